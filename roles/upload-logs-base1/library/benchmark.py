@@ -0,0 +1,419 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark the uploaders against a local object store.
+
+A synthetic log tree is generated, with a number of files, a log-normal
+size distribution, a directory depth and a mix of text and binary
+files, and uploaded by each uploader to a FakeObjectStore.  The store
+runs in a process of its own, and every upload in a fresh child
+process, so that the objects and MB per second, CPU seconds, peak RSS
+and index build time measured are the ones of the upload alone.
+
+Thread counts and compression CPU budgets can be swept to tune them.
+Results can be saved as a baseline and later runs compared to it, to
+catch regressions in upload_utils.py.  From the roles directory:
+
+  python -m upload-logs-base1.library.benchmark --save-baseline base.json
+  python -m upload-logs-base1.library.benchmark --baseline base.json
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import fixtures
+
+from .fakeobjectstore import FakeObjectStore
+
+
+UPLOADERS = ('swift', 's3', 'gcs')
+CONTAINER = 'logs'
+
+# Metrics compared to a baseline, and whether higher is better
+COMPARED_METRICS = (
+    ('objects_per_second', True),
+    ('mb_per_second', True),
+    ('cpu_seconds', False),
+    ('peak_rss_mb', False),
+    ('index_seconds', False),
+)
+
+TEXT_EXTENSIONS = ('.txt', '.log', '.json', '.yaml', '.html')
+BINARY_EXTENSIONS = ('.bin', '.png', '.xz')
+DIRECTORIES = ('controller', 'compute1', 'logs', 'etc', 'nova', 'neutron',
+               'keystone', 'apache', 'openvswitch', 'zuul-info')
+LOG_LINES = (
+    '%(time)s | INFO | nova.compute.manager [req-%(id)s] [instance: '
+    '%(uuid)s] Took %(float)s seconds to spawn the instance.\n',
+    '%(time)s | DEBUG | oslo_concurrency.lockutils [-] Lock "compute_'
+    'resources" acquired by "update_usage" :: waited %(float)ss\n',
+    '%(time)s | WARNING | neutron.agent.linux.utils [req-%(id)s] Exit '
+    'code: %(int)s; Stdout: ; Stderr: Cannot find device "tap%(id)s"\n',
+    '%(time)s | ERROR | keystone.common.wsgi [req-%(id)s] Could not find '
+    'token: %(uuid)s\n',
+    '%(time)s | INFO | tempest.lib.common.rest_client [req-%(id)s] '
+    'Request (ServersTestJSON:test_list): 200 GET http://10.0.0.%(int)s/'
+    'compute/v2.1/servers/%(uuid)s %(float)ss\n',
+)
+
+
+def _text(rnd, size):
+    lines = []
+    length = 0
+    start = 1500000000 + rnd.randrange(10 ** 8)
+    while length < size:
+        line = rnd.choice(LOG_LINES) % {
+            'time': time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.gmtime(start + length // 1000)),
+            'id': '%08x' % rnd.getrandbits(32),
+            'uuid': '%032x' % rnd.getrandbits(128),
+            'int': rnd.randrange(256),
+            'float': '%.3f' % rnd.random(),
+        }
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)[:size].encode('utf-8')
+
+
+def _binary(rnd, size):
+    return rnd.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+
+def generate_log_tree(root, files=500, mean_size=32 * 1024, size_sigma=1.5,
+                      depth=3, text_ratio=0.8, seed=0):
+    """Write a synthetic log tree of a job
+
+    Args:
+        root (str): Directory to write the tree into.
+        files (int): Number of files.
+        mean_size (int): Mean size of the files in bytes.
+        size_sigma (float): Spread of the log-normal distribution of the
+                            sizes, many small files and a few big ones.
+        depth (int): Maximum depth of the directories.
+        text_ratio (float): Fraction of the files that are text logs, the
+                            rest are binary and do not compress.
+        seed: Seed of the generation, the same tree is generated with
+              the same arguments.
+
+    Returns:
+        The total size of the files in bytes.
+    """
+    rnd = random.Random(seed)
+    mu = math.log(mean_size) - size_sigma ** 2 / 2
+    total = 0
+    for i in range(files):
+        directory = os.path.join(root, *[
+            rnd.choice(DIRECTORIES) for x in range(rnd.randint(0, depth))])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = int(rnd.lognormvariate(mu, size_sigma))
+        if rnd.random() < text_ratio:
+            name = 'file-%d%s' % (i, rnd.choice(TEXT_EXTENSIONS))
+            data = _text(rnd, size)
+        else:
+            name = 'file-%d%s' % (i, rnd.choice(BINARY_EXTENSIONS))
+            data = _binary(rnd, size)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+class LogTreeFixture(fixtures.Fixture):
+    """A synthetic log tree in a temporary directory
+
+    The keyword arguments are the ones of generate_log_tree.
+    """
+
+    def __init__(self, **kwargs):
+        super(LogTreeFixture, self).__init__()
+        self.kwargs = kwargs
+
+    def _setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.size = generate_log_tree(self.root, **self.kwargs)
+
+
+def _serve(queue, options):
+    server = FakeObjectStore(**options)
+    server.create_container(CONTAINER)
+    queue.put({
+        'swift': server.swift_endpoint,
+        'auth_url': server.auth_url,
+        's3': server.s3_endpoint,
+        'gcs': server.gcs_endpoint,
+    })
+    server.serve_forever()
+
+
+# Each child only imports the client library of its uploader, to not
+# count the others in its peak RSS.
+
+def _swift_uploader(endpoints):
+    import openstack
+    from . import zuul_swift_upload
+    cloud = openstack.connect(
+        auth_type='v3password',
+        auth=dict(auth_url=endpoints['auth_url'], username='bench',
+                  password='bench', project_name='bench',
+                  user_domain_name='Default', project_domain_name='Default'),
+        region_name='RegionOne')
+    cloud.authorize()
+    return lambda files, **options: zuul_swift_upload.run(
+        cloud, CONTAINER, files, **options)
+
+
+def _s3_uploader(endpoints):
+    from . import zuul_s3_upload
+    return lambda files, **options: zuul_s3_upload.run(
+        CONTAINER, True, files, endpoint=endpoints['s3'],
+        aws_access_key='bench', aws_secret_key='bench', **options)
+
+
+def _gcs_uploader(endpoints):
+    from . import zuul_google_storage_upload
+    os.environ['STORAGE_EMULATOR_HOST'] = endpoints['gcs']
+    return lambda files, **options: zuul_google_storage_upload.run(
+        CONTAINER, files, project='bench', **options)
+
+
+def _measure(queue, uploader, endpoints, root, size, options):
+    upload = {'swift': _swift_uploader, 's3': _s3_uploader,
+              'gcs': _gcs_uploader}[uploader](endpoints)
+    files = [root.rstrip('/') + '/']
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    result = upload(files, metrics=True, **options)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    failures, report = result[3], result[6]
+    # KiB on Linux, bytes on macOS
+    rss = after.ru_maxrss / (1024.0 * (1024 if sys.platform == 'darwin'
+                                       else 1))
+    queue.put({
+        'objects': report['objects'],
+        'failures': len(failures or []),
+        'seconds': round(seconds, 3),
+        'objects_per_second': round(report['objects'] / seconds, 1),
+        'mb_per_second': round(size / seconds / 1024 / 1024, 2),
+        'cpu_seconds': round(
+            after.ru_utime + after.ru_stime -
+            before.ru_utime - before.ru_stime, 3),
+        'peak_rss_mb': round(rss, 1),
+        'scan_seconds': report['time'].get('scan', 0),
+        'index_seconds': report['time'].get('index', 0),
+        'retries': report['retries'],
+    })
+
+
+def run_benchmarks(root, size, uploaders=UPLOADERS, concurrencies=(None,),
+                   budgets=('medium',), repeat=1, server_options=None,
+                   upload_options=None):
+    """Upload a log tree with every combination of the options
+
+    Args:
+        root (str): The log tree to upload.
+        size (int): Total size of the files of the tree in bytes.
+        uploaders (list): Uploaders to run.
+        concurrencies (list): Upload thread counts to run with, None
+                              for the default of each uploader.
+        budgets (list): Compression CPU budgets to run with.
+        repeat (int): Runs of each combination, the median one is kept.
+        server_options (dict): Arguments of the FakeObjectStore.
+        upload_options (dict): More arguments of the run() of uploaders.
+
+    Returns:
+        A dict of the measurements by benchmark name.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    server = context.Process(target=_serve,
+                             args=(queue, server_options or {}))
+    server.daemon = True
+    server.start()
+    results = {}
+    try:
+        endpoints = queue.get(timeout=60)
+        for uploader in uploaders:
+            for concurrency in concurrencies:
+                for budget in budgets:
+                    options = dict(upload_options or {},
+                                   compression_cpu_budget=budget)
+                    name = '%s budget=%s' % (uploader, budget)
+                    if concurrency:
+                        options['concurrency'] = concurrency
+                        name += ' concurrency=%d' % concurrency
+                    runs = []
+                    for x in range(repeat):
+                        child = context.Process(
+                            target=_measure,
+                            args=(queue, uploader, endpoints, root, size,
+                                  options))
+                        child.start()
+                        runs.append(queue.get())
+                        child.join()
+                    runs.sort(key=lambda r: r['seconds'])
+                    results[name] = runs[len(runs) // 2]
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Find the metrics of results worse than the baseline
+
+    Args:
+        results (dict): Measurements by benchmark name.
+        baseline (dict): Measurements by benchmark name to compare to.
+        tolerance (float): Relative change allowed before a worse
+                           metric is a regression.
+
+    Returns:
+        A list of (name, metric, baseline value, value) of regressions.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old = baseline[name].get(metric)
+            new = results[name].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_results(results, out=sys.stdout):
+    columns = ('objects', 'failures', 'seconds', 'objects_per_second',
+               'mb_per_second', 'cpu_seconds', 'peak_rss_mb',
+               'index_seconds')
+    width = max([len(name) for name in results] + [9])
+    print('%-*s %s' % (width, 'benchmark', ' '.join(
+        '%*s' % (max(len(c), 8), c) for c in columns)), file=out)
+    for name in sorted(results):
+        print('%-*s %s' % (width, name, ' '.join(
+            '%*s' % (max(len(c), 8), results[name][c])
+            for c in columns)), file=out)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        __doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploader', action='append', choices=UPLOADERS,
+                        help='uploader to run, repeat for several, '
+                             'defaults to all of them')
+    parser.add_argument('--tree',
+                        help='upload this directory instead of a '
+                             'generated log tree')
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of files of the log tree')
+    parser.add_argument('--mean-size', type=int, default=32 * 1024,
+                        help='mean size of the files in bytes')
+    parser.add_argument('--size-sigma', type=float, default=1.5,
+                        help='spread of the log-normal file sizes')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='maximum depth of the directories')
+    parser.add_argument('--text-ratio', type=float, default=0.8,
+                        help='fraction of text files, the rest is binary')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the log tree generation')
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='upload threads, repeat to compare several')
+    parser.add_argument('--compression-cpu-budget', action='append',
+                        choices=('low', 'medium', 'high'),
+                        help='compression CPU budget, repeat to compare '
+                             'several, defaults to medium')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each benchmark, the median is kept')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the object store waits to answer')
+    parser.add_argument('--bandwidth', type=int,
+                        help='bytes per second of the object store')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of the requests to fail')
+    parser.add_argument('--baseline',
+                        help='compare the results to this baseline and '
+                             'exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change allowed from the baseline')
+    parser.add_argument('--save-baseline',
+                        help='save the results as a baseline to this file')
+    args = parser.parse_args()
+
+    tree = {
+        'files': args.files,
+        'mean_size': args.mean_size,
+        'size_sigma': args.size_sigma,
+        'depth': args.depth,
+        'text_ratio': args.text_ratio,
+        'seed': args.seed,
+    }
+    if args.tree:
+        root = args.tree
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for path, _, files in os.walk(root) for f in files)
+        tree = {'path': os.path.abspath(root)}
+    else:
+        root = tempfile.mkdtemp()
+        size = generate_log_tree(root, **tree)
+    try:
+        results = run_benchmarks(
+            root, size, uploaders=args.uploader or UPLOADERS,
+            concurrencies=args.concurrency or (None,),
+            budgets=args.compression_cpu_budget or ('medium',),
+            repeat=args.repeat,
+            server_options={'latency': args.latency,
+                            'bandwidth': args.bandwidth,
+                            'error_rate': args.error_rate,
+                            'seed': args.seed})
+    finally:
+        if not args.tree:
+            shutil.rmtree(root)
+
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'tree': tree, 'results': results}, f, indent=2,
+                      sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['tree'] != tree:
+            print('The baseline was made with another log tree: %s' %
+                  baseline['tree'])
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for name, metric, old, new in regressions:
+            print('Regression: %s %s %s -> %s' % (name, metric, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,1000 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A local object store for tests and benchmarks of the uploaders.
+
+It speaks enough of the Swift, S3 and Google Cloud Storage JSON APIs
+for the uploaders to run against it over real HTTP, with no network:
+containers and buckets, objects sent with a length or chunked, Swift
+extract-archive, Static Large Objects, symlinks and bulk delete, S3
+multipart uploads and multi-object delete, and GCS simple, multipart
+and resumable uploads.  Objects are kept in memory.
+
+Latency, bandwidth and errors can be injected, and requests beyond a
+number in flight are throttled, to see how the uploaders behave when
+the object store is slow or in trouble.
+
+Run it on its own to point the command line of an uploader at it.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import collections
+import hashlib
+import io
+import json
+import mimetypes
+import random
+import re
+import struct
+import tarfile
+import threading
+import time
+import uuid
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+from xml.sax.saxutils import escape
+
+import fixtures
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+
+READ_CHUNK_SIZE = 65536
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def _crc32c(data):
+    if google_crc32c is not None:
+        return google_crc32c.value(data)
+    crc = 0xffffffff
+    for byte in bytearray(data):
+        crc ^= byte
+        for x in range(8):
+            crc = (crc >> 1) ^ (0x82f63b78 & -(crc & 1))
+    return crc ^ 0xffffffff
+
+
+class FakeObject():
+    """An object, or the manifest of a Static Large Object"""
+
+    def __init__(self, body, headers=None, segments=None, etag=None):
+        self.body = body
+        self.headers = headers or {}
+        # (container, name) of the segments of a large object
+        self.segments = segments
+        self.etag = etag or hashlib.md5(body).hexdigest()
+        self.created = time.time()
+
+    def expired(self):
+        delete_at = self.headers.get('x-delete-at')
+        return delete_at is not None and int(delete_at) <= time.time()
+
+
+class FakeContainer():
+    def __init__(self, metadata=None):
+        self.metadata = metadata or {}
+        self.objects = {}
+
+
+class Throttle():
+    """Share a bandwidth between all connections"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + size / float(self.rate)
+            delay = self._next - now
+        time.sleep(delay)
+
+
+class InjectedError():
+    def __init__(self, status, count, path, retry_after):
+        self.status = status
+        self.count = count
+        self.path = path
+        self.retry_after = retry_after
+
+
+class FakeObjectStore(ThreadingMixIn, HTTPServer):
+    """The object store, serving until shutdown()
+
+    Swift is served under /v1/<account>, the GCS JSON API under
+    /storage/v1 and /upload/storage/v1, and S3 with path-style bucket
+    names everywhere else.  One container is the same for all of them.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, token=None, latency=0,
+                 bandwidth=None, error_rate=0, error_status=503,
+                 retry_after=None, max_requests=None, seed=None):
+        """
+        Args:
+            token (str): The X-Auth-Token Swift requests need, if any.
+            latency (float): Seconds to wait before every response.
+            bandwidth (int): Bytes per second all request bodies share.
+            error_rate (float): Fraction of the requests failed with
+                                error_status.
+            retry_after (int): Retry-After sent with injected errors and
+                               throttled requests.
+            max_requests (int): Requests in flight beyond this number
+                                are throttled with HTTP 429.
+            seed: Seed of the random error injection, to repeat it.
+        """
+        HTTPServer.__init__(self, (host, port), FakeObjectStoreHandler)
+        self.token = token
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.max_requests = max_requests
+        self.random = random.Random(seed)
+        self.containers = {}
+        self.uploads = {}
+        self.connections = 0
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.bytes_received = 0
+        self.active = 0
+        self.peak_active = 0
+        self.lock = threading.Lock()
+        self._errors = []
+        url = 'http://%s:%d' % (host, self.server_address[1])
+        self.s3_endpoint = url
+        self.gcs_endpoint = url
+        self.swift_endpoint = url + '/v1/AUTH_test'
+        self.auth_url = url + '/v3'
+
+    def inject_error(self, status, count=1, path=None, retry_after=None):
+        """Fail the next count requests, or those with path in their URL"""
+        with self.lock:
+            self._errors.append(
+                InjectedError(status, count, path, retry_after))
+
+    def _take_error(self, path):
+        with self.lock:
+            for error in self._errors:
+                if error.path is None or error.path in path:
+                    error.count -= 1
+                    if not error.count:
+                        self._errors.remove(error)
+                    return error.status, error.retry_after
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.error_status, self.retry_after
+        return None
+
+    def create_container(self, name, metadata=None):
+        """Create a container or bucket, as the clouds of a job have"""
+        with self.lock:
+            self.containers.setdefault(name, FakeContainer(metadata))
+
+    def get_object(self, container, name):
+        """The FakeObject stored under a name, or None"""
+        with self.lock:
+            c = self.containers.get(container)
+            return c.objects.get(name) if c else None
+
+    def get_data(self, container, name):
+        """The data of an object as sent, large objects put together"""
+        with self.lock:
+            obj = self.containers[container].objects[name]
+            return self._object_data(obj)
+
+    def _object_data(self, obj):
+        if obj.segments is None:
+            return obj.body
+        return b''.join(
+            self._object_data(self.containers[c].objects[n])
+            for c, n in obj.segments)
+
+    def objects(self, container):
+        """The names of the objects in a container"""
+        with self.lock:
+            return sorted(self.containers[container].objects)
+
+
+class FakeObjectStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    # Request bodies
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        self.server.throttle.consume(len(data))
+        return data
+
+    def _read_body(self):
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    # Trailers
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                chunks.append(self._read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            length = int(self.headers.get('content-length', 0))
+            chunks = []
+            while length > 0:
+                chunk = self._read(min(length, READ_CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length -= len(chunk)
+            body = b''.join(chunks)
+        if ('aws-chunked' in self.headers.get('content-encoding', '') or
+                'x-amz-decoded-content-length' in self.headers):
+            body = self._decode_aws_chunked(body)
+        return body
+
+    @staticmethod
+    def _decode_aws_chunked(body):
+        stream = io.BytesIO(body)
+        chunks = []
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            size = int(line.split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append(stream.read(size))
+            stream.readline()
+        return b''.join(chunks)
+
+    # Dispatch
+
+    def _handle(self, method):
+        server = self.server
+        url = urlparse.urlsplit(self.path)
+        path = urlparse.unquote(url.path)
+        self.query = dict(urlparse.parse_qsl(url.query,
+                                             keep_blank_values=True))
+        body = self._read_body()
+        if path.startswith('/v1/'):
+            api = 'swift'
+        elif path.startswith('/v3'):
+            api = 'keystone'
+        elif path.startswith(('/storage/v1/', '/upload/storage/v1/',
+                              '/download/storage/v1/')):
+            api = 'gcs'
+        else:
+            api = 's3'
+        with server.lock:
+            server.requests[method] += 1
+            server.bytes_received += len(body)
+            server.active += 1
+            server.peak_active = max(server.peak_active, server.active)
+            throttled = (server.max_requests and
+                         server.active > server.max_requests)
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            if throttled:
+                error = (429, server.retry_after)
+            else:
+                error = server._take_error(self.path)
+            if error:
+                status, retry_after = error
+                headers = {}
+                if retry_after is not None:
+                    headers['Retry-After'] = str(retry_after)
+                response = self._error(api, status, 'Injected error',
+                                       headers)
+            else:
+                handler = getattr(self, '_%s' % api)
+                with server.lock:
+                    response = handler(method, path, body)
+        finally:
+            with server.lock:
+                server.active -= 1
+        self._respond(method, *response)
+
+    def _respond(self, method, status, headers=None, body=b''):
+        with self.server.lock:
+            self.server.statuses[status] += 1
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if method != 'HEAD' and status not in (204, 304):
+            self.wfile.write(body)
+
+    def _error(self, api, status, message, headers=None):
+        headers = dict(headers or {})
+        if api == 's3':
+            code = {404: 'NoSuchKey', 409: 'BucketNotEmpty',
+                    429: 'SlowDown', 503: 'SlowDown'}.get(status,
+                                                          'InternalError')
+            headers['Content-Type'] = 'application/xml'
+            return status, headers, (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Error><Code>%s</Code><Message>%s</Message></Error>' % (
+                    code, escape(message)))
+        if api == 'gcs':
+            headers['Content-Type'] = 'application/json'
+            return status, headers, json.dumps({'error': {
+                'code': status, 'message': message,
+                'errors': [{'message': message}]}})
+        headers['Content-Type'] = 'text/plain'
+        return status, headers, message
+
+    def _range(self, data, headers):
+        """Answer a Range header with the part of data it asks for"""
+        match = re.match(r'bytes=(\d*)-(\d*)$',
+                         self.headers.get('range', ''))
+        if not match or not data:
+            return 200, headers, data
+        start, end = match.groups()
+        if not start:
+            start, end = max(0, len(data) - int(end)), len(data) - 1
+        else:
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+        if start > end:
+            return 416, headers, b''
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+        return 206, headers, data[start:end + 1]
+
+    # Keystone, for the service catalog of openstacksdk
+
+    def _keystone(self, method, path, body):
+        server = self.server
+        if method != 'POST' or not path.startswith('/v3/auth/tokens'):
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'version': {'id': 'v3.14', 'status': 'stable', 'links': [
+                    {'rel': 'self',
+                     'href': server.auth_url + '/'}]}})
+        now = time.time()
+        token = {
+            'methods': ['password'],
+            'issued_at': time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+                                       time.gmtime(now)),
+            'expires_at': time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+                                        time.gmtime(now + 86400)),
+            'user': {'id': 'test', 'name': 'test',
+                     'domain': {'id': 'default', 'name': 'Default'}},
+            'project': {'id': 'test', 'name': 'test',
+                        'domain': {'id': 'default', 'name': 'Default'}},
+            'roles': [{'id': 'member', 'name': 'member'}],
+            'catalog': [{
+                'id': 'swift', 'type': 'object-store', 'name': 'swift',
+                'endpoints': [{
+                    'id': 'swift-public', 'interface': 'public',
+                    'region': 'RegionOne', 'region_id': 'RegionOne',
+                    'url': server.swift_endpoint,
+                }],
+            }],
+        }
+        return 201, {
+            'Content-Type': 'application/json',
+            'X-Subject-Token': server.token or 'token',
+        }, json.dumps({'token': token})
+
+    # Swift
+
+    def _swift(self, method, path, body):
+        server = self.server
+        if server.token and self.headers.get('x-auth-token') != server.token:
+            return self._error('swift', 401, 'Unauthorized')
+        parts = path.split('/', 4)[3:]
+        container = parts[0] if parts else ''
+        name = parts[1] if len(parts) > 1 else ''
+        if 'extract-archive' in self.query and method == 'PUT':
+            return self._swift_extract(container, name, body)
+        if not container:
+            if method == 'POST' and 'bulk-delete' in self.query:
+                return self._swift_bulk_delete(body)
+            return self._swift_list(
+                sorted(server.containers), dict(
+                    (n, len(c.objects))
+                    for n, c in server.containers.items()))
+        if not name:
+            return self._swift_container(method, container)
+        c = server.containers.get(container)
+        if c is None:
+            return self._error('swift', 404, 'Container not found')
+        if method == 'PUT':
+            return self._swift_put(c, container, name, body)
+        obj = c.objects.get(name)
+        if obj is not None and obj.expired():
+            del c.objects[name]
+            obj = None
+        if obj is None:
+            return self._error('swift', 404, 'Not Found')
+        if method in ('GET', 'HEAD'):
+            return self._swift_get(container, obj)
+        if method == 'POST':
+            obj.headers = dict(
+                (k, v) for k, v in obj.headers.items()
+                if not k.startswith('x-object-meta-'))
+            obj.headers.update(self._object_headers('x-object-meta-'))
+            return 202, {}, b''
+        if method == 'DELETE':
+            del c.objects[name]
+            if (obj.segments is not None and
+                    self.query.get('multipart-manifest') == 'delete'):
+                for seg_container, seg_name in obj.segments:
+                    server.containers[seg_container].objects.pop(seg_name,
+                                                                 None)
+            return 204, {}, b''
+        return self._error('swift', 405, 'Method Not Allowed')
+
+    def _object_headers(self, meta_prefix):
+        headers = {}
+        for key, value in self.headers.items():
+            key = key.lower()
+            if (key.startswith(meta_prefix) or key in (
+                    'content-type', 'content-encoding',
+                    'content-disposition', 'x-symlink-target',
+                    'x-delete-at', 'cache-control')):
+                headers[key] = value
+        encoding = headers.get('content-encoding', '')
+        if 'aws-chunked' in encoding:
+            encoding = ','.join(e for e in encoding.split(',')
+                                if e.strip() != 'aws-chunked')
+            if encoding:
+                headers['content-encoding'] = encoding
+            else:
+                del headers['content-encoding']
+        if self.headers.get('x-delete-after'):
+            headers['x-delete-at'] = str(
+                int(time.time()) + int(self.headers['x-delete-after']))
+        return headers
+
+    def _swift_list(self, names, counts=None):
+        if self.query.get('prefix'):
+            names = [n for n in names if n.startswith(self.query['prefix'])]
+        if self.query.get('format') == 'json':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                [{'name': n, 'count': (counts or {}).get(n, 0)}
+                 for n in names])
+        return (200 if names else 204,
+                {'Content-Type': 'text/plain'},
+                ''.join(n + '\n' for n in names))
+
+    def _swift_container(self, method, container):
+        server = self.server
+        c = server.containers.get(container)
+        metadata = dict((k.lower(), v) for k, v in self.headers.items()
+                        if k.lower().startswith('x-container-'))
+        if method == 'PUT':
+            if c is None:
+                server.containers[container] = FakeContainer(metadata)
+                return 201, {}, b''
+            c.metadata.update(metadata)
+            return 202, {}, b''
+        if c is None:
+            return self._error('swift', 404, 'Container not found')
+        if method == 'POST':
+            c.metadata.update(metadata)
+            return 204, {}, b''
+        if method == 'HEAD':
+            headers = dict(c.metadata)
+            headers['X-Container-Object-Count'] = str(len(c.objects))
+            headers['X-Container-Bytes-Used'] = str(
+                sum(len(o.body) for o in c.objects.values()))
+            return 204, headers, b''
+        if method == 'GET':
+            return self._swift_list(sorted(c.objects))
+        if method == 'DELETE':
+            if c.objects:
+                return self._error('swift', 409, 'Container not empty')
+            del server.containers[container]
+            return 204, {}, b''
+        return self._error('swift', 405, 'Method Not Allowed')
+
+    def _swift_put(self, c, container, name, body):
+        headers = self._object_headers('x-object-meta-')
+        if self.query.get('multipart-manifest') == 'put':
+            return self._swift_put_manifest(c, name, body, headers)
+        obj = FakeObject(body, headers)
+        c.objects[name] = obj
+        return 201, {'Etag': obj.etag}, b''
+
+    def _swift_put_manifest(self, c, name, body, headers):
+        segments = []
+        errors = []
+        etags = hashlib.md5()
+        for segment in json.loads(body.decode('utf-8')):
+            seg_container, seg_name = segment['path'].lstrip('/').split(
+                '/', 1)
+            seg_container = urlparse.unquote(seg_container)
+            seg_name = urlparse.unquote(seg_name)
+            sc = self.server.containers.get(seg_container)
+            obj = sc.objects.get(seg_name) if sc else None
+            if obj is None:
+                errors.append([segment['path'], '404 Not Found'])
+            elif segment.get('etag') and segment['etag'] != obj.etag:
+                errors.append([segment['path'], 'Etag Mismatch'])
+            elif (segment.get('size_bytes') is not None and
+                    segment['size_bytes'] != len(obj.body)):
+                errors.append([segment['path'], 'Size Mismatch'])
+            else:
+                segments.append((seg_container, seg_name))
+                etags.update(obj.etag.encode('ascii'))
+        if errors:
+            return 400, {'Content-Type': 'application/json'}, json.dumps(
+                {'Errors': errors})
+        obj = FakeObject(b'', headers, segments, etags.hexdigest())
+        c.objects[name] = obj
+        return 201, {'Etag': '"%s"' % obj.etag}, b''
+
+    def _swift_get(self, container, obj):
+        headers = {}
+        for key, value in obj.headers.items():
+            if key != 'x-symlink-target':
+                headers[key] = value
+        target = obj.headers.get('x-symlink-target')
+        if target and self.query.get('symlink') != 'get':
+            target_container, target_name = urlparse.unquote(
+                target).split('/', 1)
+            tc = self.server.containers.get(target_container)
+            linked = tc.objects.get(target_name) if tc else None
+            if linked is None or linked.expired():
+                return self._error('swift', 409, 'Broken symlink')
+            headers.update(linked.headers)
+            obj = linked
+        if (obj.segments is not None and
+                self.query.get('multipart-manifest') == 'get'):
+            data = json.dumps([{'name': '/%s/%s' % s}
+                               for s in obj.segments]).encode('utf-8')
+        else:
+            data = self.server._object_data(obj)
+        headers['Etag'] = obj.etag
+        return self._range(data, headers)
+
+    def _swift_extract(self, container, prefix, body):
+        server = self.server
+        fmt = self.query.get('extract-archive') or 'tar'
+        mode = {'tar': 'r:', 'tar.gz': 'r:gz', 'tar.bz2': 'r:bz2'}[fmt]
+        created = 0
+        errors = []
+        with tarfile.open(fileobj=io.BytesIO(body), mode=mode) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                path = member.name.lstrip('./')
+                if prefix:
+                    path = prefix.rstrip('/') + '/' + path
+                if container:
+                    target, name = container, path
+                else:
+                    target, name = path.split('/', 1)
+                c = server.containers.get(target)
+                if c is None:
+                    if container:
+                        errors.append([member.name, '404 Not Found'])
+                        continue
+                    c = server.containers[target] = FakeContainer()
+                headers = self._object_headers('x-object-meta-')
+                if self.headers.get('x-detect-content-type'):
+                    guess = mimetypes.guess_type(name)[0]
+                    headers['content-type'] = guess or 'text/plain'
+                headers.pop('content-encoding', None)
+                for key, value in member.pax_headers.items():
+                    if key.startswith('SCHILY.xattr.user.mime_type'):
+                        headers['content-type'] = value
+                    elif key.startswith('SCHILY.xattr.user.meta.'):
+                        headers['x-object-meta-' + key.split('.')[-1]] = (
+                            value)
+                c.objects[name] = FakeObject(
+                    tar.extractfile(member).read(), headers)
+                created += 1
+        result = {
+            'Response Status': '400 Bad Request' if errors else '201 Created',
+            'Response Body': '',
+            'Number Files Created': created,
+            'Errors': errors,
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result)
+
+    def _swift_bulk_delete(self, body):
+        server = self.server
+        deleted = 0
+        missing = 0
+        errors = []
+        for line in body.decode('utf-8').splitlines():
+            path = urlparse.unquote(line.strip()).lstrip('/')
+            if not path:
+                continue
+            container, _, name = path.partition('/')
+            c = server.containers.get(container)
+            if name:
+                if c is not None and c.objects.pop(name, None) is not None:
+                    deleted += 1
+                else:
+                    missing += 1
+            elif c is None:
+                missing += 1
+            elif c.objects:
+                errors.append([line.strip(), '409 Conflict'])
+            else:
+                del server.containers[container]
+                deleted += 1
+        result = {
+            'Response Status': '400 Bad Request' if errors else '200 OK',
+            'Response Body': '',
+            'Number Deleted': deleted,
+            'Number Not Found': missing,
+            'Errors': errors,
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result)
+
+    # S3
+
+    def _s3(self, method, path, body):
+        server = self.server
+        bucket, _, key = path.lstrip('/').partition('/')
+        if not bucket:
+            return self._s3_xml('ListAllMyBucketsResult', '<Buckets>%s'
+                                '</Buckets>' % ''.join(
+                                    '<Bucket><Name>%s</Name></Bucket>' %
+                                    escape(n)
+                                    for n in sorted(server.containers)))
+        c = server.containers.get(bucket)
+        if not key:
+            return self._s3_bucket(method, bucket, c, body)
+        if c is None:
+            return self._error('s3', 404, 'The bucket does not exist')
+        if method == 'POST' and 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            server.uploads[upload_id] = (
+                self._object_headers('x-amz-meta-'), {})
+            return self._s3_xml(
+                'InitiateMultipartUploadResult',
+                '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>' % (
+                    escape(bucket), escape(key), upload_id))
+        if 'uploadId' in self.query:
+            return self._s3_multipart(method, c, bucket, key, body)
+        if method == 'PUT':
+            obj = FakeObject(body, self._object_headers('x-amz-meta-'))
+            c.objects[key] = obj
+            return 200, {'ETag': '"%s"' % obj.etag}, b''
+        obj = c.objects.get(key)
+        if obj is None:
+            return self._error('s3', 404, 'The key does not exist')
+        if method in ('GET', 'HEAD'):
+            headers = dict(obj.headers)
+            headers['ETag'] = '"%s"' % obj.etag
+            headers.setdefault('content-type', 'binary/octet-stream')
+            return self._range(server._object_data(obj), headers)
+        if method == 'DELETE':
+            del c.objects[key]
+            return 204, {}, b''
+        return self._error('s3', 405, 'Method Not Allowed')
+
+    def _s3_xml(self, root, content, status=200):
+        return status, {'Content-Type': 'application/xml'}, (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<%s xmlns="%s">%s</%s>' % (root, S3_NAMESPACE, content, root))
+
+    def _s3_bucket(self, method, bucket, c, body):
+        server = self.server
+        if method == 'PUT':
+            if c is None:
+                server.containers[bucket] = FakeContainer()
+            return 200, {'Location': '/' + bucket}, b''
+        if c is None:
+            return self._error('s3', 404, 'The bucket does not exist')
+        if method == 'HEAD':
+            return 200, {}, b''
+        if method == 'GET':
+            prefix = self.query.get('prefix', '')
+            names = [n for n in sorted(c.objects) if n.startswith(prefix)]
+            return self._s3_xml('ListBucketResult', (
+                '<Name>%s</Name><Prefix>%s</Prefix><KeyCount>%d</KeyCount>'
+                '<IsTruncated>false</IsTruncated>%s') % (
+                    escape(bucket), escape(prefix), len(names), ''.join(
+                        '<Contents><Key>%s</Key><Size>%d</Size>'
+                        '<ETag>"%s"</ETag></Contents>' % (
+                            escape(n),
+                            len(server._object_data(c.objects[n])),
+                            c.objects[n].etag)
+                        for n in names)))
+        if method == 'POST' and 'delete' in self.query:
+            deleted = []
+            for key in re.findall(r'<Key>(.*?)</Key>', body.decode('utf-8')):
+                key = (key.replace('&lt;', '<').replace('&gt;', '>')
+                       .replace('&amp;', '&'))
+                c.objects.pop(key, None)
+                deleted.append('<Deleted><Key>%s</Key></Deleted>' %
+                               escape(key))
+            return self._s3_xml('DeleteResult', ''.join(deleted))
+        if method == 'DELETE':
+            if c.objects:
+                return self._error('s3', 409, 'The bucket is not empty')
+            del server.containers[bucket]
+            return 204, {}, b''
+        return self._error('s3', 405, 'Method Not Allowed')
+
+    def _s3_multipart(self, method, c, bucket, key, body):
+        server = self.server
+        upload_id = self.query['uploadId']
+        if upload_id not in server.uploads:
+            return self._error('s3', 404, 'The upload does not exist')
+        headers, parts = server.uploads[upload_id]
+        if method == 'PUT':
+            part = FakeObject(body)
+            parts[int(self.query['partNumber'])] = part
+            return 200, {'ETag': '"%s"' % part.etag}, b''
+        if method == 'DELETE':
+            del server.uploads[upload_id]
+            return 204, {}, b''
+        numbers = [int(n) for n in re.findall(
+            r'<PartNumber>(\d+)</PartNumber>', body.decode('utf-8'))]
+        digest = hashlib.md5(b''.join(
+            hashlib.md5(parts[n].body).digest() for n in numbers))
+        obj = FakeObject(b''.join(parts[n].body for n in numbers), headers,
+                         etag='%s-%d' % (digest.hexdigest(), len(numbers)))
+        c.objects[key] = obj
+        del server.uploads[upload_id]
+        return self._s3_xml(
+            'CompleteMultipartUploadResult',
+            '<Bucket>%s</Bucket><Key>%s</Key><ETag>"%s"</ETag>' % (
+                escape(bucket), escape(key), obj.etag))
+
+    # Google Cloud Storage
+
+    def _gcs_resource(self, bucket, name, obj):
+        data = self.server._object_data(obj)
+        return {
+            'kind': 'storage#object',
+            'id': '%s/%s/1' % (bucket, name),
+            'bucket': bucket,
+            'name': name,
+            'generation': '1',
+            'metageneration': '1',
+            'size': str(len(data)),
+            'contentType': obj.headers.get('content-type',
+                                           'application/octet-stream'),
+            'contentEncoding': obj.headers.get('content-encoding'),
+            'md5Hash': base64.b64encode(
+                hashlib.md5(data).digest()).decode('ascii'),
+            'crc32c': base64.b64encode(
+                struct.pack('>I', _crc32c(data))).decode('ascii'),
+            'etag': obj.etag,
+            'metadata': dict(
+                (k[len('x-goog-meta-'):], v) for k, v in obj.headers.items()
+                if k.startswith('x-goog-meta-')),
+        }
+
+    def _gcs_json(self, data, status=200, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        return status, headers, json.dumps(data)
+
+    def _gcs_store(self, bucket, metadata, data):
+        c = self.server.containers[bucket]
+        headers = {}
+        if metadata.get('contentType'):
+            headers['content-type'] = metadata['contentType']
+        if metadata.get('contentEncoding'):
+            headers['content-encoding'] = metadata['contentEncoding']
+        for key, value in (metadata.get('metadata') or {}).items():
+            headers['x-goog-meta-' + key] = value
+        obj = FakeObject(data, headers)
+        c.objects[metadata['name']] = obj
+        return self._gcs_json(
+            self._gcs_resource(bucket, metadata['name'], obj))
+
+    def _gcs(self, method, path, body):
+        server = self.server
+        parts = path.split('/')
+        transfer = parts[1] if parts[1] in ('upload', 'download') else None
+        if transfer:
+            parts = parts[1:]
+        # ['', 'storage', 'v1', 'b', bucket, 'o', name...]
+        if len(parts) == 4 and parts[3] == 'b' and method == 'POST':
+            name = json.loads(body.decode('utf-8'))['name']
+            server.containers.setdefault(name, FakeContainer())
+            return self._gcs_json({'kind': 'storage#bucket', 'name': name})
+        if len(parts) < 5 or parts[3] != 'b':
+            return self._error('gcs', 404, 'Not Found')
+        bucket = parts[4]
+        c = server.containers.get(bucket)
+        if c is None:
+            return self._error('gcs', 404, 'The bucket does not exist')
+        if len(parts) == 5:
+            if method in ('PUT', 'PATCH') and body:
+                c.metadata.update(json.loads(body.decode('utf-8')))
+            elif method == 'DELETE':
+                if c.objects:
+                    return self._error('gcs', 409, 'The bucket is not empty')
+                del server.containers[bucket]
+                return 204, {}, b''
+            resource = {'kind': 'storage#bucket', 'name': bucket}
+            resource.update(c.metadata)
+            return self._gcs_json(resource)
+        if transfer == 'upload':
+            return self._gcs_upload(method, bucket, body)
+        name = '/'.join(parts[6:])
+        if not name:
+            prefix = self.query.get('prefix', '')
+            return self._gcs_json({'kind': 'storage#objects', 'items': [
+                self._gcs_resource(bucket, n, c.objects[n])
+                for n in sorted(c.objects) if n.startswith(prefix)]})
+        obj = c.objects.get(name)
+        if obj is None:
+            return self._error('gcs', 404, 'No such object')
+        if method == 'DELETE':
+            del c.objects[name]
+            return 204, {}, b''
+        if self.query.get('alt') == 'media' or transfer == 'download':
+            headers = dict(obj.headers)
+            return self._range(server._object_data(obj), headers)
+        return self._gcs_json(self._gcs_resource(bucket, name, obj))
+
+    def _gcs_upload(self, method, bucket, body):
+        server = self.server
+        kind = self.query.get('uploadType', 'media')
+        if kind == 'media':
+            return self._gcs_store(bucket, {
+                'name': self.query['name'],
+                'contentType': self.headers.get('content-type'),
+            }, body)
+        if kind == 'multipart':
+            boundary = re.search(r'boundary="?([^";]+)"?',
+                                 self.headers['content-type']).group(1)
+            parts = []
+            for part in body.split(b'--' + boundary.encode('ascii'))[1:-1]:
+                head, _, data = part[2:].partition(b'\r\n\r\n')
+                parts.append((head, data[:-2]))
+            metadata = json.loads(parts[0][1].decode('utf-8'))
+            media_type = re.search(br'(?i)content-type:\s*(\S+)',
+                                   parts[1][0])
+            if media_type and not metadata.get('contentType'):
+                metadata['contentType'] = media_type.group(1).decode('ascii')
+            metadata.setdefault('name', self.query.get('name'))
+            return self._gcs_store(bucket, metadata, parts[1][1])
+        if kind != 'resumable':
+            return self._error('gcs', 400, 'Unknown upload type')
+        if 'upload_id' not in self.query:
+            metadata = json.loads(body.decode('utf-8')) if body else {}
+            metadata.setdefault('name', self.query.get('name'))
+            if not metadata.get('contentType'):
+                metadata['contentType'] = self.headers.get(
+                    'x-upload-content-type')
+            upload_id = uuid.uuid4().hex
+            server.uploads[upload_id] = (metadata, [])
+            location = '%s/upload/storage/v1/b/%s/o?uploadType=resumable' \
+                '&upload_id=%s' % (server.gcs_endpoint, bucket, upload_id)
+            return 200, {'Location': location}, b''
+        upload_id = self.query['upload_id']
+        if upload_id not in server.uploads:
+            return self._error('gcs', 404, 'No such upload')
+        metadata, chunks = server.uploads[upload_id]
+        chunks.append(body)
+        total = self.headers.get('content-range', '').rpartition('/')[2]
+        received = sum(len(chunk) for chunk in chunks)
+        if total == '*' or (total.isdigit() and int(total) > received):
+            headers = {}
+            if received:
+                headers['Range'] = 'bytes=0-%d' % (received - 1)
+            return 308, headers, b''
+        del server.uploads[upload_id]
+        return self._gcs_store(bucket, metadata, b''.join(chunks))
+
+
+class FakeObjectStoreFixture(fixtures.Fixture):
+    """Serve a FakeObjectStore from a thread for the time of a test
+
+    The keyword arguments are the ones of FakeObjectStore.
+    """
+
+    def __init__(self, **kwargs):
+        super(FakeObjectStoreFixture, self).__init__()
+        self.kwargs = kwargs
+
+    def _setUp(self):
+        self.server = FakeObjectStore(**self.kwargs)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token',
+                        help='X-Auth-Token Swift requests need')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to wait before every response')
+    parser.add_argument('--bandwidth', type=int,
+                        help='Bytes per second all uploads share')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of the requests to fail')
+    parser.add_argument('--error-status', type=int, default=503,
+                        help='HTTP status of the failed requests')
+    parser.add_argument('--retry-after', type=int,
+                        help='Retry-After of failed and throttled requests')
+    parser.add_argument('--max-requests', type=int,
+                        help='Throttle requests beyond this number in '
+                             'flight with HTTP 429')
+    parser.add_argument('--seed', type=int,
+                        help='Seed of the error injection')
+    args = parser.parse_args()
+
+    server = FakeObjectStore(
+        args.host, args.port, token=args.token, latency=args.latency,
+        bandwidth=args.bandwidth, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after,
+        max_requests=args.max_requests, seed=args.seed)
+    print("Swift: %s\nS3: %s\nGCS: %s" % (
+        server.swift_endpoint, server.s3_endpoint, server.gcs_endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import testtools
+
+from .benchmark import (
+    BINARY_EXTENSIONS,
+    LogTreeFixture,
+    compare,
+    run_benchmarks,
+)
+
+
+def _walk(root):
+    return sorted(os.path.relpath(os.path.join(path, f), root)
+                  for path, _, files in os.walk(root) for f in files)
+
+
+class TestLogTree(testtools.TestCase):
+
+    def test_generate(self):
+        tree = self.useFixture(LogTreeFixture(
+            files=50, mean_size=4096, depth=2, text_ratio=0.5, seed=1))
+        files = _walk(tree.root)
+        self.assertEqual(50, len(files))
+        self.assertEqual(tree.size, sum(
+            os.path.getsize(os.path.join(tree.root, f)) for f in files))
+        self.assertLessEqual(max(f.count('/') for f in files), 2)
+        binary = [f for f in files if f.endswith(BINARY_EXTENSIONS)]
+        self.assertTrue(0 < len(binary) < 50)
+
+        # The same seed generates the same tree
+        again = self.useFixture(LogTreeFixture(
+            files=50, mean_size=4096, depth=2, text_ratio=0.5, seed=1))
+        self.assertEqual(files, _walk(again.root))
+        for f in files[:5]:
+            with open(os.path.join(tree.root, f), 'rb') as a:
+                with open(os.path.join(again.root, f), 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+
+
+class TestBenchmark(testtools.TestCase):
+
+    def test_compare(self):
+        baseline = {'s3': {'objects_per_second': 100, 'cpu_seconds': 2.0,
+                           'peak_rss_mb': 80, 'index_seconds': 0.1}}
+        results = {'s3': {'objects_per_second': 95, 'cpu_seconds': 3.0,
+                          'peak_rss_mb': 70, 'index_seconds': 0.1},
+                   'gcs': {'objects_per_second': 1}}
+        self.assertEqual([('s3', 'cpu_seconds', 2.0, 3.0)],
+                         compare(results, baseline))
+        self.assertEqual([('s3', 'objects_per_second', 100, 95),
+                          ('s3', 'cpu_seconds', 2.0, 3.0)],
+                         compare(results, baseline, tolerance=0.01))
+
+    def test_run(self):
+        tree = self.useFixture(LogTreeFixture(files=20, mean_size=4096))
+        results = run_benchmarks(tree.root, tree.size, uploaders=['s3'],
+                                 concurrencies=[2, 4])
+        self.assertEqual(['s3 budget=medium concurrency=2',
+                          's3 budget=medium concurrency=4'],
+                         sorted(results))
+        for result in results.values():
+            self.assertEqual(0, result['failures'])
+            # The files and their indexes
+            self.assertGreater(result['objects'], 20)
+            self.assertGreater(result['cpu_seconds'], 0)
+            self.assertGreater(result['peak_rss_mb'], 0)
@@ -0,0 +1,272 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import testtools
+import threading
+import time
+
+import boto3
+import openstack
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from .fakeobjectstore import FakeObjectStoreFixture
+from .zuul_google_storage_upload import Uploader as GCSUploader
+from .zuul_swift_upload import Uploader as SwiftUploader
+from ..module_utils.zuul_jobs.upload_utils import (
+    FileList,
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
+                           'test-fixtures')
+
+
+class TestSwift(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSwift, self).setUp()
+        self.server = self.useFixture(
+            FakeObjectStoreFixture(token='token')).server
+        self.session = requests.Session()
+        self.session.headers['X-Auth-Token'] = 'token'
+        self.url = self.server.swift_endpoint
+
+    def test_objects(self):
+        s = self.session
+        self.assertEqual(
+            401, requests.put(self.url + '/logs').status_code)
+        self.assertEqual(404, s.put(self.url + '/logs/a').status_code)
+        self.assertEqual(201, s.put(
+            self.url + '/logs',
+            headers={'X-Container-Meta-Web-Index': 'index.html'}
+        ).status_code)
+        self.assertEqual(204, s.post(
+            self.url + '/logs',
+            headers={'X-Container-Meta-Web-Listings': 'true'}
+        ).status_code)
+
+        # Chunked transfer encoding
+        r = s.put(self.url + '/logs/dir/a.txt',
+                  data=iter([b'hello ', b'world']),
+                  headers={'Content-Type': 'text/plain',
+                           'X-Object-Meta-Build': '1234'})
+        self.assertEqual(201, r.status_code)
+        self.assertEqual(hashlib.md5(b'hello world').hexdigest(),
+                         r.headers['etag'])
+        self.assertEqual(202, s.post(
+            self.url + '/logs/dir/a.txt',
+            headers={'X-Object-Meta-Build': '5678'}).status_code)
+        r = s.get(self.url + '/logs/dir/a.txt', headers={'Range': 'bytes=6-'})
+        self.assertEqual(206, r.status_code)
+        self.assertEqual(b'world', r.content)
+        self.assertEqual('5678', r.headers['x-object-meta-build'])
+
+        s.put(self.url + '/logs/link',
+              headers={'X-Symlink-Target': 'logs/dir/a.txt'})
+        self.assertEqual(b'hello world', s.get(self.url + '/logs/link').content)
+        s.put(self.url + '/logs/gone', data=b'x',
+              headers={'X-Delete-After': '0'})
+        self.assertEqual(404, s.get(self.url + '/logs/gone').status_code)
+
+        r = s.head(self.url + '/logs')
+        self.assertEqual('2', r.headers['x-container-object-count'])
+        self.assertEqual('index.html', r.headers['x-container-meta-web-index'])
+        self.assertEqual('true', r.headers['x-container-meta-web-listings'])
+        self.assertEqual(
+            ['dir/a.txt'],
+            [o['name'] for o in s.get(
+                self.url + '/logs',
+                params={'format': 'json', 'prefix': 'dir/'}).json()])
+
+        self.assertEqual(409, s.delete(self.url + '/logs').status_code)
+        r = s.post(self.url + '?bulk-delete',
+                   data=b'/logs/dir/a.txt\n/logs/link\n/logs/missing\n/logs\n',
+                   headers={'Accept': 'application/json'})
+        self.assertEqual(3, r.json()['Number Deleted'])
+        self.assertEqual(1, r.json()['Number Not Found'])
+        self.assertNotIn('logs', self.server.containers)
+
+    def test_extract_archive(self):
+        self.server.create_container('logs')
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name, data in [('a.txt', b'a'), ('dir/b.txt', b'bb')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        r = self.session.put(
+            self.url + '/logs/1234?extract-archive=tar.gz',
+            data=buf.getvalue(),
+            headers={'Accept': 'application/json',
+                     'X-Detect-Content-Type': 'true'})
+        self.assertEqual(2, r.json()['Number Files Created'])
+        self.assertEqual([], r.json()['Errors'])
+        self.assertEqual(['1234/a.txt', '1234/dir/b.txt'],
+                         self.server.objects('logs'))
+        self.assertEqual(
+            'text/plain',
+            self.server.get_object('logs', '1234/a.txt').headers[
+                'content-type'])
+
+    def test_large_object(self):
+        self.server.create_container('logs')
+        manifest = []
+        for i, data in enumerate([b'first ', b'second']):
+            r = self.session.put(self.url + '/logs/big/%d' % i, data=data)
+            manifest.append({'path': '/logs/big/%d' % i,
+                             'etag': r.headers['etag'],
+                             'size_bytes': len(data)})
+        bad = manifest[:1] + [dict(manifest[1], etag='wrong')]
+        self.assertEqual(400, self.session.put(
+            self.url + '/logs/big?multipart-manifest=put',
+            data=json.dumps(bad)).status_code)
+        self.assertEqual(201, self.session.put(
+            self.url + '/logs/big?multipart-manifest=put',
+            data=json.dumps(manifest)).status_code)
+        self.assertEqual(b'first second',
+                         self.session.get(self.url + '/logs/big').content)
+        self.assertEqual(204, self.session.delete(
+            self.url + '/logs/big?multipart-manifest=delete').status_code)
+        self.assertEqual([], self.server.objects('logs'))
+
+    def test_uploader(self):
+        cloud = openstack.connect(
+            auth_type='v3password',
+            auth=dict(auth_url=self.server.auth_url, username='test',
+                      password='test', project_name='test',
+                      user_domain_name='Default',
+                      project_domain_name='Default'),
+            region_name='RegionOne')
+        with FileList() as file_list:
+            file_list.add(os.path.join(FIXTURE_DIR, 'logs/'))
+            files = list(file_list)
+        for transport in ('threads', 'asyncio'):
+            uploader = SwiftUploader(cloud, transport, prefix='1234',
+                                     transport=transport)
+            self.assertEqual([], uploader.upload(files))
+            self.assertEqual(self.url + '/%s/1234' % transport,
+                             uploader.url)
+            self.assertIn('1234/job-output.json',
+                          self.server.objects(transport))
+        uploader = SwiftUploader(cloud, 'archive', prefix='1234',
+                                 archive_mode=True)
+        self.assertEqual([], uploader.upload(files))
+        self.assertIn('1234/job-output.json', self.server.objects('archive'))
+
+
+class TestS3(testtools.TestCase):
+
+    def test_api(self):
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        s3 = boto3.client('s3', endpoint_url=server.s3_endpoint,
+                          region_name='us-east-1',
+                          aws_access_key_id='access',
+                          aws_secret_access_key='secret')
+        s3.create_bucket(Bucket='logs')
+        s3.put_object(Bucket='logs', Key='a.txt', Body=b'hello',
+                      ContentType='text/plain', Metadata={'build': '1234'})
+        # Above the multipart threshold of boto3
+        data = os.urandom(9 * 1024 * 1024)
+        s3.upload_fileobj(io.BytesIO(data), 'logs', 'big')
+        self.assertEqual(data, server.get_data('logs', 'big'))
+        self.assertTrue(server.get_object('logs', 'big').etag.endswith('-2'))
+
+        r = s3.get_object(Bucket='logs', Key='a.txt')
+        self.assertEqual(b'hello', r['Body'].read())
+        self.assertEqual({'build': '1234'}, r['Metadata'])
+        self.assertEqual(
+            ['a.txt', 'big'],
+            [o['Key'] for o in s3.list_objects_v2(Bucket='logs')['Contents']])
+        s3.delete_objects(Bucket='logs', Delete={
+            'Objects': [{'Key': 'a.txt'}, {'Key': 'big'}]})
+        self.assertEqual([], server.objects('logs'))
+
+
+class TestGCS(testtools.TestCase):
+
+    def test_uploader(self):
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        server.create_container('logs')
+        client = storage.Client(
+            project='test', credentials=AnonymousCredentials(),
+            client_options={'api_endpoint': server.gcs_endpoint})
+        uploader = GCSUploader(client, 'logs', prefix='1234')
+        with FileList() as file_list:
+            file_list.add(os.path.join(FIXTURE_DIR, 'logs/'))
+            self.assertEqual([], uploader.upload(list(file_list)))
+        self.assertIn('1234/job-output.json', server.objects('logs'))
+        self.assertEqual([{'method': ['GET', 'HEAD'], 'origin': ['*']}],
+                         server.containers['logs'].metadata['cors'])
+        blob = client.bucket('logs').blob('1234/zuul-info/inventory.yaml')
+        with open(os.path.join(FIXTURE_DIR,
+                               'logs/zuul-info/inventory.yaml'), 'rb') as f:
+            self.assertEqual(f.read(), blob.download_as_bytes())
+
+
+class TestInjection(testtools.TestCase):
+
+    def test_errors(self):
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        server.create_container('logs')
+        url = server.swift_endpoint + '/logs/'
+        server.inject_error(503, count=2, path='/b', retry_after=3)
+        self.assertEqual(201, requests.put(url + 'a').status_code)
+        r = requests.put(url + 'b')
+        self.assertEqual(503, r.status_code)
+        self.assertEqual('3', r.headers['retry-after'])
+        self.assertEqual(503, requests.put(url + 'b').status_code)
+        self.assertEqual(201, requests.put(url + 'b').status_code)
+
+        server.error_rate = 0.5
+        statuses = [requests.put(url + 'c').status_code for x in range(40)]
+        self.assertIn(503, statuses)
+        self.assertIn(201, statuses)
+
+    def test_throttling(self):
+        server = self.useFixture(FakeObjectStoreFixture(
+            latency=0.2, max_requests=2, retry_after=1)).server
+        server.create_container('logs')
+        statuses = []
+
+        def put(name):
+            r = requests.put(server.swift_endpoint + '/logs/' + name)
+            statuses.append(r.status_code)
+        threads = [threading.Thread(target=put, args=(str(i),))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4, server.peak_active)
+        self.assertEqual([201, 201, 429, 429], sorted(statuses))
+
+    def test_bandwidth(self):
+        server = self.useFixture(FakeObjectStoreFixture(
+            bandwidth=1024 * 1024)).server
+        server.create_container('logs')
+        start = time.time()
+        requests.put(server.swift_endpoint + '/logs/a',
+                     data=b'x' * 256 * 1024)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(256 * 1024, server.bytes_received)
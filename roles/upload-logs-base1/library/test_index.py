@@ -18,6 +18,7 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import json
 import os
 import six
 import testtools
@@ -31,9 +32,14 @@ except ImportError:
 
 import requests
 from bs4 import BeautifulSoup
-from .zuul_swift_upload import Uploader
-from ..module_utils.zuul_jobs.upload_utils import FileList, Indexer, FileDetail
+from ..module_utils.zuul_jobs.upload_utils import (
+    FileList,
+    Indexer,
+    FileDetail,
+    iter_upload_files,
+)
 from .filefixture import FileFixture
+from .test_zuul_swift_upload import MockUploader
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
                            'test-fixtures')
@@ -78,7 +84,7 @@ class TestFileList(testtools.TestCase):
             if received.folder:
                 if received.full_path is not None and expected[0] != '':
                     self.assertTrue(os.path.isdir(received.full_path))
-            else:
+            elif received.content is None:
                 self.assertTrue(os.path.isfile(received.full_path))
             self.assertEqual(expected[1], received.mimetype)
             self.assertEqual(expected[2], received.encoding)
@@ -113,6 +119,20 @@ class TestFileList(testtools.TestCase):
                     ('zuul-info/zuul-info.controller.txt', 'text/plain', None),
                 ])
 
+    def test_parallel_scan(self):
+        '''Test a parallel scan lists files in the sequential order'''
+        with FileFixture() as file_fixture:
+            for path in ('logs', 'logs/'):
+                path = os.path.join(file_fixture.root, path)
+                with FileList() as fl:
+                    fl.add(path)
+                    expected = [(f.relative_path, f.folder) for f in fl]
+                with FileList() as fl:
+                    fl.add(path, scan_workers=4)
+                    self.assertEqual(expected,
+                                     [(f.relative_path, f.folder)
+                                      for f in fl])
+
     def test_single_dir(self):
         '''Test a single directory without a trailing slash'''
         with FileList() as fl:
@@ -204,7 +224,7 @@ class TestFileList(testtools.TestCase):
             ])
 
             top_index = self.find_file(fl, 'index.html')
-            page = open(top_index.full_path).read()
+            page = top_index.open().read().decode('utf-8')
             page = BeautifulSoup(page, 'html.parser')
             rows = page.find_all('tr')[1:]
 
@@ -215,7 +235,7 @@ class TestFileList(testtools.TestCase):
 
             subdir_index = self.find_file(
                 fl, 'logs/controller/subdir/index.html')
-            page = open(subdir_index.full_path).read()
+            page = subdir_index.open().read().decode('utf-8')
             page = BeautifulSoup(page, 'html.parser')
             rows = page.find_all('tr')[1:]
             self.assertEqual(rows[0].find('a').get('href'), '../index.html')
@@ -260,7 +280,7 @@ class TestFileList(testtools.TestCase):
                 ])
 
             top_index = self.find_file(fl, 'index.html')
-            page = open(top_index.full_path).read()
+            page = top_index.open().read().decode('utf-8')
             page = BeautifulSoup(page, 'html.parser')
             rows = page.find_all('tr')[1:]
 
@@ -275,7 +295,7 @@ class TestFileList(testtools.TestCase):
             self.assertEqual(rows[1].find('a').text, 'zuul-info/')
 
             subdir_index = self.find_file(fl, 'controller/subdir/index.html')
-            page = open(subdir_index.full_path).read()
+            page = subdir_index.open().read().decode('utf-8')
             page = BeautifulSoup(page, 'html.parser')
             rows = page.find_all('tr')[1:]
             self.assertEqual(rows[0].find('a').get('href'), '../index.html')
@@ -288,6 +308,205 @@ class TestFileList(testtools.TestCase):
             self.assertEqual(rows[2].find('a').get('href'), 'subdir.txt')
             self.assertEqual(rows[2].find('a').text, 'subdir.txt')
 
+    def test_iter_upload_files(self):
+        '''Test a pipelined scan yields the files and indexes in time'''
+        with FileFixture() as file_fixture:
+            path = os.path.join(file_fixture.root, 'logs')
+
+            def contents(files):
+                return sorted(
+                    (f.relative_path,
+                     f.open().read().decode('utf-8')
+                     if f.filename == 'index.html' else None)
+                    for f in files)
+
+            with FileList() as fl:
+                fl.add(path)
+                Indexer(fl).make_indexes()
+                expected = contents(fl)
+
+            with FileList() as fl:
+                files = list(iter_upload_files(fl, [path]))
+                self.assertEqual(expected, contents(files))
+
+            # The index of a folder comes as soon as the folder is
+            # listed, before the files of its subfolders.
+            paths = [f.relative_path for f in files]
+            self.assertLess(paths.index('logs/controller/index.html'),
+                            paths.index('logs/controller/subdir/foo::3.txt'))
+            self.assertEqual('index.html', paths[-1])
+
+    def test_index_icons(self):
+        '''Test index pages embed each icon they use once'''
+        with FileFixture() as file_fixture:
+            with FileList() as fl:
+                fl.add(os.path.join(file_fixture.root, 'logs'))
+                Indexer(fl).make_indexes()
+
+                index = self.find_file(fl, 'logs/controller/index.html')
+                page = index.open().read().decode('utf-8')
+                page = BeautifulSoup(page, 'html.parser')
+                style = page.find('style').text
+                rows = page.find_all('tr')[1:]
+
+                self.assertEqual([], page.find_all('img'))
+                classes = set(r.find('td').get('class')[1] for r in rows)
+                self.assertEqual(
+                    set(['icon-back', 'icon-folder', 'icon-text',
+                         'icon-unknown']), classes)
+                for c in classes:
+                    self.assertEqual(1, style.count('td.%s {' % c))
+                self.assertEqual(len(classes), style.count('data:image'))
+                self.assertEqual('text/plain',
+                                 rows[2].find('td').get('title'))
+
+    def test_index_footer(self):
+        '''Test the footer file is appended to the index'''
+        with FileFixture() as file_fixture:
+            path = os.path.join(file_fixture.root, 'logs')
+            with open(os.path.join(path, 'index_footer.html'), 'w') as f:
+                f.write('<p>Footer</p>')
+            with FileList() as fl:
+                fl.add(path)
+                Indexer(fl).make_indexes()
+
+                index = self.find_file(fl, 'logs/index.html')
+                page = index.open().read().decode('utf-8')
+                self.assertIn('<hr /><p>Footer</p></body>', page)
+
+    def test_index_pages(self):
+        '''Test big folders get several index pages'''
+        with FileFixture() as file_fixture:
+            with FileList() as fl:
+                fl.add(os.path.join(file_fixture.root, 'logs'))
+                Indexer(fl, page_size=3).make_indexes()
+
+                pages = [f.relative_path for f in fl
+                         if f.relative_path.startswith('logs/controller/index')]
+                self.assertEqual(['logs/controller/index.html',
+                                  'logs/controller/index-2.html',
+                                  'logs/controller/index-3.html'], pages)
+
+                names = []
+                for path in pages:
+                    page = self.find_file(fl, path).open().read()
+                    page = BeautifulSoup(page.decode('utf-8'), 'html.parser')
+                    rows = page.find_all('tr')[1:]
+                    self.assertLessEqual(len(rows), 3)
+                    names.extend(r.find('a').text for r in rows)
+                self.assertEqual(['../', 'subdir/', 'compressed.gz',
+                                  'cpu-load.svg', 'journal.xz',
+                                  'service_log.txt', 'syslog'], names)
+
+                page = self.find_file(fl, 'logs/controller/index-2.html')
+                page = page.open().read().decode('utf-8')
+                links = BeautifulSoup(page, 'html.parser').find(
+                    'p', class_='pages').find_all('a')
+                self.assertEqual(
+                    [('first', 'index.html'), ('previous', 'index.html'),
+                     ('next', 'index-3.html'), ('last', 'index-3.html')],
+                    [(a.text, a.get('href')) for a in links])
+
+                # Folders with few files keep a single page
+                self.assertIsNone(
+                    self.find_file(fl, 'logs/zuul-info/index-2.html'))
+
+    def test_manifest(self):
+        '''Test the manifest describes the whole file list'''
+        with FileFixture() as file_fixture:
+            with FileList() as fl:
+                fl.add(os.path.join(file_fixture.root, 'logs'))
+                manifest = Indexer(fl).make_manifest(index_links=False)
+
+                self.assertEqual('zuul-manifest.json', manifest.relative_path)
+                self.assertEqual('application/json', manifest.mimetype)
+                manifest = json.loads(manifest.open().read().decode('utf-8'))
+                self.assertFalse(manifest['index_links'])
+                logs, = manifest['tree']
+                self.assertEqual('logs', logs['name'])
+                self.assertEqual('application/directory', logs['mimetype'])
+                self.assertEqual(
+                    ['controller', 'zuul-info', 'job-output.json',
+                     u'\u13c3\u0e9a\u0e9a\u03be-unicode.txt'],
+                    [e['name'] for e in logs['children']])
+                job_output = logs['children'][2]
+                path = os.path.join(file_fixture.root,
+                                    'logs/job-output.json')
+                self.assertEqual({
+                    'name': 'job-output.json',
+                    'mimetype': 'application/json',
+                    'encoding': None,
+                    'last_modified': int(os.stat(path).st_mtime),
+                    'size': 16,
+                }, job_output)
+                controller = logs['children'][0]
+                self.assertNotIn('size', controller)
+                self.assertEqual(
+                    ['subdir', 'compressed.gz', 'cpu-load.svg',
+                     'journal.xz', 'service_log.txt', 'syslog'],
+                    [e['name'] for e in controller['children']])
+                self.assertEqual(
+                    ['foo::3.txt', 'subdir.txt'],
+                    [e['name'] for e in
+                     controller['children'][0]['children']])
+
+    def test_iter_upload_files_manifest(self):
+        '''Test a pipelined upload ends with the manifest'''
+        with FileFixture() as file_fixture:
+            path = os.path.join(file_fixture.root, 'logs')
+            with FileList() as fl:
+                files = list(iter_upload_files(fl, [path], manifest=True))
+
+                self.assertEqual('zuul-manifest.json',
+                                 files[-1].relative_path)
+                manifest = json.loads(
+                    files[-1].open().read().decode('utf-8'))
+                self.assertTrue(manifest['index_links'])
+                self.assertEqual(
+                    ['index.html', 'logs'],
+                    sorted(e['name'] for e in manifest['tree']))
+
+    def test_index_files_in_memory(self):
+        '''Test index pages are kept in memory'''
+        with FileFixture() as file_fixture:
+            with FileList() as fl:
+                fl.add(os.path.join(file_fixture.root, 'logs'))
+                Indexer(fl).make_indexes()
+                indexes = [f for f in fl if f.filename == 'index.html']
+
+                self.assertEqual([], fl.tempdirs)
+                self.assertEqual(5, len(indexes))
+                for f in indexes:
+                    self.assertIsNone(f.full_path)
+                    self.assertIsInstance(f.content, bytes)
+                    self.assertEqual(len(f.content), f.size)
+                    self.assertEqual('text/html', f.mimetype)
+
+    def test_index_files_spill(self):
+        '''Test index pages past the memory limit go to one spill file'''
+        with FileFixture() as file_fixture:
+            path = os.path.join(file_fixture.root, 'logs')
+            with FileList() as fl:
+                fl.add(path)
+                Indexer(fl).make_indexes()
+                expected = sorted(
+                    (f.relative_path, f.open().read())
+                    for f in fl if f.filename == 'index.html')
+
+            with FileList() as fl:
+                fl.add(path)
+                indexer = Indexer(fl)
+                indexer.max_memory = 0
+                indexer.make_indexes()
+                indexes = [f for f in fl if f.filename == 'index.html']
+
+                self.assertEqual(1, len(fl.tempdirs))
+                self.assertEqual(['indexes'], os.listdir(fl.tempdirs[0]))
+                self.assertEqual(expected, sorted(
+                    (f.relative_path, f.open().read()) for f in indexes))
+                for f in indexes:
+                    self.assertEqual(len(bytes(f.content)), f.size)
+
     def test_topdir_parent_link(self):
         '''Test index generation creates topdir parent link'''
         with FileList() as fl:
@@ -322,7 +541,7 @@ class TestFileList(testtools.TestCase):
                 ])
 
                 top_index = self.find_file(fl, 'index.html')
-                page = open(top_index.full_path).read()
+                page = top_index.open().read().decode('utf-8')
                 page = BeautifulSoup(page, 'html.parser')
                 rows = page.find_all('tr')[1:]
 
@@ -343,7 +562,7 @@ class TestFileList(testtools.TestCase):
                 subdir_index = self.find_file(
                     fl, 'controller/subdir/index.html'
                 )
-                page = open(subdir_index.full_path).read()
+                page = subdir_index.open().read().decode('utf-8')
                 page = BeautifulSoup(page, 'html.parser')
                 rows = page.find_all('tr')[1:]
                 self.assertEqual(
@@ -394,7 +613,7 @@ class TestFileList(testtools.TestCase):
                 ])
 
                 top_index = self.find_file(fl, 'index.html')
-                page = open(top_index.full_path).read()
+                page = top_index.open().read().decode('utf-8')
                 page = BeautifulSoup(page, 'html.parser')
                 rows = page.find_all('tr')[1:]
 
@@ -413,7 +632,7 @@ class TestFileList(testtools.TestCase):
                 subdir_index = self.find_file(
                     fl, 'controller/subdir/index.html'
                 )
-                page = open(subdir_index.full_path).read()
+                page = subdir_index.open().read().decode('utf-8')
                 page = BeautifulSoup(page, 'html.parser')
                 rows = page.find_all('tr')[1:]
 
@@ -448,17 +667,30 @@ class TestFileDetail(testtools.TestCase):
         self.assertEqual(time.gmtime(0), file_detail.last_modified)
         self.assertEqual(0, file_detail.size)
 
+    def test_get_file_detail_lazy_mimetype(self):
+        '''Test the mime type is only guessed when used'''
+        with FileFixture() as file_fixture:
+            path = os.path.join(file_fixture.root, 'logs/job-output.json')
+            with mock.patch('mimetypes.guess_type',
+                            return_value=('application/json', None)) as guess:
+                file_detail = FileDetail(path, '', stat_result=os.stat(path))
+                self.assertEqual(0, guess.call_count)
+                self.assertEqual('application/json', file_detail.mimetype)
+                self.assertIsNone(file_detail.encoding)
+                self.assertEqual(1, guess.call_count)
+            self.assertEqual(16, file_detail.size)
 
-class MockUploader(Uploader):
-    """An uploader that uses a mocked cloud object"""
-    def __init__(self, container):
-        self.container = container
-        self.cloud = mock.Mock()
-        self.dry_run = False
-        self.public = True
-        self.delete_after = None
-        self.prefix = ""
-        self.url = 'http://dry-run-url.com/a/path/'
+    def test_get_file_detail_from_content(self):
+        '''Test files held in memory'''
+        file_detail = FileDetail.from_content('logs/index.html', b'<html>')
+
+        self.assertIsNone(file_detail.full_path)
+        self.assertEqual('index.html', file_detail.filename)
+        self.assertFalse(file_detail.folder)
+        self.assertEqual(6, file_detail.size)
+        self.assertEqual('text/html', file_detail.mimetype)
+        with file_detail.open() as f:
+            self.assertEqual(b'<html>', f.read())
 
 
 class TestUpload(testtools.TestCase):
@@ -0,0 +1,1052 @@
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import asyncio
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+
+import fixtures
+import testtools
+from testtools.content import text_content
+
+from ..module_utils.zuul_jobs import upload_utils
+from ..module_utils.zuul_jobs.upload_utils import (
+    AUTH_RETRY_STATUSES,
+    CompressionPolicy,
+    CompressorStream,
+    ConcurrencyController,
+    DedupIndex,
+    FileDetail,
+    GZIPCompressedStream,
+    LineIndexedGZIPCompressedStream,
+    PROFILE_NAME,
+    ParallelGZIPCompressedStream,
+    RetryPolicy,
+    UploadEngine,
+    UploadJournal,
+    UploadMetrics,
+    UPLOAD_OPTIONS,
+    UploadProfiler,
+    ZeroCopyGZIPCompressedStream,
+    add_upload_arguments,
+    get_content_encoder,
+    open_gzip_stream,
+    retry_function,
+    run_upload,
+    split_file_list,
+    upload_argument_spec,
+    upload_options,
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
+                           'test-fixtures')
+
+
+class FakeItem():
+    def __init__(self, filename, size=0, folder=False):
+        self.filename = filename
+        self.size = size
+        self.folder = folder
+
+
+class FakeResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeHTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super(FakeHTTPError, self).__init__("HTTP %s" % status_code)
+        self.response = FakeResponse(status_code, headers)
+
+
+class TestRetryPolicy(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRetryPolicy, self).setUp()
+        self.sleep = self.useFixture(
+            fixtures.MockPatchObject(upload_utils.time, 'sleep')).mock
+
+    def test_is_retryable(self):
+        '''Test permanent errors are told from transient ones'''
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable(FakeHTTPError(503)))
+        self.assertTrue(policy.is_retryable(FakeHTTPError(429)))
+        self.assertFalse(policy.is_retryable(FakeHTTPError(404)))
+        self.assertFalse(policy.is_retryable(FakeHTTPError(401)))
+        self.assertTrue(policy.is_retryable(IOError("Connection reset")))
+        self.assertFalse(policy.is_retryable(
+            IOError(2, "No such file or directory", "missing.txt")))
+        self.assertFalse(policy.is_retryable(ValueError("Bad argument")))
+        # boto reports the status in a response dict
+        error = Exception()
+        error.response = {'ResponseMetadata': {'HTTPStatusCode': 403}}
+        self.assertFalse(policy.is_retryable(error))
+        # google in a code attribute
+        error = Exception()
+        error.code = 500
+        self.assertTrue(policy.is_retryable(error))
+
+    def test_retry_statuses(self):
+        '''Test a policy can retry other statuses'''
+        policy = RetryPolicy(retry_statuses=AUTH_RETRY_STATUSES)
+        self.assertTrue(policy.is_retryable(FakeHTTPError(401)))
+        self.assertTrue(policy.is_retryable(FakeHTTPError(503)))
+        self.assertFalse(policy.is_retryable(FakeHTTPError(403)))
+
+    def test_retry_delay(self):
+        '''Test the backoff grows, is capped and honors Retry-After'''
+        policy = RetryPolicy(attempts=10, base_delay=2, max_delay=10,
+                             budget=1000)
+        error = IOError("Connection reset")
+        for attempt, bound in ((1, 2), (2, 4), (3, 8), (4, 10), (9, 10)):
+            for x in range(20):
+                delay = policy.retry_delay(attempt, error)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, bound)
+        self.assertIsNone(policy.retry_delay(10, error))
+        self.assertIsNone(policy.retry_delay(1, FakeHTTPError(404)))
+
+        delay = policy.retry_delay(
+            1, FakeHTTPError(503, {'Retry-After': '30'}))
+        self.assertEqual(30, delay)
+        delay = policy.retry_delay(
+            1, FakeHTTPError(503, {'retry-after': 'Mon, 01 Jan 2001 '
+                                                  '00:00:00 GMT'}))
+        self.assertLessEqual(delay, 2)
+
+    def test_budget(self):
+        '''Test retries stop when the budget is spent'''
+        policy = RetryPolicy(attempts=10, budget=2, budget_ratio=0.5)
+        error = IOError("Connection reset")
+        self.assertIsNotNone(policy.retry_delay(1, error))
+        self.assertIsNotNone(policy.retry_delay(1, error))
+        self.assertIsNone(policy.retry_delay(1, error))
+        # Two successful attempts earn a retry
+        policy.succeeded()
+        self.assertIsNone(policy.retry_delay(1, error))
+        policy.succeeded()
+        self.assertIsNotNone(policy.retry_delay(1, error))
+
+    def test_retry_function(self):
+        '''Test only transient errors are retried'''
+        calls = []
+
+        def post(error):
+            calls.append(error)
+            if len(calls) < 3:
+                raise error
+            return 'done'
+
+        policy = RetryPolicy(attempts=3)
+        self.assertEqual(
+            'done', retry_function(lambda: post(FakeHTTPError(503)), policy))
+        self.assertEqual(3, len(calls))
+        self.assertEqual(2, self.sleep.call_count)
+
+        del calls[:]
+        self.assertRaises(FakeHTTPError, retry_function,
+                          lambda: post(FakeHTTPError(404)), policy)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, self.sleep.call_count)
+
+
+class TestConcurrencyController(testtools.TestCase):
+
+    def test_increase(self):
+        '''Test the limit grows by one per window of healthy uploads'''
+        controller = ConcurrencyController(2, 4)
+        now = time.time()
+        for x in range(2):
+            controller.observe(now, 0.1)
+        self.assertEqual(3, controller.limit)
+        # Slow uploads hold the limit
+        for x in range(10):
+            controller.observe(now, 10)
+        self.assertEqual(3, controller.limit)
+        # Big files may take longer
+        for x in range(3):
+            controller.observe(now, 10, 100 * upload_utils.LATENCY_SIZE_UNIT)
+        self.assertEqual(4, controller.limit)
+        for x in range(10):
+            controller.observe(now, 0.1)
+        self.assertEqual(4, controller.limit)
+        self.assertEqual(
+            [(3, 'healthy'), (4, 'healthy')],
+            [(d['limit'], d['reason']) for d in controller.decisions])
+
+    def test_decrease(self):
+        '''Test throttling and timeouts cut the limit'''
+        controller = ConcurrencyController(16, 16)
+        before = time.time() - 1
+        controller.observe(time.time(), 1, error=FakeHTTPError(503))
+        self.assertEqual(8, controller.limit)
+        # Sent at the old limit
+        controller.observe(before, 1, error=FakeHTTPError(429))
+        self.assertEqual(8, controller.limit)
+        # Not a sign of overload
+        controller.observe(time.time(), 1, error=FakeHTTPError(404))
+        controller.observe(time.time(), 1, error=IOError("Broken pipe"))
+        self.assertEqual(8, controller.limit)
+        time.sleep(0.01)
+        controller.observe(time.time(), 1,
+                           error=upload_utils.UploadTimeout("Timed out"))
+        self.assertEqual(4, controller.limit)
+        for x in range(5):
+            time.sleep(0.01)
+            controller.observe(time.time(), 1, error=FakeHTTPError(429))
+        self.assertEqual(1, controller.limit)
+        summary = controller.summary()
+        self.assertEqual(7, summary['decreases'])
+        self.assertEqual(
+            [(8, 'throttled (HTTP 503)'), (4, 'timeout'),
+             (2, 'throttled (HTTP 429)'), (1, 'throttled (HTTP 429)')],
+            [(d['limit'], d['reason']) for d in summary['decisions']])
+
+    def test_engine(self):
+        '''Test the engine runs no more tasks than the limit'''
+        self.useFixture(
+            fixtures.MockPatchObject(upload_utils, 'POST_ATTEMPTS', 1))
+        lock = threading.Lock()
+        state = {'inflight': 0, 'peak': 0}
+
+        def post(item):
+            with lock:
+                state['inflight'] += 1
+                state['peak'] = max(state['peak'], state['inflight'])
+            time.sleep(0.01)
+            with lock:
+                state['inflight'] -= 1
+            raise FakeHTTPError(503)
+
+        controller = ConcurrencyController(2, 8)
+        engine = UploadEngine(controller=controller)
+        self.assertEqual(8, engine.concurrency)
+        items = [FakeItem(str(x)) for x in range(20)]
+        self.assertEqual(20, len(engine.run(post, items)))
+        self.assertEqual(1, controller.limit)
+        self.assertLessEqual(state['peak'], 2)
+
+    def test_engine_async(self):
+        '''Test the asyncio engine grows up to the maximum'''
+        state = {'inflight': 0, 'peak': 0}
+
+        async def post(item):
+            state['inflight'] += 1
+            state['peak'] = max(state['peak'], state['inflight'])
+            await asyncio.sleep(0.01)
+            state['inflight'] -= 1
+
+        controller = ConcurrencyController(1, 4)
+        engine = UploadEngine(controller=controller)
+        items = [FakeItem(str(x)) for x in range(40)]
+        self.assertEqual([], asyncio.run(engine.run_async(post, items)))
+        self.assertEqual(4, controller.limit)
+        self.assertEqual(4, state['peak'])
+
+
+class TestUploadMetrics(testtools.TestCase):
+
+    def test_report(self):
+        '''Test latencies are summarized and the slowest listed'''
+        metrics = UploadMetrics(slowest=3)
+        metrics.add_phase('scan', 1.5)
+        metrics.add_phase('upload', 4)
+        for x in range(100):
+            metrics.object_done(FakeItem(str(x), 10), (x + 1) / 100.0)
+        metrics.object_done(FakeItem('bad', 10), 60, failed=True)
+        metrics.compressed(2, 1000, 100)
+
+        report = metrics.report(retries=5)
+        self.assertEqual(100, report['objects'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(1000, report['bytes'])
+        self.assertEqual(25, report['objects_per_second'])
+        self.assertEqual({'p50': 0.5, 'p95': 0.95, 'p99': 0.99, 'max': 1},
+                         report['latency'])
+        self.assertEqual(
+            {'scan': 1.5, 'upload': 4, 'compression': 2, 'network': 48.5},
+            report['time'])
+        self.assertEqual({'bytes_in': 1000, 'bytes_out': 100},
+                         report['compression'])
+        self.assertEqual(5, report['retries'])
+        self.assertEqual(
+            [('99', 1), ('98', 0.99), ('97', 0.98)],
+            [(x['name'], x['seconds']) for x in report['slowest']])
+
+    def test_meter(self):
+        '''Test reading a compressed stream is accounted for'''
+        metrics = UploadMetrics()
+        data = b'a log line\n' * 1000
+        stream = metrics.meter(
+            LineIndexedGZIPCompressedStream(io.BytesIO(data)), len(data))
+        out = stream.read()
+        self.assertEqual(b'', stream.read())
+        self.assertEqual(data, gzip.decompress(out))
+        self.assertEqual(1000, stream.line_index()['lines'])
+        report = metrics.report()
+        self.assertEqual({'bytes_in': len(data), 'bytes_out': len(out)},
+                         report['compression'])
+        self.assertNotIn('latency', report)
+
+    def test_engine(self):
+        '''Test the engine records every item'''
+        self.useFixture(
+            fixtures.MockPatchObject(upload_utils, 'POST_ATTEMPTS', 1))
+
+        def post(item):
+            if item.filename == 'bad':
+                raise IOError("Failed for a reason")
+
+        metrics = UploadMetrics()
+        engine = UploadEngine(concurrency=2, metrics=metrics)
+        engine.run(post, [FakeItem('a', 1), FakeItem('bad', 2),
+                          FakeItem('b', 4)])
+        report = metrics.report()
+        self.assertEqual(2, report['objects'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(5, report['bytes'])
+        # The phases are timed by run_upload
+        self.assertNotIn('upload', report['time'])
+
+
+def profiled_post(item):
+    time.sleep(0.05)
+    return sum(x * x for x in range(10000))
+
+
+class CountingProfiler(UploadProfiler):
+    """A profiler counting the calls of its thread hook"""
+
+    hook_calls = 0
+
+    def _start_thread(self, frame, event, arg):
+        self.hook_calls += 1
+        super(CountingProfiler, self)._start_thread(frame, event, arg)
+
+
+class TestUploadProfiler(testtools.TestCase):
+
+    def _profile(self, mode):
+        profiler = UploadProfiler(mode, interval=0.001)
+        profiler.start()
+        UploadEngine(concurrency=2).run(
+            profiled_post, [FakeItem('a'), FakeItem('b')])
+        profiler.stop()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        return profiler.save(tempdir)
+
+    def test_cprofile(self):
+        '''Test the worker threads are profiled'''
+        profile = self._profile('cprofile')
+        self.assertEqual('zuul-upload-profile.prof', profile.relative_path)
+        stats = pstats.Stats(profile.full_path).stats
+        calls = [stat[0] for (filename, line, name), stat in stats.items()
+                 if name == 'profiled_post']
+        self.assertEqual([2], calls)
+
+    def _count_hook_calls(self):
+        profiler = CountingProfiler('cprofile')
+        profiler.start()
+        UploadEngine(concurrency=2).run(
+            profiled_post, [FakeItem('a'), FakeItem('b')])
+        profiler.stop()
+        return profiler.hook_calls
+
+    def test_cprofile_hook(self):
+        '''Test the thread hook runs at most once per worker'''
+        self.assertLessEqual(self._count_hook_calls(), 2)
+
+    def test_cprofile_hook_enable_fails(self):
+        '''Test the thread hook is removed when profiling is refused'''
+        def enable(profile):
+            raise ValueError("Another profiling tool is already active")
+        self.useFixture(fixtures.MockPatchObject(
+            upload_utils.cProfile.Profile, 'enable', enable))
+        self.assertLessEqual(self._count_hook_calls(), 2)
+
+    def test_sample(self):
+        '''Test the stacks are sampled by thread'''
+        profile = self._profile('sample')
+        self.assertEqual('zuul-upload-profile.txt', profile.relative_path)
+        with open(profile.full_path) as f:
+            stacks = [line.rsplit(' ', 1) for line in f]
+        workers = [stack for stack, count in stacks
+                   if 'test_upload_utils.py:profiled_post' in stack]
+        self.assertTrue(workers)
+        for stack in workers:
+            self.assertFalse(stack.startswith('MainThread;'))
+            self.assertIn('upload_utils.py:_worker;', stack)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, UploadProfiler, 'perf')
+
+
+class TestUploadEngine(testtools.TestCase):
+
+    def setUp(self):
+        super(TestUploadEngine, self).setUp()
+        # Do not retry (and sleep) on failures
+        self.useFixture(
+            fixtures.MockPatchObject(upload_utils, 'POST_ATTEMPTS', 1))
+
+    def test_failures(self):
+        '''Test failed tasks are reported and others still run'''
+        done = []
+
+        def post(item):
+            if item.filename == 'bad':
+                raise IOError("Failed for a reason")
+            done.append(item.filename)
+
+        items = [FakeItem('a'), FakeItem('bad'), FakeItem('b')]
+        failures = UploadEngine(concurrency=2).run(post, items)
+        self.assertEqual(
+            [{'file': 'bad', 'error': 'Failed for a reason'}], failures)
+        self.assertEqual(['a', 'b'], sorted(done))
+
+    def test_concurrency(self):
+        '''Test the number of parallel tasks is capped'''
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def post(item):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        items = [FakeItem(str(x)) for x in range(20)]
+        failures = UploadEngine(concurrency=3).run(post, items)
+        self.assertEqual([], failures)
+        self.assertEqual(3, state['peak'])
+
+    def test_generator(self):
+        '''Test items are pulled from a generator as workers need them'''
+        lock = threading.Lock()
+        state = {'produced': 0, 'posted': 0, 'ahead': 0}
+
+        def produce():
+            for x in range(30):
+                with lock:
+                    state['produced'] += 1
+                    state['ahead'] = max(
+                        state['ahead'], state['produced'] - state['posted'])
+                yield FakeItem(str(x))
+
+        def post(item):
+            time.sleep(0.01)
+            with lock:
+                state['posted'] += 1
+
+        engine = UploadEngine(concurrency=2)
+        self.assertEqual([], engine.run(post, produce()))
+        self.assertEqual(30, state['posted'])
+        # Queued items, the ones being posted and the one being put
+        self.assertLessEqual(state['ahead'], engine.queue_size + 2 + 1)
+
+    def test_max_inflight_bytes(self):
+        '''Test the size of the files in flight is capped'''
+        lock = threading.Lock()
+        state = {'inflight': 0, 'peak': 0}
+
+        def post(item):
+            with lock:
+                state['inflight'] += item.size
+                state['peak'] = max(state['peak'], state['inflight'])
+            time.sleep(0.01)
+            with lock:
+                state['inflight'] -= item.size
+
+        # The oversized item is still uploaded, on its own.
+        items = [FakeItem(str(x), 40) for x in range(10)]
+        items.append(FakeItem('big', 500))
+        engine = UploadEngine(concurrency=10, max_inflight_bytes=100)
+        self.assertEqual([], engine.run(post, items))
+        self.assertEqual(500, state['peak'])
+        state['peak'] = 0
+        items.pop()
+        self.assertEqual([], engine.run(post, items))
+        self.assertEqual(80, state['peak'])
+
+    def test_task_timeout(self):
+        '''Test slow tasks are reported and do not block the others'''
+        done = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def post(item):
+            if item.filename == 'slow':
+                release.wait(10)
+            done.append(item.filename)
+
+        engine = UploadEngine(concurrency=1, task_timeout=0.2)
+        engine.poll_interval = 0.05
+        items = [FakeItem('slow'), FakeItem('a'), FakeItem('b')]
+        failures = engine.run(post, items)
+        self.assertEqual(
+            [{'file': 'slow', 'error': 'Timed out after 0.2 seconds'}],
+            failures)
+        self.assertEqual(['a', 'b'], done)
+
+    def test_task_timeout_concurrency(self):
+        '''Test timed out tasks still count until they return'''
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def post(item):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.4 if item.filename == 'slow' else 0.05)
+            with lock:
+                state['running'] -= 1
+
+        engine = UploadEngine(concurrency=2, task_timeout=0.2)
+        engine.poll_interval = 0.05
+        items = [FakeItem('slow')] + [FakeItem(str(i)) for i in range(8)]
+        failures = engine.run(post, items)
+        self.assertEqual(['slow'], [f['file'] for f in failures])
+        self.assertEqual(2, state['peak'])
+
+
+class RecordingUploader():
+    """An uploader recording the files it is given"""
+    def __init__(self, engine, compression, journal):
+        self.engine = engine
+        self.compression = compression
+        self.journal = journal
+        self.uploaded = []
+
+    def upload(self, file_list):
+        def post(file_detail):
+            self.uploaded.append(file_detail.relative_path)
+        return self.engine.run(post, file_list)
+
+
+class FailingUploader(RecordingUploader):
+    """An uploader failing on everything but the profile"""
+    def upload(self, file_list):
+        file_list = list(file_list)
+        if file_list[0].relative_path.startswith(PROFILE_NAME):
+            return super(FailingUploader, self).upload(file_list)
+        raise IOError("Connection reset")
+
+
+class TestRunUpload(testtools.TestCase):
+
+    def _run(self, **options):
+        return run_upload([os.path.join(FIXTURE_DIR, 'logs/')],
+                          RecordingUploader, **options)
+
+    def test_run_upload(self):
+        '''Test the files and their indexes are uploaded'''
+        uploader, failures, levels, control, report = self._run(
+            concurrency=2, max_concurrency=4, manifest=True, metrics=True)
+        self.assertEqual([], failures)
+        self.assertIsNone(uploader.journal)
+        self.assertEqual(2, control['initial'])
+        self.assertEqual(4, control['maximum'])
+        self.assertIn('job-output.json', uploader.uploaded)
+        self.assertIn('index.html', uploader.uploaded)
+        self.assertIn('zuul-info/index.html', uploader.uploaded)
+        self.assertIn('zuul-manifest.json', uploader.uploaded)
+        self.assertEqual(len(uploader.uploaded), report['objects'])
+        self.assertIn('scan', report['time'])
+
+        # The pipelined scan uploads the same files
+        pipelined, failures, levels, control, report = self._run(
+            pipeline=True, manifest=True)
+        self.assertEqual([], failures)
+        self.assertIsNone(control)
+        self.assertIsNone(report)
+        self.assertEqual(sorted(uploader.uploaded),
+                         sorted(pipelined.uploaded))
+
+    def test_profile(self):
+        '''Test the profile is uploaded next to the files'''
+        uploader, failures, levels, control, report = self._run(
+            profile='sample')
+        self.assertEqual([], failures)
+        self.assertEqual(PROFILE_NAME + '.txt', uploader.uploaded[-1])
+
+    def test_metrics(self):
+        '''Test the metrics only describe the upload of the files'''
+        uploader, failures, levels, control, report = self._run(
+            metrics=True, profile='sample')
+        self.assertEqual(PROFILE_NAME + '.txt', uploader.uploaded[-1])
+        self.assertEqual(len(uploader.uploaded) - 1, report['objects'])
+        self.assertNotIn(PROFILE_NAME + '.txt',
+                         [x['name'] for x in report['slowest']])
+        self.assertEqual(['scan', 'index', 'upload', 'compression',
+                          'network'], list(report['time']))
+        self.assertIsNotNone(report['objects_per_second'])
+
+    def test_profile_failed_upload(self):
+        '''Test the profile of a failed upload is uploaded'''
+        uploaders = []
+
+        def make_uploader(engine, compression, journal):
+            uploaders.append(FailingUploader(engine, compression, journal))
+            return uploaders[-1]
+
+        self.assertRaises(IOError, run_upload,
+                          [os.path.join(FIXTURE_DIR, 'logs/')],
+                          make_uploader, profile='cprofile')
+        self.assertEqual([PROFILE_NAME + '.prof'], uploaders[0].uploaded)
+        self.assertIsNone(sys.getprofile())
+        self.assertIsNone(threading.getprofile())
+
+        # Nothing to upload the profile with, but it is stopped
+        def fail(engine, compression, journal):
+            raise IOError("Container not found")
+
+        self.assertRaises(IOError, run_upload,
+                          [os.path.join(FIXTURE_DIR, 'logs/')],
+                          fail, profile='cprofile')
+        self.assertIsNone(sys.getprofile())
+        self.assertIsNone(threading.getprofile())
+
+    def test_options(self):
+        '''Test the module and command line options match run_upload'''
+        spec = upload_argument_spec()
+        self.assertEqual(set(UPLOAD_OPTIONS) | set(['content_encoding']),
+                         set(spec))
+        parser = argparse.ArgumentParser()
+        add_upload_arguments(parser)
+        args = parser.parse_args(['--pipeline', '--journal', 'journal',
+                                  '--content-encoding', 'zstd'])
+        options = upload_options(vars(args))
+        self.assertEqual(set(UPLOAD_OPTIONS), set(options))
+        self.assertTrue(options['pipeline'])
+        self.assertEqual('journal', options['journal'])
+        self.assertEqual('medium', options['compression_cpu_budget'])
+        # Only module parameters have metrics
+        self.assertIsNone(options['metrics'])
+        self.assertEqual('zstd', args.content_encoding)
+
+
+class TestSplitFileList(testtools.TestCase):
+
+    def test_split(self):
+        '''Test parts are balanced and keep the file order'''
+        items = [
+            FakeItem('dir', 4096, folder=True),
+            FakeItem('a', 10),
+            FakeItem('b', 70),
+            FakeItem('c', 20),
+            FakeItem('d', 40),
+            FakeItem('e', 30),
+        ]
+        parts = split_file_list(items, 2)
+        self.assertEqual(
+            [['b', 'c'], ['dir', 'a', 'd', 'e']],
+            [[f.filename for f in part] for part in parts])
+        self.assertEqual([90, 80],
+                         [sum(f.size for f in part if not f.folder)
+                          for part in parts])
+
+    def test_split_more_parts_than_files(self):
+        parts = split_file_list([FakeItem('a', 10)], 3)
+        self.assertEqual([1, 0, 0], [len(part) for part in parts])
+
+
+class TestParallelGZIPCompressedStream(testtools.TestCase):
+
+    def setUp(self):
+        super(TestParallelGZIPCompressedStream, self).setUp()
+        # Use small blocks so a few bytes span several of them
+        self.useFixture(fixtures.MockPatchObject(
+            ParallelGZIPCompressedStream, 'block_size', 1024))
+
+    def test_workers(self):
+        '''Test the blocks read ahead follow the workers of the pool'''
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        submitted = []
+        submit = executor.submit
+
+        def counting_submit(*args):
+            submitted.append(args)
+            return submit(*args)
+        executor.submit = counting_submit
+
+        data = b'a log line\n' * 10000
+        stream = ParallelGZIPCompressedStream(
+            io.BytesIO(data), executor=executor, workers=2)
+        # The gzip header, then the first block
+        out = stream.read(10) + stream.read(1)
+        self.assertEqual(3, len(submitted))
+        out += stream.read()
+        self.assertEqual(data, gzip.decompress(out))
+
+    def _compress(self, data):
+        stream = ParallelGZIPCompressedStream(io.BytesIO(data))
+        out = b''
+        while True:
+            chunk = stream.read(700)
+            if not chunk:
+                break
+            out += chunk
+        self.assertEqual(len(out), stream.tell())
+        return out
+
+    def test_round_trip(self):
+        '''Test the output decompresses to the input'''
+        text = b''.join(b'line %d of the log\n' % i for i in range(2000))
+        for data in (b'', b'x', text, os.urandom(5000)):
+            out = self._compress(data)
+            self.assertEqual(data, gzip.decompress(out))
+
+    def test_single_member(self):
+        '''Test the blocks make up a single gzip member'''
+        data = b'abcdefgh' * 1000
+        out = self._compress(data)
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(data, d.decompress(out))
+        self.assertTrue(d.eof)
+        self.assertEqual(b'', d.unused_data)
+
+    def test_open_gzip_stream(self):
+        '''Test only big inputs are compressed in parallel'''
+        self.assertIsInstance(open_gzip_stream(io.BytesIO(b'')),
+                              ZeroCopyGZIPCompressedStream)
+        self.assertIsInstance(
+            open_gzip_stream(io.BytesIO(b''),
+                             upload_utils.PARALLEL_GZIP_MIN_SIZE),
+            ParallelGZIPCompressedStream)
+
+
+class TestLineIndexedGZIPCompressedStream(testtools.TestCase):
+
+    def setUp(self):
+        super(TestLineIndexedGZIPCompressedStream, self).setUp()
+        self.useFixture(fixtures.MockPatchObject(
+            LineIndexedGZIPCompressedStream, 'block_size', 1024))
+
+    def _compress(self, data):
+        stream = LineIndexedGZIPCompressedStream(io.BytesIO(data))
+        out = stream.read()
+        self.assertEqual(data, gzip.decompress(out))
+        return out, stream.line_index()
+
+    def test_chunks(self):
+        '''Test every chunk inflates on its own'''
+        lines = [b'line %d of the log\n' % i for i in range(2000)]
+        # Longer than a block
+        lines[1000] = b'x' * 3000 + b'\n'
+        data = b''.join(lines)
+        out, index = self._compress(data)
+
+        self.assertEqual(2000, index['lines'])
+        self.assertEqual(len(data), index['size'])
+        chunks = index['chunks']
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual((1, 0, 10), chunks[0])
+        ends = [(offset, coffset) for line, offset, coffset in chunks[1:]]
+        ends.append((len(data), len(out) - 8))
+        for (line, offset, coffset), (end, cend) in zip(chunks, ends):
+            chunk = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                out[coffset:cend])
+            self.assertEqual(data[offset:end], chunk)
+            self.assertEqual(lines[line - 1], chunk.split(b'\n')[0] + b'\n')
+
+    def test_no_trailing_newline(self):
+        '''Test a last line without newline'''
+        out, index = self._compress(b'first\nsecond')
+        self.assertEqual(1, index['lines'])
+        self.assertEqual([(1, 0, 10)], index['chunks'])
+        out, index = self._compress(b'')
+        self.assertEqual([], index['chunks'])
+
+
+class TestCompressionPolicy(testtools.TestCase):
+
+    def _file(self, name, data):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return FileDetail(path, name)
+
+    def test_incompressible(self):
+        '''Test files which barely compress are not compressed'''
+        policy = CompressionPolicy()
+        text = self._file('text.log', b'a log line\n' * 1000)
+        blob = self._file('blob.log', os.urandom(8192))
+        # Too small to tell
+        tiny = self._file('tiny.log', os.urandom(100))
+        self.assertEqual(9, policy.compression_level(text))
+        self.assertEqual(0, policy.compression_level(blob))
+        self.assertEqual(9, policy.compression_level(tiny))
+        self.assertEqual({'text.log': 9, 'blob.log': 0, 'tiny.log': 9},
+                         policy.levels)
+
+    def test_level_by_size(self):
+        '''Test big files are compressed faster'''
+        f = self._file('text.log', b'a log line\n' * 1000)
+        f.size = 100 * 1024 * 1024
+        self.assertEqual(6, CompressionPolicy().compression_level(f))
+        self.assertEqual(
+            1, CompressionPolicy(cpu_budget='low').compression_level(f))
+        self.assertEqual(
+            9, CompressionPolicy(cpu_budget='high').compression_level(f))
+        self.assertRaises(ValueError, CompressionPolicy, cpu_budget='max')
+
+    def test_line_index(self):
+        '''Test only big gzipped files get a line index'''
+        f = self._file('text.log', b'a log line\n' * 1000)
+        self.assertFalse(CompressionPolicy().line_index(f, 'gzip'))
+        policy = CompressionPolicy(line_index_min_size=10000)
+        self.assertTrue(policy.line_index(f, 'gzip'))
+        self.assertFalse(policy.line_index(f, 'br'))
+        f.size = 9999
+        self.assertFalse(policy.line_index(f, 'gzip'))
+
+
+class TestDedupIndex(testtools.TestCase):
+
+    def test_has(self):
+        '''Test blobs are only used while they outlive the links'''
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'dedup.json')
+        index = DedupIndex(path)
+        index.add('c/forever')
+        index.add('c/soon', 1000)
+        self.assertTrue(index.has('c/forever'))
+        self.assertTrue(index.has('c/forever', 2000))
+        self.assertTrue(index.has('c/soon', 1000))
+        self.assertFalse(index.has('c/soon', 2000))
+        self.assertFalse(index.has('c/soon'))
+        self.assertFalse(index.has('c/unknown'))
+
+    def test_save(self):
+        '''Test the saved index merges what other runs saved'''
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'cache', 'dedup.json')
+        later = time.time() + 1000
+        first = DedupIndex(path)
+        second = DedupIndex(path)
+        first.add('c/a', later)
+        # Expired entries are dropped
+        first.add('c/expired', time.time() - 1)
+        first.save()
+        second.add('c/b', later + 1)
+        second.add('c/a', later + 1)
+        second.save()
+
+        index = DedupIndex(path)
+        self.assertTrue(index.has('c/a', later + 1))
+        self.assertTrue(index.has('c/b', later + 1))
+        self.assertFalse(index.has('c/expired', 0))
+
+    @testtools.skipUnless(upload_utils.fcntl, 'fcntl is not available')
+    def test_save_locked(self):
+        '''Test a run saving waits for the one holding the lock'''
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'dedup.json')
+        first = DedupIndex(path)
+        first.add('c/a')
+        second = DedupIndex(path)
+        second.add('c/b')
+
+        with open(path + '.lock', 'a') as lock:
+            upload_utils.fcntl.flock(lock, upload_utils.fcntl.LOCK_EX)
+            saving = threading.Thread(target=second.save)
+            saving.start()
+            saving.join(0.2)
+            self.assertTrue(saving.is_alive())
+            # The run holding the lock saves meanwhile, without it
+            # merging what the other run saved
+            with open(path, 'w') as f:
+                json.dump(first._blobs, f)
+        saving.join()
+
+        index = DedupIndex(path)
+        self.assertTrue(index.has('c/a'))
+        self.assertTrue(index.has('c/b'))
+
+
+class TestUploadJournal(testtools.TestCase):
+
+    def test_resume(self):
+        '''Test the journal survives a run cut short'''
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tempdir, 'journal')
+        log = os.path.join(tempdir, 'job-output.txt')
+        with open(log, 'w') as f:
+            f.write('log')
+        detail = FileDetail(log, 'job-output.txt')
+
+        journal = UploadJournal(path)
+        self.assertFalse(journal.is_done('c/job-output.txt', detail))
+        journal.done('c/job-output.txt', detail, 'etag')
+        self.assertTrue(journal.is_done('c/job-output.txt', detail))
+        # Only the object names recorded are done
+        self.assertFalse(journal.is_done('d/job-output.txt', detail))
+        # Recorded before the journal is closed
+        self.assertTrue(UploadJournal(path).is_done('c/job-output.txt',
+                                                    detail))
+        journal.close()
+        # The interruption cut the last line short
+        with open(path, 'a') as f:
+            f.write('{"name": "c/ot')
+
+        journal = UploadJournal(path)
+        self.assertTrue(journal.is_done('c/job-output.txt', detail))
+        self.assertFalse(journal.is_done(
+            'c/index.html', FileDetail.from_content('index.html', b'')))
+        # A file changed since is uploaded again
+        os.utime(log, (0, 0))
+        self.assertFalse(journal.is_done(
+            'c/job-output.txt', FileDetail(log, 'job-output.txt')))
+
+    def test_single_handle(self):
+        '''Test the journal file is opened once for all the objects'''
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tempdir, 'journal')
+        journal = UploadJournal(path)
+        self.addCleanup(journal.close)
+        opened = []
+        real_open = open
+
+        def fake_open(*args, **kwargs):
+            opened.append(args[0])
+            return real_open(*args, **kwargs)
+
+        with fixtures.MockPatch('builtins.open', fake_open):
+            for x in range(10):
+                journal.done('c/%d' % x, FileDetail.from_content(
+                    '%d' % x, b'data'))
+        self.assertEqual([path], opened)
+        journal.close()
+        self.assertEqual(10, len(UploadJournal(path)._entries))
+
+
+class TestZeroCopyGZIPCompressedStream(testtools.TestCase):
+
+    def _compress(self, cls, data, chunk_size=16384):
+        stream = cls(io.BytesIO(data))
+        out = []
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            out.append(chunk)
+        out = b''.join(out)
+        self.assertEqual(len(out), stream.tell())
+        return out
+
+    def test_round_trip(self):
+        '''Test the output decompresses to the input'''
+        text = b''.join(b'line %d of the log\n' % i for i in range(50000))
+        for data in (b'', b'x', text, os.urandom(200000)):
+            for chunk_size in (1, 16384, 10 ** 6):
+                if chunk_size == 1 and len(data) > 1:
+                    continue
+                out = self._compress(ZeroCopyGZIPCompressedStream, data,
+                                     chunk_size)
+                self.assertEqual(data, gzip.decompress(out))
+        stream = ZeroCopyGZIPCompressedStream(io.BytesIO(text))
+        self.assertEqual(text, gzip.decompress(stream.read()))
+
+    def test_benchmark(self):
+        '''Compare the speed and memory use with GZIPCompressedStream'''
+        data = b''.join(b'%d: some log line\n' % i for i in range(300000))
+        results = []
+        for cls in (GZIPCompressedStream, ZeroCopyGZIPCompressedStream):
+            stream = cls(io.BytesIO(data))
+            # Only measure the memory used by the stream itself
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            size = 0
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                while True:
+                    chunk = stream.read(16384)
+                    if not chunk:
+                        break
+                    size += len(decompressor.decompress(chunk))
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(data), size)
+            self.assertTrue(decompressor.eof)
+            results.append('%s: %.1f MB/s, %d bytes allocated at peak' % (
+                cls.__name__, len(data) / elapsed / 1e6, peak))
+        self.addDetail('benchmark', text_content('\n'.join(results)))
+
+
+class TestContentEncoders(testtools.TestCase):
+
+    def _encode(self, encoding, data, level=9):
+        stream = get_content_encoder(encoding).open(
+            io.BytesIO(data), len(data), level)
+        return stream.read()
+
+    def test_compressor_stream(self):
+        '''Test the output of the compressor is read whole'''
+        data = b'a log line\n' * 100000
+        compressor = zlib.compressobj()
+        stream = CompressorStream(io.BytesIO(data), compressor.compress,
+                                  compressor.flush)
+        out = b''
+        while True:
+            chunk = stream.read(1000)
+            if not chunk:
+                break
+            out += chunk
+        self.assertEqual(len(out), stream.tell())
+        self.assertEqual(data, zlib.decompress(out))
+
+    def test_gzip(self):
+        self.assertTrue(get_content_encoder('gzip').concatenable)
+        self.assertEqual(b'data', gzip.decompress(self._encode('gzip',
+                                                               b'data')))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, get_content_encoder, 'lzma')
+
+    @testtools.skipUnless(upload_utils.brotli, 'brotli is not installed')
+    def test_brotli(self):
+        data = b'a log line\n' * 1000
+        self.assertEqual(data, upload_utils.brotli.decompress(
+            self._encode('br', data)))
+
+    @testtools.skipUnless(upload_utils.zstandard,
+                          'zstandard is not installed')
+    def test_zstd(self):
+        data = b'a log line\n' * 1000
+        decompressor = upload_utils.zstandard.ZstdDecompressor()
+        self.assertEqual(data, decompressor.decompressobj().decompress(
+            self._encode('zstd', data)))
@@ -5,12 +5,65 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import gzip
+import json
 import os
 import testtools
+
+import fixtures
+from .fakeobjectstore import FakeObjectStoreFixture
+from .zuul_s3_upload import Uploader
+from ..module_utils.zuul_jobs.upload_utils import FileList, UploadJournal
+
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
                            'test-fixtures')
 
 
 class TestUpload(testtools.TestCase):
-    # TODO: Implement upload test case
-    pass
+
+    def test_upload(self):
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        server.create_container('bucket')
+        uploader = Uploader('bucket', True, endpoint=server.s3_endpoint,
+                            prefix='1234', aws_access_key='access',
+                            aws_secret_key='secret')
+
+        with FileList() as file_list:
+            file_list.add(os.path.join(FIXTURE_DIR, 'logs/'))
+            self.assertEqual([], uploader.upload(list(file_list)))
+
+        self.assertIn('1234/job-output.json', server.objects('bucket'))
+        obj = server.get_object('bucket', '1234/zuul-info/inventory.yaml')
+        self.assertEqual('gzip', obj.headers['content-encoding'])
+        with open(os.path.join(FIXTURE_DIR,
+                               'logs/zuul-info/inventory.yaml'), 'rb') as f:
+            self.assertEqual(f.read(), gzip.decompress(obj.body))
+        obj = server.get_object('bucket', '1234/controller/journal.xz')
+        self.assertEqual('xz', obj.headers['content-encoding'])
+        # Gzipped files are kept as they are, without an encoding
+        obj = server.get_object('bucket', '1234/controller/compressed.gz')
+        self.assertNotIn('content-encoding', obj.headers)
+
+    def test_upload_journal(self):
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        server.create_container('bucket')
+        journal_path = os.path.join(self.useFixture(
+            fixtures.TempDir()).path, 'journal')
+        uploader = Uploader('bucket', True, endpoint=server.s3_endpoint,
+                            aws_access_key='access', aws_secret_key='secret',
+                            journal=UploadJournal(journal_path))
+
+        self.addCleanup(uploader.journal.close)
+
+        with FileList() as file_list:
+            file_list.add(os.path.join(FIXTURE_DIR, 'logs/'))
+            self.assertEqual([], uploader.upload(list(file_list)))
+
+        with open(journal_path) as f:
+            entries = [json.loads(line) for line in f]
+        names = [e['name'] for e in entries]
+        self.assertIn('bucket/job-output.json', names)
+        self.assertEqual(len(file_list), len(names))
+        # No request is made for the ETags, none are recorded
+        self.assertEqual([None], list(set(e['etag'] for e in entries)))
+        self.assertNotIn('HEAD', server.requests)
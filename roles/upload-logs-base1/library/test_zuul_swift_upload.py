@@ -18,16 +18,35 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import gzip
+import io
+import json
 import os
+import shutil
+import tarfile
 import testtools
+import zlib
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+import fixtures
+import openstack
 import requests
-from .zuul_swift_upload import Uploader
-from ..module_utils.zuul_jobs.upload_utils import FileDetail
+from .fakeobjectstore import FakeObjectStoreFixture
+from .zuul_swift_upload import DEDUP_MIN_SIZE, Uploader, run
+from ..module_utils.zuul_jobs import upload_utils
+from ..module_utils.zuul_jobs.upload_utils import (
+    CompressionPolicy,
+    CompressorStream,
+    ContentEncoder,
+    DedupIndex,
+    FileDetail,
+    UploadEngine,
+    UploadJournal,
+    UploadMetrics,
+)
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
                            'test-fixtures')
@@ -36,12 +55,11 @@ FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
 class MockUploader(Uploader):
     """An uploader that uses a mocked cloud object"""
     def __init__(self, container):
-        self.container = container
-        self.cloud = mock.Mock()
+        # Set up like a dry run, which does not talk to the cloud, but
+        # upload for real to the mock.
+        super(MockUploader, self).__init__(mock.Mock(), container,
+                                           dry_run=True)
         self.dry_run = False
-        self.public = True
-        self.delete_after = None
-        self.prefix = ""
         self.url = 'http://dry-run-url.com/a/path/'
 
 
@@ -85,3 +103,455 @@ class TestUpload(testtools.TestCase):
 
         failures = uploader.upload(files)
         self.assertEqual(expected_failures, failures)
+
+    def test_upload_content_encoding(self):
+        def open_deflate_stream(stream, size, compression_level):
+            compressor = zlib.compressobj(compression_level)
+            return CompressorStream(stream, compressor.compress,
+                                    compressor.flush)
+
+        patcher = mock.patch.dict(
+            upload_utils.CONTENT_ENCODERS,
+            {'deflate': ContentEncoder('deflate', open_deflate_stream)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        uploader = MockUploader(container="container")
+        uploader.content_encoding = 'deflate'
+        path = os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg")
+        file_detail = FileDetail(path, "cpu-load.svg")
+
+        self.assertEqual([], uploader.upload([file_detail]))
+        kwargs = uploader.cloud.create_object.call_args[1]
+        self.assertEqual('deflate', kwargs['content-encoding'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(),
+                             zlib.decompress(b''.join(kwargs['data'])))
+
+        # Deflate streams can not be concatenated, segments are gzipped
+        headers = uploader._object_details(file_detail, segmented=True)[1]
+        self.assertEqual('gzip', headers['content-encoding'])
+
+    def test_upload_line_index(self):
+        uploader = MockUploader(container="container")
+        uploader.compression = CompressionPolicy(line_index_min_size=1)
+        path = os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg")
+        file_detail = FileDetail(path, "cpu-load.svg")
+
+        objects = []
+
+        def create_object(container, name, data, **headers):
+            # The index is complete once the data is read
+            objects.append((name, gzip.decompress(b''.join(data))))
+
+        uploader.cloud.create_object.side_effect = create_object
+        self.assertEqual([], uploader.upload([file_detail]))
+        self.assertEqual(['cpu-load.svg', 'cpu-load.svg.lines.json'],
+                         [name for name, data in objects])
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, objects[0][1])
+        index = json.loads(objects[1][1].decode('utf-8'))
+        self.assertEqual(data.count(b'\n'), index['lines'])
+        self.assertEqual([[1, 0, 10]], index['chunks'])
+
+    def test_upload_metrics(self):
+        uploader = MockUploader(container="container")
+        uploader.compression = CompressionPolicy(line_index_min_size=1)
+        uploader.engine = UploadEngine(metrics=UploadMetrics())
+        path = os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg")
+        files = [FileDetail(path, "cpu-load.svg"),
+                 FileDetail.from_content('index.html', b'<html/>')]
+
+        sizes = {}
+
+        def create_object(container, name, data, **headers):
+            sizes[name] = len(b''.join(data))
+
+        uploader.cloud.create_object.side_effect = create_object
+        self.assertEqual([], uploader.upload(files))
+        # The line index is still read through the metered stream
+        self.assertIn('cpu-load.svg.lines.json', sizes)
+
+        report = uploader.engine.metrics.report()
+        self.assertEqual(2, report['objects'])
+        self.assertEqual(files[0].size + files[1].size, report['bytes'])
+        # The line index is compressed too
+        self.assertGreater(report['compression']['bytes_in'],
+                           files[0].size + files[1].size)
+        self.assertEqual(sum(sizes.values()),
+                         report['compression']['bytes_out'])
+        self.assertEqual(['compression', 'network'],
+                         list(report['time']))
+        self.assertEqual(['cpu-load.svg', 'index.html'],
+                         sorted(x['name'] for x in report['slowest']))
+
+    def test_upload_dedup(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        index_path = os.path.join(tempdir, 'dedup.json')
+        path = os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg")
+        text_path = os.path.join(tempdir, 'cpu-load.txt')
+        shutil.copy(path, text_path)
+
+        def upload(name, path=path, min_size=0):
+            uploader = MockUploader(container="container")
+            uploader.delete_after = 100
+            uploader.dedup_index = DedupIndex(index_path)
+            uploader.dedup_min_size = min_size
+            self.assertEqual(
+                [], uploader.upload([FileDetail(path, name)]))
+            uploader.dedup_index.save()
+            return [c[1] for c in
+                    uploader.cloud.create_object.call_args_list]
+
+        blob, link = upload('build1/cpu-load.svg')
+        self.assertTrue(blob['name'].startswith('_blobs/'))
+        self.assertEqual('200', blob['x-delete-after'])
+        self.assertEqual('gzip', blob['content-encoding'])
+        self.assertEqual('build1/cpu-load.svg', link['name'])
+        self.assertEqual('', link['data'])
+        self.assertEqual('100', link['x-delete-after'])
+        self.assertEqual('image/svg+xml', link['content-type'])
+        self.assertNotIn('content-encoding', link)
+        self.assertEqual('container/' + blob['name'],
+                         link['x-symlink-target'])
+
+        # The same content is only linked to
+        link2, = upload('build2/cpu-load.svg')
+        self.assertEqual('build2/cpu-load.svg', link2['name'])
+        self.assertEqual(link['x-symlink-target'], link2['x-symlink-target'])
+
+        # A different mimetype makes a different blob
+        blob3, link3 = upload('build3/cpu-load.txt', text_path)
+        self.assertNotEqual(blob['name'], blob3['name'])
+
+        # Small files are uploaded as they are
+        obj, = upload('build4/cpu-load.svg', min_size=DEDUP_MIN_SIZE)
+        self.assertEqual('build4/cpu-load.svg', obj['name'])
+        self.assertNotIn('x-symlink-target', obj)
+
+    def test_upload_journal(self):
+        # Do not retry (and sleep) on failures
+        self.useFixture(
+            fixtures.MockPatchObject(upload_utils, 'POST_ATTEMPTS', 1))
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        journal_path = os.path.join(tempdir, 'journal')
+        files = [
+            FileDetail(os.path.join(FIXTURE_DIR, "logs/zuul-info/inventory"
+                                                 ".yaml"),
+                       'zuul-info/inventory.yaml'),
+            FileDetail(os.path.join(FIXTURE_DIR, "logs/controller/"
+                                                 "cpu-load.svg"),
+                       'controller/cpu-load.svg'),
+            FileDetail.from_content('index.html', b'<html/>'),
+        ]
+
+        def upload(fail=None):
+            uploader = MockUploader(container="container")
+            uploader.path = 'container'
+            uploader.journal = UploadJournal(journal_path)
+            self.addCleanup(uploader.journal.close)
+
+            def create_object(container, name, data, **headers):
+                if name == fail:
+                    raise requests.exceptions.ConnectionError()
+                return mock.Mock(etag='etag-' + name)
+            uploader.cloud.create_object.side_effect = create_object
+            failures = uploader.upload(files)
+            return failures, sorted(set(
+                c[1]['name'] for c in
+                uploader.cloud.create_object.call_args_list))
+
+        # The first run is interrupted by a failure
+        failures, names = upload(fail='controller/cpu-load.svg')
+        self.assertEqual(1, len(failures))
+        self.assertEqual(
+            ['controller/cpu-load.svg', 'index.html',
+             'zuul-info/inventory.yaml'], names)
+
+        # Only the failed file and the generated index are sent again
+        failures, names = upload()
+        self.assertEqual([], failures)
+        self.assertEqual(['controller/cpu-load.svg', 'index.html'], names)
+
+        with open(journal_path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            {'container/zuul-info/inventory.yaml':
+             'etag-zuul-info/inventory.yaml',
+             'container/index.html': 'etag-index.html',
+             'container/controller/cpu-load.svg':
+             'etag-controller/cpu-load.svg'},
+            dict((e['name'], e['etag']) for e in entries))
+
+    def test_setup_unauthorized(self):
+        '''Test the container setup retries intermittent HTTP 401'''
+        self.useFixture(fixtures.MockPatchObject(upload_utils.time, 'sleep'))
+        server = self.useFixture(FakeObjectStoreFixture()).server
+        cloud = openstack.connect(
+            auth_type='v3password',
+            auth=dict(auth_url=server.auth_url, username='test',
+                      password='test', project_name='test',
+                      user_domain_name='Default',
+                      project_domain_name='Default'),
+            region_name='RegionOne')
+        # keystoneauth reauthenticates and retries a first 401 itself
+        server.inject_error(401, count=2, path='/v1/AUTH_test/container')
+        Uploader(cloud, 'container')
+        self.assertEqual(2, server.statuses[401])
+        self.assertEqual(['index.html'], server.objects('container'))
+
+    def test_asyncio_unsupported_options(self):
+        # Rejected before anything is scanned or uploaded
+        for options in ({'segment_size': 1024},
+                        {'dedup_index': '/tmp/dedup.json'}):
+            e = self.assertRaises(ValueError, run, None, 'container', [],
+                                  transport='asyncio', **options)
+            self.assertIn(list(options)[0], str(e))
+        self.assertRaisesRegex(
+            ValueError, 'segment_size and dedup_index', run, None,
+            'container', [], transport='asyncio', segment_size=1024,
+            dedup_index='/tmp/dedup.json')
+
+    def test_upload_asyncio(self):
+        server = self.useFixture(
+            FakeObjectStoreFixture(token='token')).server
+        server.create_container('container')
+
+        uploader = MockUploader(container="container")
+        uploader.transport = 'asyncio'
+        uploader.engine = UploadEngine(concurrency=2)
+        uploader.cloud.auth_token = 'token'
+        uploader.cloud.object_store.get_endpoint.return_value = (
+            server.swift_endpoint)
+
+        files = [
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/job-output.json"),
+                "job-output.json",
+            ),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/zuul-info/inventory.yaml"),
+                "zuul-info/inventory.yaml",
+            ),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/controller/journal.xz"),
+                "controller/journal.xz",
+            ),
+        ]
+
+        self.assertEqual([], uploader.upload(files))
+        self.assertEqual(
+            ['controller/journal.xz', 'job-output.json',
+             'zuul-info/inventory.yaml'],
+            server.objects('container'))
+        # Connections are kept alive and reused
+        self.assertLessEqual(server.connections, 2)
+
+        obj = server.get_object('container', 'zuul-info/inventory.yaml')
+        self.assertEqual('gzip', obj.headers['content-encoding'])
+        self.assertEqual('text/plain', obj.headers['content-type'])
+        with open(os.path.join(FIXTURE_DIR,
+                               "logs/zuul-info/inventory.yaml"), 'rb') as f:
+            self.assertEqual(f.read(), gzip.decompress(obj.body))
+
+        obj = server.get_object('container', 'controller/journal.xz')
+        self.assertEqual('xz', obj.headers['content-encoding'])
+        with open(os.path.join(FIXTURE_DIR,
+                               "logs/controller/journal.xz"), 'rb') as f:
+            self.assertEqual(f.read(), obj.body)
+
+    def test_upload_archive_stream(self):
+        uploader = MockUploader(container="container")
+        uploader.archive_mode = True
+        uploader.stream_archive = True
+        uploaded = {}
+
+        def put(url, headers, data):
+            uploaded['url'] = url
+            # A generator, sent with chunked transfer encoding
+            self.assertFalse(hasattr(data, '__len__'))
+            uploaded['data'] = b''.join(data)
+            response = mock.Mock()
+            response.json.return_value = {
+                'Errors': [['zuul-info/inventory.yaml', '400 Bad Request']]}
+            return response
+        uploader.cloud.object_store.put = mock.Mock(side_effect=put)
+
+        files = [
+            FileDetail(None, '', ''),
+            FileDetail(os.path.join(FIXTURE_DIR, "logs/zuul-info"),
+                       "zuul-info"),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/zuul-info/inventory.yaml"),
+                "zuul-info/inventory.yaml",
+            ),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/job-output.json"),
+                "job-output.json",
+            ),
+        ]
+
+        failures = uploader.upload(files)
+        self.assertEqual(
+            [{'file': 'zuul-info/inventory.yaml',
+              'error': '400 Bad Request'}], failures)
+        self.assertEqual('container/?extract-archive=tar.gz',
+                         uploaded['url'])
+        with tarfile.open(fileobj=io.BytesIO(uploaded['data'])) as tar:
+            # Folders are not added recursively
+            self.assertEqual(
+                ['zuul-info', 'zuul-info/inventory.yaml', 'job-output.json'],
+                tar.getnames())
+
+    def test_upload_archive_stream_aborted(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        files = [FileDetail(None, '', '')]
+        for x in range(20):
+            path = os.path.join(tempdir, 'file%d.bin' % x)
+            with open(path, 'wb') as f:
+                # More than the pipe holds, and incompressible
+                f.write(os.urandom(256 * 1024))
+            files.append(FileDetail(path, 'file%d.bin' % x))
+
+        uploader = MockUploader(container="container")
+        uploader.archive_mode = True
+        uploader.stream_archive = True
+
+        def put(url, headers, data):
+            # The server answers before reading the whole archive
+            next(iter(data))
+            response = mock.Mock()
+            response.json.return_value = {'Errors': []}
+            return response
+        uploader.cloud.object_store.put = mock.Mock(side_effect=put)
+
+        # The writer stops instead of failing every remaining file
+        self.assertEqual([], uploader.upload(files))
+
+    def test_upload_archive_shards(self):
+        uploader = MockUploader(container="container")
+        uploader.archive_mode = True
+        uploader.archive_shards = 2
+        archives = []
+
+        def put(url, headers, data):
+            with tarfile.open(fileobj=io.BytesIO(data.read())) as tar:
+                names = tar.getnames()
+            archives.append(names)
+            response = mock.Mock()
+            response.json.return_value = {
+                'Errors': [[name, '400 Bad Request'] for name in names
+                           if name.endswith('.yaml')]}
+            return response
+        uploader.cloud.object_store.put = mock.Mock(side_effect=put)
+
+        files = [
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/zuul-info/inventory.yaml"),
+                "zuul-info/inventory.yaml",
+            ),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/job-output.json"),
+                "job-output.json",
+            ),
+        ]
+
+        failures = uploader.upload(files)
+        self.assertEqual(
+            [{'file': 'zuul-info/inventory.yaml',
+              'error': '400 Bad Request'}], failures)
+        self.assertEqual(
+            [['job-output.json'], ['zuul-info/inventory.yaml']],
+            sorted(archives))
+
+    def test_upload_hybrid(self):
+        uploader = MockUploader(container="container")
+        uploader.archive_mode = True
+        uploader.archive_max_file_size = 20
+        archives = []
+
+        def put(url, headers, data):
+            with tarfile.open(fileobj=io.BytesIO(data.read())) as tar:
+                archives.append(tar.getnames())
+            response = mock.Mock()
+            response.json.return_value = {'Errors': []}
+            return response
+        uploader.cloud.object_store.put = mock.Mock(side_effect=put)
+
+        files = [
+            FileDetail(os.path.join(FIXTURE_DIR, "logs/controller"),
+                       "controller"),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg"),
+                "controller/cpu-load.svg",
+            ),
+            FileDetail(
+                os.path.join(FIXTURE_DIR, "logs/job-output.json"),
+                "job-output.json",
+            ),
+        ]
+        # cpu-load.svg is the only file above the limit
+        self.assertGreater(files[1].size, 20)
+        self.assertLess(files[2].size, 20)
+
+        self.assertEqual([], uploader.upload(files))
+        self.assertEqual([['controller', 'job-output.json']], archives)
+        self.assertEqual(
+            ['controller/cpu-load.svg'],
+            [c[1]['name']
+             for c in uploader.cloud.create_object.call_args_list])
+
+    def test_upload_segments(self):
+        # Do not sleep before retrying
+        self.useFixture(fixtures.MockPatchObject(upload_utils.time, 'sleep'))
+        uploader = MockUploader(container="container")
+        uploader.segment_size = 10
+        uploader.delete_after = 60
+        objects = {}
+        attempts = []
+
+        def put(url, headers, data):
+            attempts.append(url)
+            body = b''.join(data) if not isinstance(data, str) else data
+            # The third segment fails once and is retried on its own
+            if url.endswith('/00000002') and attempts.count(url) == 1:
+                raise requests.exceptions.ConnectionError("Failed")
+            objects[url] = (headers, body)
+            response = mock.Mock()
+            response.headers = {'etag': '"etag-%d"' % len(objects)}
+            return response
+        uploader.cloud.object_store.put = mock.Mock(side_effect=put)
+
+        path = os.path.join(FIXTURE_DIR, "logs/controller/cpu-load.svg")
+        files = [FileDetail(path, "controller/cpu-load.svg")]
+        self.assertEqual(52, files[0].size)
+
+        self.assertEqual([], uploader.upload(files))
+        segment_urls = [
+            'container/.segments/controller/cpu-load.svg/%08d' % x
+            for x in range(6)]
+        self.assertEqual(7, len(objects))
+        self.assertEqual(1, attempts.count(segment_urls[0]))
+        self.assertEqual(2, attempts.count(segment_urls[2]))
+
+        # Every segment is gzipped on its own
+        with open(path, 'rb') as f:
+            content = f.read()
+        for index, url in enumerate(segment_urls):
+            headers, body = objects[url]
+            self.assertEqual('60', headers['x-delete-after'])
+            self.assertEqual(content[index * 10:(index + 1) * 10],
+                             gzip.decompress(body))
+        self.assertEqual(
+            content,
+            gzip.decompress(b''.join(objects[url][1]
+                                     for url in segment_urls)))
+
+        headers, body = objects[
+            'container/controller/cpu-load.svg?multipart-manifest=put']
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual('image/svg+xml', headers['content-type'])
+        manifest = json.loads(body)
+        self.assertEqual(['/' + url for url in segment_urls],
+                         [segment['path'] for segment in manifest])
+        self.assertTrue(all(segment['etag'] for segment in manifest))
@@ -31,12 +31,7 @@ import datetime
 import json
 import logging
 import os
-try:
-    import queue as queuelib
-except ImportError:
-    import Queue as queuelib
 import sys
-import threading
 
 from google.cloud import storage
 import google.auth.compute_engine.credentials as gce_cred
@@ -46,18 +41,28 @@ from ansible.module_utils.basic import AnsibleModule
 try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GZIPCompressedStream,
-        Indexer,
-        retry_function,
+        CompressionPolicy,
+        LineIndexedGZIPCompressedStream,
+        UploadEngine,
+        add_upload_arguments,
+        get_content_encoder,
+        make_line_index_file,
+        run_upload,
+        upload_argument_spec,
+        upload_options,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GZIPCompressedStream,
-        Indexer,
-        retry_function,
+        CompressionPolicy,
+        LineIndexedGZIPCompressedStream,
+        UploadEngine,
+        add_upload_arguments,
+        get_content_encoder,
+        make_line_index_file,
+        run_upload,
+        upload_argument_spec,
+        upload_options,
     )
 
 MAX_UPLOAD_THREADS = 24
@@ -87,9 +92,15 @@ class Credentials(gce_cred.Credentials):
 
 class Uploader():
     def __init__(self, client, container, prefix=None,
-                 dry_run=False):
+                 dry_run=False, engine=None, compression=None,
+                 content_encoding='gzip', journal=None):
 
         self.dry_run = dry_run
+        self.journal = journal
+        self.engine = engine or UploadEngine(concurrency=MAX_UPLOAD_THREADS)
+        self.compression = compression or CompressionPolicy()
+        # Fail early on an unknown encoding
+        self.encoder = get_content_encoder(content_encoding)
         if dry_run:
             self.endpoint = 'http://dry-run-url.com'
             self.path = '/a/path/'
@@ -112,41 +123,26 @@ class Uploader():
         self.url = os.path.join(self.endpoint, self.path)
 
     def upload(self, file_list):
-        """Spin up thread pool to upload to storage"""
+        """Upload the file list to storage using the upload engine"""
 
         if self.dry_run:
             return
 
-        num_threads = min(len(file_list), MAX_UPLOAD_THREADS)
-        threads = []
-        queue = queuelib.Queue()
-        # add items to queue
-        for f in file_list:
-            queue.put(f)
-
-        for x in range(num_threads):
-            t = threading.Thread(target=self.post_thread, args=(queue,))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-    def post_thread(self, queue):
-        while True:
-            try:
-                file_detail = queue.get_nowait()
-                logging.debug("%s: processing job %s",
-                              threading.current_thread(),
-                              file_detail)
-                retry_function(lambda: self._post_file(file_detail))
-            except IOError:
-                # Do our best to attempt to upload all the files
-                logging.exception("Error opening file")
-                continue
-            except queuelib.Empty:
-                # No more work to do
-                return
+        if self.journal is not None:
+            # Lazily, file_list may be a pipelined scan
+            file_list = (f for f in file_list if not self.journal.is_done(
+                self._journal_name(f), f))
+
+        def post(file_detail):
+            etag = self._post_file(file_detail)
+            if self.journal is not None:
+                self.journal.done(self._journal_name(file_detail),
+                                  file_detail, etag)
+
+        return self.engine.run(post, file_list)
+
+    def _journal_name(self, file_detail):
+        return os.path.join(self.path, file_detail.relative_path)
 
     @staticmethod
     def _is_text_type(mimetype):
@@ -167,12 +163,26 @@ class Uploader():
     def _post_file(self, file_detail):
         relative_path = os.path.join(self.prefix, file_detail.relative_path)
         content_encoding = None
+        line_index = False
 
         if not file_detail.folder:
+            level = 0
             if (file_detail.encoding is None and
                 self._is_text_type(file_detail.mimetype)):
-                content_encoding = 'gzip'
-                data = GZIPCompressedStream(open(file_detail.full_path, 'rb'))
+                level = self.compression.compression_level(file_detail)
+            if level:
+                content_encoding = self.encoder.encoding
+                line_index = self.compression.line_index(file_detail,
+                                                         content_encoding)
+                if line_index:
+                    data = LineIndexedGZIPCompressedStream(
+                        file_detail.open(), level)
+                else:
+                    data = self.encoder.open(
+                        file_detail.open(), file_detail.size,
+                        level)
+                if self.engine.metrics is not None:
+                    data = self.engine.metrics.meter(data, file_detail.size)
             else:
                 if (not file_detail.filename.endswith(".gz") and
                     file_detail.encoding):
@@ -183,7 +193,7 @@ class Uploader():
                     # can cause problems when the desired file state is
                     # compressed as with .tar.gz tarballs.
                     content_encoding = file_detail.encoding
-                data = open(file_detail.full_path, 'rb')
+                data = file_detail.open()
         else:
             data = ''
             relative_path = relative_path.rstrip('/')
@@ -197,13 +207,17 @@ class Uploader():
         else:
             upload = blob.upload_from_string
         upload(data, content_type=file_detail.mimetype)
+        if line_index:
+            self._post_file(make_line_index_file(file_detail, data))
+        return blob.etag
 
 
 def run(container, files,
         indexes=True, parent_links=True, topdir_parent_link=False,
         partition=False, footer='index_footer.html',
         prefix=None, dry_run=False, credentials_file=None,
-        project=None):
+        project=None, concurrency=MAX_UPLOAD_THREADS,
+        content_encoding='gzip', **options):
 
     if credentials_file:
         cred = Credentials(credentials_file)
@@ -219,28 +233,20 @@ def run(container, files,
             container += '_' + parts[0]
             prefix = '/'.join(parts[1:])
 
-    # Create the objects to make sure the arguments are sound.
-    with FileList() as file_list:
-        # Scan the files.
-        for file_path in files:
-            file_list.add(file_path)
-
-        indexer = Indexer(file_list)
-
-        # (Possibly) make indexes.
-        if indexes:
-            indexer.make_indexes(create_parent_links=parent_links,
-                                 create_topdir_parent_link=topdir_parent_link,
-                                 append_footer=footer)
-
-        logging.debug("List of files prepared to upload:")
-        for x in file_list:
-            logging.debug(x)
+    def make_uploader(engine, compression, journal):
+        return Uploader(client, container, prefix, dry_run, engine,
+                        compression, content_encoding, journal)
 
-        # Upload.
-        uploader = Uploader(client, container, prefix, dry_run)
-        uploader.upload(file_list)
-        return uploader.url, uploader.endpoint, uploader.path
+    (uploader, upload_failures, compression_levels, concurrency_control,
+     report) = run_upload(files, make_uploader,
+                          indexes=indexes,
+                          parent_links=parent_links,
+                          topdir_parent_link=topdir_parent_link,
+                          footer=footer,
+                          concurrency=concurrency,
+                          **options)
+    return (uploader.url, uploader.endpoint, uploader.path,
+            upload_failures, compression_levels, concurrency_control, report)
 
 
 def ansible_main():
@@ -256,11 +262,14 @@ def ansible_main():
             prefix=dict(type='str'),
             credentials_file=dict(type='str'),
             project=dict(type='str'),
+            concurrency=dict(type='int', default=MAX_UPLOAD_THREADS),
+            **upload_argument_spec()
         )
     )
 
     p = module.params
-    url, endpoint, path = run(
+    (url, endpoint, path, upload_failures, compression_levels,
+     concurrency_control, metrics) = run(
         p.get('container'), p.get('files'),
         indexes=p.get('indexes'),
         parent_links=p.get('parent_links'),
@@ -269,12 +278,20 @@ def ansible_main():
         footer=p.get('footer'),
         prefix=p.get('prefix'),
         credentials_file=p.get('credentials_file'),
-        project=p.get('project')
+        project=p.get('project'),
+        concurrency=p.get('concurrency'),
+        content_encoding=p.get('content_encoding'),
+        **upload_options(p)
     )
     module.exit_json(changed=True,
                      url=url,
                      endpoint=endpoint,
-                     path=path)
+                     path=path,
+                     upload_failures=upload_failures,
+                     compression_levels=compression_levels,
+                     concurrency_control=concurrency_control,
+                     metrics=metrics,
+                     content_encoding=p.get('content_encoding'))
 
 
 def cli_main():
@@ -308,6 +325,10 @@ def cli_main():
     parser.add_argument('--project',
                         help='Name of the Google Cloud project (required for '
                              'credential file)')
+    parser.add_argument('--concurrency', default=MAX_UPLOAD_THREADS,
+                        type=int,
+                        help='Number of files to upload in parallel')
+    add_upload_arguments(parser)
     parser.add_argument('container',
                         help='Name of the container to use when uploading')
     parser.add_argument('files', nargs='+',
@@ -324,7 +345,7 @@ def cli_main():
     if append_footer.lower() == 'none':
         append_footer = None
 
-    _, _, path = run(
+    _, _, path, _, _, _, _ = run(
         args.container, args.files,
         indexes=not args.no_indexes,
         parent_links=not args.no_parent_links,
@@ -334,7 +355,10 @@ def cli_main():
         prefix=args.prefix,
         dry_run=args.dry_run,
         credentials_file=args.credentials_file,
-        project=args.project
+        project=args.project,
+        concurrency=args.concurrency,
+        content_encoding=args.content_encoding,
+        **upload_options(vars(args))
     )
     print(path)
 
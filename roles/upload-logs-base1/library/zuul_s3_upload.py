@@ -25,12 +25,7 @@ Utility to upload files to s3
 import argparse
 import logging
 import os
-try:
-    import queue as queuelib
-except ImportError:
-    import Queue as queuelib
 import sys
-import threading
 
 import boto3
 from ansible.module_utils.basic import AnsibleModule
@@ -38,18 +33,28 @@ from ansible.module_utils.basic import AnsibleModule
 try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GZIPCompressedStream,
-        Indexer,
-        retry_function,
+        CompressionPolicy,
+        LineIndexedGZIPCompressedStream,
+        UploadEngine,
+        add_upload_arguments,
+        get_content_encoder,
+        make_line_index_file,
+        run_upload,
+        upload_argument_spec,
+        upload_options,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GZIPCompressedStream,
-        Indexer,
-        retry_function,
+        CompressionPolicy,
+        LineIndexedGZIPCompressedStream,
+        UploadEngine,
+        add_upload_arguments,
+        get_content_encoder,
+        make_line_index_file,
+        run_upload,
+        upload_argument_spec,
+        upload_options,
     )
 
 MAX_UPLOAD_THREADS = 24
@@ -57,8 +62,15 @@ MAX_UPLOAD_THREADS = 24
 
 class Uploader():
     def __init__(self, bucket, public, endpoint=None, prefix=None,
-                 dry_run=False, aws_access_key=None, aws_secret_key=None):
+                 dry_run=False, aws_access_key=None, aws_secret_key=None,
+                 engine=None, compression=None, content_encoding='gzip',
+                 journal=None):
         self.dry_run = dry_run
+        self.journal = journal
+        self.engine = engine or UploadEngine(concurrency=MAX_UPLOAD_THREADS)
+        self.compression = compression or CompressionPolicy()
+        # Fail early on an unknown encoding
+        self.encoder = get_content_encoder(content_encoding)
         self.public = public
         if dry_run:
             self.endpoint = 'http://dry-run-url.com'
@@ -83,54 +95,26 @@ class Uploader():
         self.bucket = self.s3.Bucket(bucket)
 
     def upload(self, file_list):
-        """Spin up thread pool to upload to storage"""
+        """Upload the file list to storage using the upload engine"""
 
         if self.dry_run:
             return
 
-        num_threads = min(len(file_list), MAX_UPLOAD_THREADS)
-        threads = []
-        queue = queuelib.Queue()
-        # add items to queue
-        for f in file_list:
-            queue.put(f)
-
-        failures = []
-        for x in range(num_threads):
-            t = threading.Thread(target=self.post_thread, args=(queue,
-                                                                failures))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        return failures
-
-    def post_thread(self, queue, failures):
-        while True:
-            try:
-                file_detail = queue.get_nowait()
-                logging.debug("%s: processing job %s",
-                              threading.current_thread(),
-                              file_detail)
-                retry_function(lambda: self._post_file(file_detail))
-            except IOError as e:
-                # Do our best to attempt to upload all the files
-                logging.exception("Error opening file")
-                failures.append({
-                    "file": file_detail.filename,
-                    "error": "{}".format(e)
-                })
-                continue
-            except queuelib.Empty:
-                # No more work to do
-                return
-            except Exception as e:
-                failures.append({
-                    "file": file_detail.filename,
-                    "error": "{}".format(e)
-                })
+        if self.journal is not None:
+            # Lazily, file_list may be a pipelined scan
+            file_list = (f for f in file_list if not self.journal.is_done(
+                self._journal_name(f), f))
+
+        def post(file_detail):
+            etag = self._post_file(file_detail)
+            if self.journal is not None:
+                self.journal.done(self._journal_name(file_detail),
+                                  file_detail, etag)
+
+        return self.engine.run(post, file_list)
+
+    def _journal_name(self, file_detail):
+        return os.path.join(self.path, file_detail.relative_path)
 
     @staticmethod
     def _is_text_type(mimetype):
@@ -151,12 +135,26 @@ class Uploader():
     def _post_file(self, file_detail):
         relative_path = os.path.join(self.prefix, file_detail.relative_path)
         content_encoding = None
+        line_index = False
 
         if not file_detail.folder:
+            level = 0
             if (file_detail.encoding is None and
                 self._is_text_type(file_detail.mimetype)):
-                content_encoding = 'gzip'
-                data = GZIPCompressedStream(open(file_detail.full_path, 'rb'))
+                level = self.compression.compression_level(file_detail)
+            if level:
+                content_encoding = self.encoder.encoding
+                line_index = self.compression.line_index(file_detail,
+                                                         content_encoding)
+                if line_index:
+                    data = LineIndexedGZIPCompressedStream(
+                        file_detail.open(), level)
+                else:
+                    data = self.encoder.open(
+                        file_detail.open(), file_detail.size,
+                        level)
+                if self.engine.metrics is not None:
+                    data = self.engine.metrics.meter(data, file_detail.size)
             else:
                 if (not file_detail.filename.endswith(".gz") and
                     file_detail.encoding):
@@ -167,12 +165,13 @@ class Uploader():
                     # can cause problems when the desired file state is
                     # compressed as with .tar.gz tarballs.
                     content_encoding = file_detail.encoding
-                data = open(file_detail.full_path, 'rb')
+                data = file_detail.open()
 
             extra_args = dict(
                 ContentType=file_detail.mimetype,
-                ContentEncoding=content_encoding
             )
+            if content_encoding:
+                extra_args['ContentEncoding'] = content_encoding
             if self.public:
                 extra_args['ACL'] = 'public-read'
 
@@ -181,12 +180,19 @@ class Uploader():
                 relative_path,
                 ExtraArgs=extra_args
             )
+            # upload_fileobj does not return the ETag, and asking for
+            # it would take a request per object, so the journal
+            # records none.
+            if line_index:
+                self._post_file(make_line_index_file(file_detail, data))
 
 
 def run(bucket, public, files, endpoint=None,
         indexes=True, parent_links=True, topdir_parent_link=False,
         partition=False, footer='index_footer.html',
-        prefix=None, aws_access_key=None, aws_secret_key=None):
+        prefix=None, aws_access_key=None, aws_secret_key=None,
+        concurrency=MAX_UPLOAD_THREADS, content_encoding='gzip',
+        **options):
 
     if prefix:
         prefix = prefix.lstrip('/')
@@ -196,34 +202,28 @@ def run(bucket, public, files, endpoint=None,
             bucket += '_' + parts[0]
             prefix = '/'.join(parts[1:])
 
-    # Create the objects to make sure the arguments are sound.
-    with FileList() as file_list:
-        # Scan the files.
-        for file_path in files:
-            file_list.add(file_path)
-
-        indexer = Indexer(file_list)
-
-        # (Possibly) make indexes.
-        if indexes:
-            indexer.make_indexes(create_parent_links=parent_links,
-                                 create_topdir_parent_link=topdir_parent_link,
-                                 append_footer=footer)
-
-        logging.debug("List of files prepared to upload:")
-        for x in file_list:
-            logging.debug(x)
-
-        # Upload.
-        uploader = Uploader(bucket,
-                            public,
-                            endpoint,
-                            prefix,
-                            aws_access_key=aws_access_key,
-                            aws_secret_key=aws_secret_key)
-        upload_failures = uploader.upload(file_list)
-
-        return uploader.url, uploader.endpoint, uploader.path, upload_failures
+    def make_uploader(engine, compression, journal):
+        return Uploader(bucket,
+                        public,
+                        endpoint,
+                        prefix,
+                        aws_access_key=aws_access_key,
+                        aws_secret_key=aws_secret_key,
+                        engine=engine,
+                        compression=compression,
+                        content_encoding=content_encoding,
+                        journal=journal)
+
+    (uploader, upload_failures, compression_levels, concurrency_control,
+     report) = run_upload(files, make_uploader,
+                          indexes=indexes,
+                          parent_links=parent_links,
+                          topdir_parent_link=topdir_parent_link,
+                          footer=footer,
+                          concurrency=concurrency,
+                          **options)
+    return (uploader.url, uploader.endpoint, uploader.path,
+            upload_failures, compression_levels, concurrency_control, report)
 
 
 def ansible_main():
@@ -241,11 +241,14 @@ def ansible_main():
             endpoint=dict(type='str'),
             aws_access_key=dict(type='str'),
             aws_secret_key=dict(type='str', no_log=True),
+            concurrency=dict(type='int', default=MAX_UPLOAD_THREADS),
+            **upload_argument_spec()
         )
     )
 
     p = module.params
-    url, endpoint, path, failures = run(
+    (url, endpoint, path, failures, compression_levels,
+     concurrency_control, metrics) = run(
         p.get('bucket'),
         p.get('public'),
         p.get('files'),
@@ -258,18 +261,29 @@ def ansible_main():
         prefix=p.get('prefix'),
         aws_access_key=p.get('aws_access_key'),
         aws_secret_key=p.get('aws_secret_key'),
+        concurrency=p.get('concurrency'),
+        content_encoding=p.get('content_encoding'),
+        **upload_options(p)
     )
     if failures:
         module.fail_json(changed=True,
                          url=url,
                          endpoint=endpoint,
                          path=path,
-                         failures=failures)
+                         failures=failures,
+                         compression_levels=compression_levels,
+                         concurrency_control=concurrency_control,
+                         metrics=metrics,
+                         content_encoding=p.get('content_encoding'))
     module.exit_json(changed=True,
                      url=url,
                      endpoint=endpoint,
                      path=path,
-                     failures=failures)
+                     failures=failures,
+                     compression_levels=compression_levels,
+                     concurrency_control=concurrency_control,
+                     metrics=metrics,
+                     content_encoding=p.get('content_encoding'))
 
 
 def cli_main():
@@ -285,6 +299,10 @@ def cli_main():
     parser.add_argument('--prefix',
                         help='Prepend this path to the object names when '
                              'uploading')
+    parser.add_argument('--concurrency', default=MAX_UPLOAD_THREADS,
+                        type=int,
+                        help='Number of files to upload in parallel')
+    add_upload_arguments(parser)
     parser.add_argument('bucket',
                         help='Name of the bucket to use when uploading')
     parser.add_argument('files', nargs='+',
@@ -296,10 +314,13 @@ def cli_main():
         logging.basicConfig(level=logging.DEBUG)
         logging.captureWarnings(True)
 
-    _, _, path, _ = run(
+    _, _, path, _, _, _, _ = run(
         args.bucket, not args.no_public, args.files,
         prefix=args.prefix,
-        endpoint=args.endpoint
+        endpoint=args.endpoint,
+        concurrency=args.concurrency,
+        content_encoding=args.content_encoding,
+        **upload_options(vars(args))
     )
     print(path)
 
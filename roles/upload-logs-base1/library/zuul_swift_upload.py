@@ -23,17 +23,22 @@ Utility to upload files to swift
 """
 
 import argparse
+import asyncio
+import calendar
+import json
 import logging
 import os
-try:
-    import queue as queuelib
-except ImportError:
-    import Queue as queuelib
+import ssl
 import sys
 import tarfile
 import tempfile
 import threading
+import time
 import traceback
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urllib as urlparse
 
 import openstack
 import requests
@@ -46,21 +51,57 @@ from ansible.module_utils.basic import AnsibleModule
 try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GzipFilter,
-        Indexer,
+        ASYNC_MAX_UPLOADS,
+        AUTH_RETRY_STATUSES,
+        AsyncHTTPConnectionPool,
+        CompressionPolicy,
+        DEDUP_BLOB_LIFETIME_FACTOR,
+        DedupIndex,
+        EncodingFilter,
+        FileSegment,
+        RetryPolicy,
+        UploadEngine,
+        add_upload_arguments,
+        file_digest,
+        get_content_encoder,
+        make_line_index_file,
         retry_function,
+        run_upload,
+        split_file_list,
+        upload_argument_spec,
+        upload_options,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.upload_utils import (
-        FileList,
-        GzipFilter,
-        Indexer,
+        ASYNC_MAX_UPLOADS,
+        AUTH_RETRY_STATUSES,
+        AsyncHTTPConnectionPool,
+        CompressionPolicy,
+        DEDUP_BLOB_LIFETIME_FACTOR,
+        DedupIndex,
+        EncodingFilter,
+        FileSegment,
+        RetryPolicy,
+        UploadEngine,
+        add_upload_arguments,
+        file_digest,
+        get_content_encoder,
+        make_line_index_file,
         retry_function,
+        run_upload,
+        split_file_list,
+        upload_argument_spec,
+        upload_options,
     )
 
 MAX_UPLOAD_THREADS = 12
+STREAM_CHUNK_SIZE = 65536
+# Deduplicated files are stored once under this prefix of the container
+DEDUP_BLOB_PREFIX = '_blobs'
+# Smaller files are uploaded as they are: hashing them and the extra
+# symlink request cost more than uploading them again.
+DEDUP_MIN_SIZE = 64 * 1024
 
 
 def get_cloud(cloud):
@@ -71,22 +112,107 @@ def get_cloud(cloud):
         return openstack.connect(cloud=cloud)
 
 
+def check_transport_options(transport, segment_size=None, dedup_index=None):
+    """Raise ValueError for options the transport cannot honor
+
+    The asyncio transport uploads every file as a single object.
+    """
+    if transport != 'asyncio':
+        return
+    unsupported = [name for name, value in (('segment_size', segment_size),
+                                            ('dedup_index', dedup_index))
+                   if value]
+    if unsupported:
+        raise ValueError("%s not supported with the asyncio transport" %
+                         ' and '.join(unsupported))
+
+
+class ArchiveShard():
+    """A part of the file list uploaded as one archive"""
+
+    # Archives are streamed or written to disk first, they do not
+    # count against the bytes in flight of the upload engine.
+    size = 0
+
+    def __init__(self, index, files):
+        self.index = index
+        self.files = files
+        self.filename = 'archive shard {}'.format(index)
+
+    def __repr__(self):
+        return '<ArchiveShard %d: %d files>' % (self.index, len(self.files))
+
+
+class Segment():
+    """A part of a file uploaded as one segment of a Static Large Object"""
+
+    def __init__(self, file_detail, index, offset, length):
+        self.file_detail = file_detail
+        self.index = index
+        self.offset = offset
+        self.size = length
+        self.filename = file_detail.filename
+        self.etag = None
+        self.done = False
+
+    def __repr__(self):
+        return '<Segment %d of %s>' % (self.index,
+                                       self.file_detail.relative_path)
+
+
+class SegmentedFile():
+    """A file uploaded as segments and a Static Large Object manifest"""
+
+    # The manifest is tiny, whatever the size of the file
+    size = 0
+
+    def __init__(self, file_detail, segment_size):
+        self.file_detail = file_detail
+        self.filename = file_detail.filename
+        self.segments = [
+            Segment(file_detail, index, offset,
+                    min(segment_size, file_detail.size - offset))
+            for index, offset in enumerate(
+                range(0, file_detail.size, segment_size))
+        ]
+
+    def __repr__(self):
+        return '<SegmentedFile %s>' % self.file_detail.relative_path
+
+
 class Uploader():
     def __init__(self, cloud, container, prefix=None, delete_after=None,
-                 public=True, archive_mode=False, dry_run=False):
+                 public=True, archive_mode=False, dry_run=False,
+                 engine=None, transport='threads', stream_archive=False,
+                 archive_shards=1, archive_max_file_size=None,
+                 segment_size=None, compression=None,
+                 content_encoding='gzip', dedup_index=None, journal=None,
+                 dedup_min_size=DEDUP_MIN_SIZE):
 
         self.dry_run = dry_run
-        if dry_run:
-            self.endpoint = 'http://dry-run-url.com'
-            self.path = '/a/path'
-            self.url = os.path.join(self.endpoint, self.path)
-            return
-
+        self.engine = engine or UploadEngine(concurrency=MAX_UPLOAD_THREADS)
+        self.compression = compression or CompressionPolicy()
+        # Fail early on an unknown encoding
+        get_content_encoder(content_encoding)
+        self.content_encoding = content_encoding
+        self.transport = transport
+        self.stream_archive = stream_archive
+        self.archive_shards = archive_shards
+        self.archive_max_file_size = archive_max_file_size
+        self.segment_size = segment_size
+        self.dedup_index = dedup_index
+        self.dedup_min_size = dedup_min_size
+        self.journal = journal
         self.cloud = cloud
         self.container = container
         self.prefix = prefix or ''
         self.delete_after = delete_after
         self.archive_mode = archive_mode
+        if dry_run:
+            self.endpoint = 'http://dry-run-url.com'
+            self.path = '/a/path'
+            self.url = os.path.join(self.endpoint, self.path)
+            return
 
         sess = self.cloud.config.get_session()
         adapter = requests.adapters.HTTPAdapter(pool_maxsize=100)
@@ -106,18 +232,19 @@ class Uploader():
         # We retry here because sometimes we get HTTP 401 errors in rax.
         # They seem to happen infrequently (on the order of once a day across
         # all jobs) so a retry is likely to work.
+        setup_retry = RetryPolicy(retry_statuses=AUTH_RETRY_STATUSES)
         container = retry_function(
-            lambda: self.cloud.get_container(self.container))
+            lambda: self.cloud.get_container(self.container), setup_retry)
         if not container:
             retry_function(
                 lambda: self.cloud.create_container(
-                    name=self.container, public=public))
+                    name=self.container, public=public), setup_retry)
             headers = {'X-Container-Meta-Web-Index': 'index.html',
                        'X-Container-Meta-Access-Control-Allow-Origin': '*'}
             retry_function(
                 lambda: self.cloud.update_container(
                     name=self.container,
-                    headers=headers))
+                    headers=headers), setup_retry)
             # 'X-Container-Meta-Web-Listings': 'true'
 
             # The ceph radosgw swift implementation requires an
@@ -129,16 +256,18 @@ class Uploader():
                                                  name='index.html',
                                                  data='',
                                                  content_type='text/html',
-                                                 **index_headers))
+                                                 **index_headers),
+                setup_retry)
 
             # Enable the CDN in rax
             if cdn_url:
-                retry_function(lambda: self.cloud.session.put(cdn_url))
+                retry_function(lambda: self.cloud.session.put(cdn_url),
+                               setup_retry)
 
         if cdn_url:
             endpoint = retry_function(
                 lambda: self.cloud.session.head(
-                    cdn_url).headers['X-Cdn-Ssl-Uri'])
+                    cdn_url).headers['X-Cdn-Ssl-Uri'], setup_retry)
             container = endpoint
         else:
             endpoint = self.cloud.object_store.get_endpoint()
@@ -148,111 +277,326 @@ class Uploader():
         self.url = os.path.join(self.endpoint, self.path)
 
     def upload(self, file_list):
-        """Spin up thread pool to upload to swift"""
+        """Upload the file list to swift using the upload engine"""
 
         if self.dry_run:
             return
 
-        num_threads = min(len(file_list), MAX_UPLOAD_THREADS)
-        threads = []
-        # Keep track on upload failures
-        failures = []
+        if self.journal is not None:
+            # Lazily, file_list may be a pipelined scan
+            file_list = (f for f in file_list if not self.journal.is_done(
+                self._journal_name(f), f))
+
         if self.archive_mode:
-            fp = tempfile.NamedTemporaryFile(
-                suffix='.tar.gz', delete=False)
-            fp.close()
-            tar = tarfile.open(fp.name, "w:gz")
-            for file in file_list:
-                try:
-                    if file.full_path:
-                        tar.add(
-                            file.full_path,
-                            arcname=file.relative_path,
-                        )
-                except Exception as ex:
-                    failures.append({
-                        "file": file.full_path,
-                        "error": "Error appending {}: {}".format(
-                            file.relative_path, ex)
-                    })
-            tar.close()
-            failures.extend(self.post_archive(fp.name))
-            os.remove(fp.name)
+            file_list = list(file_list)
+            if self.archive_max_file_size:
+                return self._upload_hybrid(file_list)
+            if self.archive_shards > 1:
+                return self._upload_archive_shards(file_list)
+            if self.stream_archive:
+                failures = retry_function(
+                    lambda: self._upload_archive_stream(file_list),
+                    self.engine.retry_policy)
+            else:
+                failures = self._upload_archive(file_list)
+            if not failures:
+                self._record(file_list)
             return failures
 
-        queue = queuelib.Queue()
-        # add items to queue
-        for f in file_list:
-            queue.put(f)
+        if self.transport == 'asyncio':
+            return asyncio.run(self._upload_async(file_list))
 
-        for x in range(num_threads):
-            t = threading.Thread(
-                target=self.post_thread, args=(queue, failures)
-            )
-            threads.append(t)
-            t.start()
+        return self._upload_objects(file_list)
 
-        for t in threads:
-            t.join()
+    def _journal_name(self, file_detail):
+        return os.path.join(self.path, file_detail.relative_path)
 
-        return failures
+    def _record(self, files, etag=None):
+        """Record uploaded files in the journal, if any"""
+        if self.journal is None:
+            return
+        for file_detail in files:
+            self.journal.done(self._journal_name(file_detail), file_detail,
+                              etag)
 
-    def post_archive(self, name):
+    def _upload_objects(self, items):
+        """Upload files, archive shards and segments on the engine
+
+        Files bigger than segment_size are replaced by their segments,
+        their Static Large Object manifests are written once all of
+        their segments are uploaded.
+        """
         failures = []
-        with open(name, 'rb') as f:
-            headers = {
-                "X-Detect-Content-Type": "true",
-                "Content-Type": "application/gzip",
-                "Accept": "application/json"
-            }
 
-            if self.delete_after:
-                headers['x-delete-after'] = str(self.delete_after)
+        def post(item):
+            if isinstance(item, ArchiveShard):
+                errors = self._post_shard(item)
+                failures.extend(errors)
+                if not errors:
+                    self._record(item.files)
+            elif isinstance(item, Segment):
+                self._post_segment(item)
+            else:
+                self._record([item], self._post_file(item))
+
+        segmented_files = []
+
+        def objects():
+            # Lazily, items may be a pipelined scan
+            for item in items:
+                if (self.segment_size and item.size > self.segment_size and
+                    not item.folder):
+                    segmented_file = SegmentedFile(item, self.segment_size)
+                    segmented_files.append(segmented_file)
+                    for segment in segmented_file.segments:
+                        yield segment
+                else:
+                    yield item
+
+        failures.extend(self.engine.run(
+            post, objects(), on_failure=self._describe_failure))
+        complete = [f for f in segmented_files
+                    if all(segment.done for segment in f.segments)]
+        failures.extend(self.engine.run(
+            self._post_manifest, complete,
+            on_failure=self._describe_failure))
+        return failures
+
+    def _segment_name(self, segment):
+        return os.path.join(self.prefix, '.segments',
+                            segment.file_detail.relative_path,
+                            '%08d' % segment.index)
+
+    def _post_segment(self, segment):
+        file_detail = segment.file_detail
+        _, _, encoding, level = self._object_details(file_detail,
+                                                     segmented=True)
+        headers = {}
+        if self.delete_after:
+            headers['x-delete-after'] = str(self.delete_after)
+        with file_detail.open() as f:
+            f.seek(segment.offset)
+            data = FileSegment(f, segment.size)
+            if level:
+                # Every segment is encoded on its own, their
+                # concatenation is still a valid encoded stream.
+                data = EncodingFilter(data, encoding, segment.size, level,
+                                      metrics=self.engine.metrics)
             response = self.cloud.object_store.put(
-                "{}/{}?extract-archive=tar.gz".format(
-                    self.container,
-                    self.prefix,
-                ),
+                '{}/{}'.format(self.container,
+                               urlparse.quote(self._segment_name(segment))),
                 headers=headers,
-                data=f
+                data=data
             )
-            errors = response.json().get('Errors')
-            for error in errors:
-                failures.append({
-                    "file": error[0],
-                    "error": error[1]})
+        segment.etag = response.headers.get('etag', '').strip('"') or None
+        segment.done = True
 
-        return failures
+    def _post_manifest(self, segmented_file):
+        relative_path, headers, _, _ = self._object_details(
+            segmented_file.file_detail, segmented=True)
+        manifest = [{
+            'path': '/{}/{}'.format(self.container,
+                                    self._segment_name(segment)),
+            'etag': segment.etag,
+            'size_bytes': None,
+        } for segment in segmented_file.segments]
+        response = self.cloud.object_store.put(
+            '{}/{}?multipart-manifest=put'.format(
+                self.container, urlparse.quote(relative_path)),
+            headers=headers,
+            data=json.dumps(manifest)
+        )
+        self._record([segmented_file.file_detail],
+                     response.headers.get('etag', '').strip('"') or None)
+
+    def _get_ssl_context(self):
+        config = self.cloud.config.config
+        if not config.get('verify', True):
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return context
+        return ssl.create_default_context(cafile=config.get('cacert'))
+
+    async def _upload_async(self, file_list):
+        endpoint = self.cloud.object_store.get_endpoint()
+        ssl_context = None
+        if endpoint.startswith('https://'):
+            ssl_context = self._get_ssl_context()
+        pool = AsyncHTTPConnectionPool(endpoint,
+                                       maxsize=self.engine.concurrency,
+                                       ssl_context=ssl_context)
 
-    def post_thread(self, queue, failures):
-        while True:
+        async def post(file_detail):
+            self._record([file_detail],
+                         await self._post_file_async(pool, file_detail))
+
+        try:
+            return await self.engine.run_async(
+                post, file_list, on_failure=self._describe_failure)
+        finally:
+            pool.close()
+
+    @staticmethod
+    def _add_to_archive(tar, file_list, failures):
+        for file in file_list:
             try:
-                file_detail = queue.get_nowait()
-                logging.debug("%s: processing job %s",
-                              threading.current_thread(),
-                              file_detail)
-                retry_function(lambda: self._post_file(file_detail))
-            except requests.exceptions.RequestException as e:
-                msg = "Error posting file after multiple attempts"
-                # Do our best to attempt to upload all the files
-                logging.exception(msg)
+                if file.content is not None:
+                    info = tarfile.TarInfo(file.relative_path)
+                    info.size = file.size
+                    info.mtime = calendar.timegm(file.last_modified)
+                    with file.open() as f:
+                        tar.addfile(info, f)
+                elif file.full_path:
+                    # Folders are part of the file list on their own,
+                    # adding them recursively would duplicate their content
+                    tar.add(
+                        file.full_path,
+                        arcname=file.relative_path,
+                        recursive=False,
+                    )
+            except BrokenPipeError:
+                # The archive is streamed and its reader went away, no
+                # other file can be added either
+                raise
+            except Exception as ex:
                 failures.append({
-                    "file": file_detail.filename,
-                    "error": "{}: {}".format(msg, e)
+                    "file": file.full_path,
+                    "error": "Error appending {}: {}".format(
+                        file.relative_path, ex)
                 })
-                continue
-            except IOError as e:
-                msg = "Error opening file"
-                # Do our best to attempt to upload all the files
-                logging.exception(msg)
-                failures.append({
-                    "file": file_detail.filename,
-                    "error": "{}: {}".format(msg, e)
-                })
-                continue
-            except queuelib.Empty:
-                # No more work to do
-                return
+
+    def _upload_archive_shards(self, file_list, large_files=()):
+        """Upload the file list as several archives in parallel
+
+        Each archive is extracted by its own bulk request, which spreads
+        the upload over several connections and extraction workers.
+        Files in large_files are uploaded as single objects alongside.
+        """
+        shards = [
+            ArchiveShard(index, files) for index, files in
+            enumerate(split_file_list(file_list, self.archive_shards))
+            if files
+        ]
+        # Start with the biggest files, so they do not end up last
+        items = sorted(large_files, key=lambda f: -f.size) + shards
+        return self._upload_objects(items)
+
+    def _upload_hybrid(self, file_list):
+        """Archive the small files, upload the big ones as objects"""
+        small_files = []
+        large_files = []
+        for f in file_list:
+            if f.folder or f.size <= self.archive_max_file_size:
+                small_files.append(f)
+            else:
+                large_files.append(f)
+        return self._upload_archive_shards(small_files, large_files)
+
+    def _post_shard(self, shard):
+        if self.stream_archive:
+            return self._upload_archive_stream(shard.files)
+        return self._upload_archive(shard.files)
+
+    def _upload_archive(self, file_list):
+        # Keep track on upload failures
+        failures = []
+        fp = tempfile.NamedTemporaryFile(
+            suffix='.tar.gz', delete=False)
+        fp.close()
+        tar = tarfile.open(fp.name, "w:gz")
+        self._add_to_archive(tar, file_list, failures)
+        tar.close()
+        failures.extend(self.post_archive(fp.name))
+        os.remove(fp.name)
+        return failures
+
+    def _upload_archive_stream(self, file_list):
+        """Upload the file list as a tar.gz built while it is sent"""
+        failures = []
+        data = self._stream_archive(file_list, failures)
+        try:
+            errors = self._post_archive_data(data)
+        finally:
+            # Stops the archive writer if the upload was aborted
+            data.close()
+        return failures + errors
+
+    def _stream_archive(self, file_list, failures):
+        """Generate the chunks of a tar.gz of the file list
+
+        The archive is written by a thread into a pipe, which holds it
+        back while the upload does not keep up, so it never hits the
+        disk nor piles up in memory.
+        """
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb')
+        writer = os.fdopen(write_fd, 'wb')
+
+        def write_archive():
+            try:
+                with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+                    self._add_to_archive(tar, file_list, failures)
+                writer.close()
+            except (IOError, OSError):
+                # The reading side went away, the upload was aborted
+                logging.debug("Archive stream closed before completion")
+                try:
+                    writer.close()
+                except (IOError, OSError):
+                    pass
+
+        t = threading.Thread(target=write_archive)
+        t.daemon = True
+        t.start()
+        try:
+            for chunk in iter(lambda: reader.read(STREAM_CHUNK_SIZE), b''):
+                yield chunk
+        finally:
+            reader.close()
+            t.join()
+
+    def post_archive(self, name):
+        with open(name, 'rb') as f:
+            return self._post_archive_data(f)
+
+    def _post_archive_data(self, data):
+        failures = []
+        headers = {
+            "X-Detect-Content-Type": "true",
+            "Content-Type": "application/gzip",
+            "Accept": "application/json"
+        }
+
+        if self.delete_after:
+            headers['x-delete-after'] = str(self.delete_after)
+        response = self.cloud.object_store.put(
+            "{}/{}?extract-archive=tar.gz".format(
+                self.container,
+                self.prefix,
+            ),
+            headers=headers,
+            data=data
+        )
+        errors = response.json().get('Errors')
+        for error in errors:
+            failures.append({
+                "file": error[0],
+                "error": error[1]})
+        return failures
+
+    @staticmethod
+    def _describe_failure(file_detail, error):
+        if isinstance(error, requests.exceptions.RequestException):
+            msg = "Error posting file after multiple attempts"
+        elif isinstance(error, IOError):
+            msg = "Error opening file"
+        else:
+            msg = "Error uploading file"
+        return {
+            "file": file_detail.filename,
+            "error": "{}: {}".format(msg, error)
+        }
 
     @staticmethod
     def _is_text_type(mimetype):
@@ -270,7 +614,13 @@ class Uploader():
             return True
         return False
 
-    def _post_file(self, file_detail):
+    def _object_details(self, file_detail, segmented=False):
+        """Return the object name, its headers, encoding and level
+
+        The level is 0 when the file is uploaded as it is.  Segmented
+        files are gzipped when their segments can not be encoded
+        separately with the configured encoding.
+        """
         relative_path = os.path.join(self.prefix, file_detail.relative_path)
         headers = {}
         if self.delete_after:
@@ -278,38 +628,170 @@ class Uploader():
         headers['content-type'] = file_detail.mimetype
         # This is required for Rackspace CDN
         headers['access-control-allow-origin'] = '*'
+        encoding = self.content_encoding
+        if segmented and not get_content_encoder(encoding).concatenable:
+            encoding = 'gzip'
+        level = 0
 
         if not file_detail.folder:
             if (file_detail.encoding is None and
                 self._is_text_type(file_detail.mimetype)):
-                headers['content-encoding'] = 'gzip'
-                data = GzipFilter(open(file_detail.full_path, 'rb'))
-            else:
-                if (not file_detail.filename.endswith(".gz") and
-                    file_detail.encoding):
-                    # Don't apply gzip encoding to files that we receive as
-                    # already gzipped. The reason for this is swift will
-                    # serve this back to users as an uncompressed file if they
-                    # don't set an accept-encoding that includes gzip. This
-                    # can cause problems when the desired file state is
-                    # compressed as with .tar.gz tarballs.
-                    headers['content-encoding'] = file_detail.encoding
-                data = open(file_detail.full_path, 'rb')
+                level = self.compression.compression_level(file_detail)
+            if level:
+                headers['content-encoding'] = encoding
+            elif (not file_detail.filename.endswith(".gz") and
+                  file_detail.encoding):
+                # Don't apply gzip encoding to files that we receive as
+                # already gzipped. The reason for this is swift will
+                # serve this back to users as an uncompressed file if they
+                # don't set an accept-encoding that includes gzip. This
+                # can cause problems when the desired file state is
+                # compressed as with .tar.gz tarballs.
+                headers['content-encoding'] = file_detail.encoding
         else:
-            data = ''
             relative_path = relative_path.rstrip('/')
             if relative_path == '':
                 relative_path = '/'
-        self.cloud.create_object(self.container,
-                                 name=relative_path,
-                                 data=data,
-                                 **headers)
+        return relative_path, headers, encoding, level
+
+    def _dedups(self, file_detail, encoding):
+        """Whether to upload a file as a link to a shared blob"""
+        return (self.dedup_index is not None and
+                not file_detail.folder and
+                file_detail.content is None and
+                file_detail.size >= self.dedup_min_size and
+                not self.compression.line_index(file_detail, encoding))
+
+    def _post_link(self, file_detail, relative_path, headers, encoding,
+                   level):
+        """Upload a file as a symlink to its content-addressed blob
+
+        The blob is named after the digest of the content and of the
+        headers it is served with.  It is only uploaded when the dedup
+        index does not know it, or knows it expires before the link
+        would, and is kept longer than the link.
+
+        The digest has to be known before uploading to skip the blobs
+        the index knows, so new blobs are read twice: once to hash them
+        and once to upload them, usually from the page cache by then.
+        Known blobs are only read once.
+        """
+        salt = '%s\0%s\0' % (headers['content-type'],
+                             headers.get('content-encoding', ''))
+        blob = '%s/%s' % (DEDUP_BLOB_PREFIX,
+                          file_digest(file_detail, salt.encode('utf-8')))
+        target = '%s/%s' % (self.container, blob)
+        now = time.time()
+        until = None
+        if self.delete_after:
+            until = now + self.delete_after
+        if not self.dedup_index.has(target, until):
+            blob_headers = dict(headers)
+            expires = None
+            if self.delete_after:
+                lifetime = self.delete_after * DEDUP_BLOB_LIFETIME_FACTOR
+                blob_headers['x-delete-after'] = str(lifetime)
+                expires = now + lifetime
+            if level:
+                data = EncodingFilter(file_detail.open(),
+                                      encoding, file_detail.size, level,
+                                      metrics=self.engine.metrics)
+            else:
+                data = file_detail.open()
+            self.cloud.create_object(self.container,
+                                     name=blob,
+                                     data=data,
+                                     **blob_headers)
+            self.dedup_index.add(target, expires)
+        # Swift serves the blob with its own content-encoding
+        link_headers = dict((k, v) for k, v in headers.items()
+                            if k != 'content-encoding')
+        link_headers['x-symlink-target'] = urlparse.quote(target)
+        return self.cloud.create_object(self.container,
+                                        name=relative_path,
+                                        data='',
+                                        **link_headers)
+
+    @staticmethod
+    def _etag(obj):
+        # The SDK returns no object for large objects
+        etag = getattr(obj, 'etag', None)
+        return etag if isinstance(etag, str) else None
+
+    def _post_file(self, file_detail):
+        """Upload a file, returning the ETag of the object if known"""
+        relative_path, headers, encoding, level = self._object_details(
+            file_detail)
+        if self._dedups(file_detail, encoding):
+            return self._etag(self._post_link(
+                file_detail, relative_path, headers, encoding, level))
+        line_index = False
+        if file_detail.folder:
+            data = ''
+        elif level:
+            line_index = self.compression.line_index(file_detail, encoding)
+            data = EncodingFilter(file_detail.open(),
+                                  encoding, file_detail.size, level,
+                                  line_index=line_index,
+                                  metrics=self.engine.metrics)
+        else:
+            data = file_detail.open()
+        obj = self.cloud.create_object(self.container,
+                                       name=relative_path,
+                                       data=data,
+                                       **headers)
+        if line_index:
+            self._post_file(make_line_index_file(file_detail,
+                                                 data.encodedfile))
+        return self._etag(obj)
+
+    async def _post_file_async(self, pool, file_detail):
+        relative_path, headers, encoding, level = self._object_details(
+            file_detail)
+        headers['x-auth-token'] = self.cloud.auth_token
+        path = '/%s/%s' % (urlparse.quote(self.container),
+                           urlparse.quote(relative_path.lstrip('/')))
+        f = None
+        line_index = False
+        if file_detail.folder:
+            data = b''
+        else:
+            f = file_detail.open()
+            if level:
+                line_index = self.compression.line_index(file_detail,
+                                                         encoding)
+                data = EncodingFilter(f, encoding, file_detail.size, level,
+                                      line_index=line_index,
+                                      metrics=self.engine.metrics)
+            else:
+                data = f
+        try:
+            response = await pool.request('PUT', path, headers, data)
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            if f:
+                f.close()
+        if not response.ok:
+            raise requests.exceptions.HTTPError(
+                "%s %s for object %s" % (response.status, response.reason,
+                                         relative_path), response=response)
+        if line_index:
+            await self._post_file_async(
+                pool, make_line_index_file(file_detail, data.encodedfile))
+        return response.headers.get('etag', '').strip('"') or None
 
 
 def run(cloud, container, files,
         indexes=True, parent_links=True, topdir_parent_link=False,
         partition=False, footer='index_footer.html', delete_after=15552000,
-        prefix=None, public=True, archive_mode=False, dry_run=False):
+        prefix=None, public=True, archive_mode=False, dry_run=False,
+        concurrency=None, transport='threads', stream_archive=False,
+        archive_shards=1, archive_max_file_size=None, segment_size=None,
+        content_encoding='gzip', dedup_index=None, dedup_min_size=None,
+        **options):
+
+    check_transport_options(transport, segment_size, dedup_index)
 
     if prefix:
         prefix = prefix.lstrip('/')
@@ -319,29 +801,38 @@ def run(cloud, container, files,
             container += '_' + parts[0]
             prefix = '/'.join(parts[1:])
 
-    # Create the objects to make sure the arguments are sound.
-    with FileList() as file_list:
-        # Scan the files.
-        for file_path in files:
-            file_list.add(file_path)
-
-        indexer = Indexer(file_list)
-
-        # (Possibly) make indexes.
-        if indexes:
-            indexer.make_indexes(create_parent_links=parent_links,
-                                 create_topdir_parent_link=topdir_parent_link,
-                                 append_footer=footer)
+    if not concurrency:
+        if transport == 'asyncio':
+            concurrency = ASYNC_MAX_UPLOADS
+        else:
+            concurrency = MAX_UPLOAD_THREADS
+    if archive_mode:
+        # The archives are built from the complete file list
+        options['pipeline'] = False
 
-        logging.debug("List of files prepared to upload:")
-        for x in file_list:
-            logging.debug(x)
+    def make_uploader(engine, compression, journal):
+        return Uploader(cloud, container, prefix, delete_after,
+                        public, archive_mode, dry_run, engine,
+                        transport, stream_archive, archive_shards,
+                        archive_max_file_size, segment_size,
+                        compression, content_encoding,
+                        DedupIndex(dedup_index) if dedup_index else None,
+                        journal,
+                        DEDUP_MIN_SIZE if dedup_min_size is None
+                        else dedup_min_size)
 
-        # Upload.
-        uploader = Uploader(cloud, container, prefix, delete_after,
-                            public, archive_mode, dry_run)
-        upload_failures = uploader.upload(file_list)
-        return uploader.url, uploader.endpoint, uploader.path, upload_failures
+    (uploader, upload_failures, compression_levels, concurrency_control,
+     report) = run_upload(files, make_uploader,
+                          indexes=indexes,
+                          parent_links=parent_links,
+                          topdir_parent_link=topdir_parent_link,
+                          footer=footer,
+                          concurrency=concurrency,
+                          **options)
+    if uploader.dedup_index is not None:
+        uploader.dedup_index.save()
+    return (uploader.url, uploader.endpoint, uploader.path,
+            upload_failures, compression_levels, concurrency_control, report)
 
 
 def ansible_main():
@@ -359,13 +850,29 @@ def ansible_main():
             delete_after=dict(type='int'),
             prefix=dict(type='str'),
             archive_mode=dict(type='bool', default=False),
+            stream_archive=dict(type='bool', default=False),
+            archive_shards=dict(type='int', default=1),
+            archive_max_file_size=dict(type='int'),
+            segment_size=dict(type='int'),
+            concurrency=dict(type='int'),
+            transport=dict(type='str', default='threads',
+                           choices=['threads', 'asyncio']),
+            dedup_index=dict(type='path'),
+            dedup_min_size=dict(type='int'),
+            **upload_argument_spec()
         )
     )
 
     p = module.params
+    try:
+        check_transport_options(p.get('transport'), p.get('segment_size'),
+                                p.get('dedup_index'))
+    except ValueError as e:
+        module.fail_json(changed=False, msg=str(e))
     cloud = get_cloud(p.get('cloud'))
     try:
-        url, endpoint, path, upload_failures = run(
+        (url, endpoint, path, upload_failures, compression_levels,
+         concurrency_control, metrics) = run(
             cloud, p.get('container'), p.get('files'),
             indexes=p.get('indexes'),
             parent_links=p.get('parent_links'),
@@ -375,7 +882,17 @@ def ansible_main():
             delete_after=p.get('delete_after', 15552000),
             prefix=p.get('prefix'),
             public=p.get('public'),
-            archive_mode=p.get('archive_mode')
+            archive_mode=p.get('archive_mode'),
+            stream_archive=p.get('stream_archive'),
+            archive_shards=p.get('archive_shards'),
+            archive_max_file_size=p.get('archive_max_file_size'),
+            segment_size=p.get('segment_size'),
+            concurrency=p.get('concurrency'),
+            transport=p.get('transport'),
+            dedup_index=p.get('dedup_index'),
+            dedup_min_size=p.get('dedup_min_size'),
+            content_encoding=p.get('content_encoding'),
+            **upload_options(p)
         )
     except (keystoneauth1.exceptions.http.HttpError,
             requests.exceptions.RequestException):
@@ -393,6 +910,10 @@ def ansible_main():
         endpoint=endpoint,
         path=path,
         upload_failures=upload_failures,
+        compression_levels=compression_levels,
+        concurrency_control=concurrency_control,
+        metrics=metrics,
+        content_encoding=p.get('content_encoding'),
     )
 
 
@@ -428,7 +949,47 @@ def cli_main():
                              'uploading')
     parser.add_argument('--archive_mode', action='store_true',
                         help='Upload all files as archive. '
-                             'Use only when swift supports that')
+                             'Use only when swift supports that. '
+                             '--pipeline is ignored with it')
+    parser.add_argument('--stream-archive', action='store_true',
+                        help='With --archive_mode, upload the archive while '
+                             'it is being built instead of writing it to a '
+                             'temporary file first')
+    parser.add_argument('--archive-shards', default=1, type=int,
+                        help='With --archive_mode, split the files into this '
+                             'many archives of about the same size and '
+                             'upload them in parallel')
+    parser.add_argument('--archive-max-file-size', type=int,
+                        help='With --archive_mode, upload files bigger than '
+                             'this many bytes as single objects in parallel '
+                             'to the archives')
+    parser.add_argument('--segment-size', type=int,
+                        help='Upload files bigger than this many bytes as '
+                             'Static Large Objects made of segments of this '
+                             'size, which are uploaded in parallel. Not '
+                             'supported with --transport asyncio')
+    parser.add_argument('--concurrency', type=int,
+                        help='Number of files to upload in parallel. '
+                             'Default is %d, or %d with the asyncio '
+                             'transport' % (MAX_UPLOAD_THREADS,
+                                            ASYNC_MAX_UPLOADS))
+    parser.add_argument('--transport', default='threads',
+                        choices=['threads', 'asyncio'],
+                        help='Upload files from a pool of threads or from '
+                             'a single asyncio event loop over keep-alive '
+                             'connections, as single objects')
+    parser.add_argument('--dedup-index',
+                        help='Upload files once to content-addressed blobs '
+                             'linked to with Swift symlinks, recording the '
+                             'uploaded blobs in this local JSON file. '
+                             'Ignored with --archive_mode, except for the '
+                             'files bigger than --archive-max-file-size. '
+                             'Not supported with --transport asyncio')
+    parser.add_argument('--dedup-min-size', type=int,
+                        help='Upload files smaller than this, in bytes, '
+                             'as they are with --dedup-index (default %d)'
+                             % DEDUP_MIN_SIZE)
+    add_upload_arguments(parser)
     parser.add_argument('--dry-run', action='store_true',
                         help='do not attempt to create containers or upload, '
                              'useful with --verbose for debugging')
@@ -450,11 +1011,17 @@ def cli_main():
         # logging.getLogger("stevedore").setLevel(logging.INFO)
         logging.captureWarnings(True)
 
+    try:
+        check_transport_options(args.transport, args.segment_size,
+                                args.dedup_index)
+    except ValueError as e:
+        parser.error(str(e))
+
     append_footer = args.append_footer
     if append_footer.lower() == 'none':
         append_footer = None
 
-    _, _, path, _ = run(
+    _, _, path, _, _, _, _ = run(
         get_cloud(args.cloud), args.container, args.files,
         indexes=not args.no_indexes,
         parent_links=not args.no_parent_links,
@@ -464,7 +1031,18 @@ def cli_main():
         delete_after=args.delete_after,
         prefix=args.prefix,
         public=not args.no_public,
-        dry_run=args.dry_run
+        archive_mode=args.archive_mode,
+        stream_archive=args.stream_archive,
+        archive_shards=args.archive_shards,
+        archive_max_file_size=args.archive_max_file_size,
+        segment_size=args.segment_size,
+        dry_run=args.dry_run,
+        concurrency=args.concurrency,
+        transport=args.transport,
+        dedup_index=args.dedup_index,
+        dedup_min_size=args.dedup_min_size,
+        content_encoding=args.content_encoding,
+        **upload_options(vars(args))
     )
     print(path)
 
@@ -22,15 +22,48 @@ __metaclass__ = type
 Generic utilities used for log upload.
 """
 
+import asyncio
+import calendar
+import concurrent.futures
+import cProfile
+import email.utils
 import gzip
+import hashlib
+import heapq
 import io
+import itertools
+import json
 import logging
+import math
 import mimetypes
 import os
+import pstats
+import random
 import shutil
+import socket
+import ssl
 import stat
+import struct
+import sys
 import tempfile
+import threading
 import time
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import queue as queuelib
+except ImportError:
+    import Queue as queuelib
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -49,7 +82,75 @@ mimetypes.init()
 mimetypes.add_type('text/plain', '.yaml')
 
 MAX_UPLOAD_THREADS = 24
+# Number of concurrent requests when uploading with asyncio
+ASYNC_MAX_UPLOADS = 100
+# Upper bound of the summed size of the files an UploadEngine uploads at
+# the same time.
+MAX_INFLIGHT_BYTES = 1024 * 1024 * 1024
 POST_ATTEMPTS = 3
+# Failed attempts are retried after a random delay of up to
+# RETRY_BASE_DELAY seconds, doubled with every attempt up to
+# RETRY_MAX_DELAY.  A Retry-After sent with the error is honored up to
+# RETRY_AFTER_MAX_DELAY seconds.
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+RETRY_AFTER_MAX_DELAY = 300
+# Retries an upload may do at once, refilled by RETRY_BUDGET_RATIO for
+# every successful attempt.
+RETRY_BUDGET = 20
+RETRY_BUDGET_RATIO = 0.1
+# HTTP statuses worth retrying, any other error status is permanent.
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+# Some clouds, like rax, intermittently reject valid tokens, so calls
+# setting up a container also retry authentication failures.
+AUTH_RETRY_STATUSES = RETRY_STATUSES | frozenset([401])
+# With adaptive concurrency, the number of concurrent uploads is cut by
+# this factor when the object store throttles (these HTTP statuses) or
+# times out.
+CONCURRENCY_DECREASE_FACTOR = 0.5
+THROTTLE_STATUSES = frozenset([429, 503])
+TIMEOUT_STATUSES = frozenset([408, 504])
+# Uploads taking more than this many times the best time seen per
+# LATENCY_SIZE_UNIT bytes do not let the concurrency grow.
+CONCURRENCY_LATENCY_TOLERANCE = 4
+LATENCY_SIZE_UNIT = 1024 * 1024
+# Changes of the concurrency recorded for the module result
+CONCURRENCY_MAX_DECISIONS = 100
+# Number of the slowest objects listed in the metrics report
+METRICS_SLOWEST_OBJECTS = 10
+# Profiles of an upload are uploaded next to the logs under this name,
+# with an extension depending on the profiler.  The environment
+# variable selects the profiler when the module is not told to.
+PROFILE_NAME = 'zuul-upload-profile'
+PROFILE_ENV = 'ZUUL_UPLOAD_PROFILE'
+# Seconds between the samples of the sampling profiler
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Errors which fail the same way when tried again
+FATAL_ERRORS = (AttributeError, KeyError, NotImplementedError, TypeError,
+                ValueError)
+# Files from this size on are compressed by ParallelGZIPCompressedStream
+PARALLEL_GZIP_MIN_SIZE = 64 * 1024 * 1024
+# The start of a file compressed to estimate how well it compresses.  The
+# estimate is not trusted for files smaller than the minimum.
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_SAMPLE_SIZE = 4096
+# Files whose sample does not shrink by at least this fraction are
+# uploaded uncompressed.
+MIN_COMPRESSION_GAIN = 0.1
+# The line index of a file is uploaded next to it with this suffix.
+LINE_INDEX_SUFFIX = '.lines.json'
+# Deduplicated blobs are kept this many times longer than the objects
+# linking to them, so they are only uploaded again once in a while.
+DEDUP_BLOB_LIFETIME_FACTOR = 2
+# Index pages are kept in memory up to this size, the rest is written
+# to a single spill file.
+INDEX_MAX_MEMORY = 64 * 1024 * 1024
+# Gzip level by CPU budget, as (files up to this size, level) pairs.
+COMPRESSION_LEVELS = {
+    'low': ((1024 * 1024, 6), (None, 1)),
+    'medium': ((16 * 1024 * 1024, 9), (256 * 1024 * 1024, 6), (None, 1)),
+    'high': ((256 * 1024 * 1024, 9), (None, 6)),
+}
 
 # Map mime types to apache icons
 APACHE_MIME_ICON_MAP = {
@@ -217,23 +318,1409 @@ class GZIPCompressedStream(io.RawIOBase):
 # End vendored code
 
 
-def get_mime_icon(mime, filename=''):
-    icon = (APACHE_FILE_ICON_MAP.get(filename) or
+class ZeroCopyGZIPCompressedStream(io.RawIOBase):
+    """Read a stream gzipped, with as few copies as possible
+
+    This drives zlib directly instead of going through gzip.GzipFile and
+    a BytesIO like GZIPCompressedStream does.  The input is read with
+    readinto into a buffer which is reused, and the compressed data is
+    handed out through a memoryview, so it is only copied into the
+    caller's buffer.  The input chunk size doubles, up to
+    max_chunk_size, as long as the stream fills it.
+    """
+    min_chunk_size = 64 * 1024
+    max_chunk_size = 1024 * 1024
+
+    def __init__(self, stream, compression_level=9):
+        assert 1 <= compression_level <= 9
+
+        self._compression_level = compression_level
+        self._stream = stream
+        self._compressor = zlib.compressobj(
+            compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._crc = 0
+        self._size = 0
+        self._chunk_size = self.min_chunk_size
+        self._input = bytearray(self._chunk_size)
+        xfl = 2 if compression_level == 9 else 0
+        self._output = memoryview(
+            struct.pack('<4sIBB', b'\x1f\x8b\x08\x00', 0, xfl, 255))
+        self._offset = 0
+        self._finished = False
+        self.count = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            r = self.readall()
+        elif len(self._output) - self._offset >= size:
+            # Skip the temporary buffer of RawIOBase.read
+            r = self._output[self._offset:self._offset + size].tobytes()
+            self._offset += size
+        else:
+            r = super().read(size)
+        self.count += len(r)
+        return r
+
+    def tell(self):
+        return self.count
+
+    @property
+    def compression_level(self):
+        return self._compression_level
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def readable(self):
+        return True
+
+    def _read_input(self):
+        readinto = getattr(self._stream, 'readinto', None)
+        if readinto is None:
+            return self._stream.read(self._chunk_size)
+        size = readinto(memoryview(self._input)[:self._chunk_size]) or 0
+        return memoryview(self._input)[:size]
+
+    def _compress_next(self):
+        data = self._read_input()
+        size = len(data)
+        if size:
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += size
+            output = self._compressor.compress(data)
+            if (size == self._chunk_size and
+                self._chunk_size < self.max_chunk_size):
+                self._chunk_size *= 2
+                self._input = bytearray(self._chunk_size)
+        else:
+            output = self._compressor.flush(zlib.Z_FINISH) + struct.pack(
+                '<II', self._crc & 0xffffffff, self._size & 0xffffffff)
+            self._finished = True
+        self._output = memoryview(output)
+        self._offset = 0
+
+    def readinto(self, b):
+        with memoryview(b) as view, view.cast('B') as b:
+            offset = 0
+            size = len(b)
+            while offset < size:
+                available = len(self._output) - self._offset
+                if available:
+                    n = min(available, size - offset)
+                    b[offset:offset + n] = \
+                        self._output[self._offset:self._offset + n]
+                    offset += n
+                    self._offset += n
+                elif self._finished:
+                    break
+                else:
+                    self._compress_next()
+            return offset
+
+    def __repr__(self):
+        return (
+            '{self.__class__.__name__}('
+            '{self.stream!r}, '
+            'compression_level={self.compression_level!r}'
+            ')'
+        ).format(self=self)
+
+
+# Threads of the compression pool shared by all parallel compressors
+COMPRESS_WORKERS = os.cpu_count() or 1
+_compress_executor = None
+_compress_executor_lock = threading.Lock()
+
+
+def get_compress_executor():
+    """Return the thread pool shared by all parallel compressors
+
+    It has one thread per CPU, however many files are compressed at
+    the same time.
+    """
+    global _compress_executor
+    with _compress_executor_lock:
+        if _compress_executor is None:
+            _compress_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=COMPRESS_WORKERS)
+        return _compress_executor
+
+
+def _deflate_block(data, compression_level, zdict):
+    if zdict:
+        compressor = zlib.compressobj(
+            compression_level, zlib.DEFLATED, -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(
+            compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if data:
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # The final, empty, block ends the deflate stream
+    return compressor.flush(zlib.Z_FINISH)
+
+
+class ParallelGZIPCompressedStream(io.RawIOBase):
+    """Gzip a stream using all CPUs, like pigz does
+
+    The input is cut in blocks which are deflated on the shared
+    compression thread pool; zlib releases the GIL while it works.
+    Every block is primed with the end of the previous one as
+    dictionary and ends with a sync flush, so the compressed blocks
+    simply concatenate into a single deflate stream, which is written
+    as one standard gzip member.
+
+    Another executor can be given with its number of workers, which
+    bounds the blocks read ahead.
+    """
+    block_size = 1024 * 1024
+
+    def __init__(self, stream, compression_level=9, executor=None,
+                 workers=None):
+        assert 1 <= compression_level <= 9
+
+        self._compression_level = compression_level
+        self._stream = stream
+        self._executor = executor or get_compress_executor()
+        # Blocks read ahead and being compressed, in order
+        self._pending = collections.deque()
+        self._max_pending = (workers or COMPRESS_WORKERS) + 1
+        self._zdict = None
+        self._crc = 0
+        self._size = 0
+        self._eof = False
+        self._trailer_written = False
+        xfl = 2 if compression_level == 9 else 0
+        self._buffer = struct.pack('<4sIBB', b'\x1f\x8b\x08\x00', 0, xfl, 255)
+        self._offset = 0
+        self.count = 0
+
+    def read(self, size=-1):
+        r = super().read(size)
+        self.count += len(r)
+        return r
+
+    def tell(self):
+        return self.count
+
+    @property
+    def compression_level(self):
+        return self._compression_level
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def readable(self):
+        return True
+
+    def _read_ahead(self):
+        while not self._eof and len(self._pending) < self._max_pending:
+            data = self._stream.read(self.block_size)
+            if data:
+                self._crc = zlib.crc32(data, self._crc)
+                self._size += len(data)
+            else:
+                self._eof = True
+            self._pending.append(self._executor.submit(
+                _deflate_block, data, self._compression_level, self._zdict))
+            # Deflate looks back 32 KiB at most
+            self._zdict = data[-32768:]
+
+    def _next_buffer(self):
+        self._read_ahead()
+        if self._pending:
+            return self._pending.popleft().result()
+        if not self._trailer_written:
+            self._trailer_written = True
+            return struct.pack('<II', self._crc & 0xffffffff,
+                               self._size & 0xffffffff)
+        return None
+
+    def readinto(self, b):
+        while self._offset >= len(self._buffer):
+            buf = self._next_buffer()
+            if buf is None:
+                return 0
+            self._buffer = buf
+            self._offset = 0
+        size = min(len(b), len(self._buffer) - self._offset)
+        b[:size] = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        super().close()
+
+
+class LineIndexedGZIPCompressedStream(ParallelGZIPCompressedStream):
+    """Gzip a text stream in chunks which inflate on their own
+
+    Blocks end with a line, unless the line is longer than a block, and
+    are deflated without dictionary, so each one is a byte-aligned piece
+    of the deflate stream that does not refer to anything before it.
+    The output is still a single standard gzip member, but a viewer can
+    fetch a range of it starting at a chunk and inflate it as raw
+    deflate data.  Once the stream is read, line_index() tells where
+    the chunks start.
+    """
+
+    def __init__(self, stream, compression_level=9, executor=None,
+                 workers=None):
+        super(LineIndexedGZIPCompressedStream, self).__init__(
+            stream, compression_level, executor, workers)
+        # (line, offset) where the pending blocks start, None for
+        # blocks starting in the middle of a line
+        self._starts = collections.deque()
+        self._lines = 0
+        self._at_line_start = True
+        self._compressed = len(self._buffer)
+        self.chunks = []
+
+    def _read_ahead(self):
+        while not self._eof and len(self._pending) < self._max_pending:
+            data = self._stream.read(self.block_size)
+            if data and not data.endswith(b'\n'):
+                # Finish the line, unless it is too long
+                data += self._stream.readline(self.block_size)
+            start = None
+            if data:
+                self._crc = zlib.crc32(data, self._crc)
+                if self._at_line_start:
+                    start = (self._lines + 1, self._size)
+                self._size += len(data)
+                self._lines += data.count(b'\n')
+                self._at_line_start = data.endswith(b'\n')
+            else:
+                self._eof = True
+            self._starts.append(start)
+            self._pending.append(self._executor.submit(
+                _deflate_block, data, self._compression_level, None))
+
+    def _next_buffer(self):
+        self._read_ahead()
+        if self._pending:
+            start = self._starts.popleft()
+            buf = self._pending.popleft().result()
+            if start:
+                self.chunks.append(start + (self._compressed,))
+            self._compressed += len(buf)
+            return buf
+        return super(LineIndexedGZIPCompressedStream, self)._next_buffer()
+
+    def line_index(self):
+        """Return the line index of the stream
+
+        chunks lists the (line, offset, compressed offset) of the start
+        of each chunk, line numbers counting from 1 and offsets in the
+        uncompressed and compressed data.  A chunk ends where the next
+        one starts.
+        """
+        return {
+            'encoding': 'gzip',
+            'lines': self._lines,
+            'size': self._size,
+            'chunks': self.chunks,
+        }
+
+
+def make_line_index_file(file_detail, stream):
+    """Return the FileDetail of the line index of a file
+
+    Args:
+        file_detail (FileDetail): The file the index is about.
+        stream (LineIndexedGZIPCompressedStream): The stream the file
+            was uploaded through, read to the end.
+    """
+    content = json.dumps(stream.line_index(), separators=(',', ':'))
+    return FileDetail.from_content(
+        file_detail.relative_path + LINE_INDEX_SUFFIX,
+        content.encode('utf-8'))
+
+
+def open_gzip_stream(stream, size=0, compression_level=9):
+    """Wrap stream in a file-like object reading it gzipped
+
+    Args:
+        stream: The file-like object to compress.
+        size (int): Size of the data, when known. Big inputs are
+                    compressed in parallel.
+        compression_level (int): The gzip level.
+    """
+    if size >= PARALLEL_GZIP_MIN_SIZE:
+        return ParallelGZIPCompressedStream(stream, compression_level)
+    return ZeroCopyGZIPCompressedStream(stream, compression_level)
+
+
+class CompressionPolicy():
+    """Choose how hard to compress each file
+
+    The level depends on the size of the file and on the CPU budget, as
+    level 9 on multi-GB logs takes minutes for a few percent of size.
+    Files which barely compress, like base64 blobs or minified JSON, are
+    not compressed at all.  The choices are kept in `levels`, indexed by
+    relative path, to be reported.  Gzipped files from
+    line_index_min_size on get a line index.
+    """
+
+    def __init__(self, cpu_budget='medium', min_gain=None,
+                 line_index_min_size=None):
+        if cpu_budget not in COMPRESSION_LEVELS:
+            raise ValueError("Unknown CPU budget %s" % cpu_budget)
+        self.cpu_budget = cpu_budget
+        if min_gain is None:
+            min_gain = MIN_COMPRESSION_GAIN
+        self.min_gain = min_gain
+        self.line_index_min_size = line_index_min_size
+        self.levels = {}
+        self._lock = threading.Lock()
+
+    def _level_for_size(self, size):
+        for max_size, level in COMPRESSION_LEVELS[self.cpu_budget]:
+            if max_size is None or size <= max_size:
+                return level
+
+    def _compresses(self, file_detail):
+        try:
+            with file_detail.open() as f:
+                sample = f.read(COMPRESSION_SAMPLE_SIZE)
+        except OSError:
+            # The upload reports the error
+            return True
+        if len(sample) < COMPRESSION_MIN_SAMPLE_SIZE:
+            return True
+        gain = 1 - len(zlib.compress(sample, 1)) / len(sample)
+        return gain >= self.min_gain
+
+    def line_index(self, file_detail, encoding):
+        """Whether to upload a compressed file with a line index"""
+        return (self.line_index_min_size is not None and
+                encoding == 'gzip' and
+                file_detail.content is None and
+                file_detail.size >= self.line_index_min_size)
+
+    def compression_level(self, file_detail):
+        """Return the gzip level of a file, 0 to not compress it"""
+        with self._lock:
+            level = self.levels.get(file_detail.relative_path)
+        if level is not None:
+            return level
+        if self._compresses(file_detail):
+            level = self._level_for_size(file_detail.size)
+        else:
+            level = 0
+        logging.debug("Compression level of %s: %s", file_detail, level)
+        with self._lock:
+            self.levels[file_detail.relative_path] = level
+        return level
+
+
+def get_mime_icon_name(mime, filename=''):
+    return (APACHE_FILE_ICON_MAP.get(filename) or
             APACHE_MIME_ICON_MAP.get(mime) or
             APACHE_MIME_ICON_MAP['_default'])
+
+
+def get_mime_icon(mime, filename=''):
+    icon = get_mime_icon_name(mime, filename)
     return "data:image/png;base64,%s" % ICON_IMAGES[icon]
 
 
-def retry_function(func):
-    for attempt in range(1, POST_ATTEMPTS + 1):
+def get_icon_class(icon):
+    """Return the CSS class showing an icon of ICON_IMAGES"""
+    return 'icon-' + os.path.splitext(icon)[0]
+
+
+def get_icon_style(icons):
+    """Return the CSS rules of the classes of some icons"""
+    rules = ['td.icon { width: 20px; height: 22px; '
+             'background-repeat: no-repeat; '
+             'background-position: center; }\n']
+    for icon in sorted(icons):
+        rules.append(
+            'td.%s { background-image: url(data:image/png;base64,%s); }\n'
+            % (get_icon_class(icon), ICON_IMAGES[icon]))
+    return ''.join(rules)
+
+
+def _error_status(error):
+    """The HTTP status of an error raised by requests, boto or google"""
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return status
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    for attr in ('status_code', 'status'):
+        status = getattr(response, attr, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status
+    return None
+
+
+def _error_retry_after(error):
+    """Seconds to wait that the server sent with an error, or None"""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders')
+    else:
+        headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class RetryPolicy():
+    """Decide whether and when a failed attempt is tried again
+
+    Errors with an HTTP status are retried when the status is one of
+    retry_statuses, other errors unless they are FATAL_ERRORS or about
+    a missing or unreadable local file.  Retries wait a random delay
+    with capped exponential backoff ("full jitter"), so threads failing
+    at the same time do not retry in lockstep, or the Retry-After the
+    server asked for.
+
+    All retries done with a policy draw from one budget, which stops
+    retrying when most attempts fail, like during an outage of the
+    object store, instead of multiplying the load on it.
+    """
+
+    def __init__(self, attempts=None, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, budget=RETRY_BUDGET,
+                 budget_ratio=RETRY_BUDGET_RATIO,
+                 retry_statuses=RETRY_STATUSES):
+        """
+        Args:
+            attempts (int): Attempts per call, including the first one.
+                            Defaults to POST_ATTEMPTS.
+            base_delay (float): Upper bound of the delay before the
+                                first retry, in seconds.
+            max_delay (float): Upper bound of any backoff delay.
+            budget (float): Retries which can be done at once.
+            budget_ratio (float): Retries earned by a successful attempt.
+            retry_statuses (set): HTTP statuses of errors to retry.
+        """
+        self.attempts = attempts or POST_ATTEMPTS
+        self.retry_statuses = retry_statuses
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self._tokens = budget
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def is_retryable(self, error):
+        status = _error_status(error)
+        if status is not None:
+            return status in self.retry_statuses
+        if isinstance(error, FATAL_ERRORS):
+            return False
+        # Failures to open the file to upload, not network errors
+        if isinstance(error, EnvironmentError) and error.filename:
+            return False
+        return True
+
+    def succeeded(self):
+        with self._lock:
+            self._tokens = min(self.budget, self._tokens + self.budget_ratio)
+
+    def retry_delay(self, attempt, error):
+        """Seconds to wait before retrying, or None to give up
+
+        Args:
+            attempt (int): The number of the attempt which failed.
+            error (Exception): The error it failed with.
+        """
+        if attempt >= self.attempts or not self.is_retryable(error):
+            return None
+        with self._lock:
+            if self._tokens < 1:
+                logging.warning("Retry budget exhausted, not retrying")
+                return None
+            self._tokens -= 1
+            self.retries += 1
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = _error_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, RETRY_AFTER_MAX_DELAY))
+        return delay
+
+
+def retry_function(func, policy=None):
+    policy = policy or RetryPolicy()
+    attempt = 1
+    while True:
         try:
-            return func()
-        except Exception:
-            if attempt >= POST_ATTEMPTS:
+            result = func()
+        except Exception as e:
+            delay = policy.retry_delay(attempt, e)
+            if delay is None:
                 raise
+            logging.exception("Error on attempt %d, retrying in %.1f "
+                              "seconds" % (attempt, delay))
+            time.sleep(delay)
+            attempt += 1
+        else:
+            policy.succeeded()
+            return result
+
+
+class UploadTimeout(Exception):
+    pass
+
+
+def default_failure(item, error):
+    return {
+        "file": item.filename,
+        "error": "{}".format(error)
+    }
+
+
+def _is_timeout(error):
+    if isinstance(error, (UploadTimeout, asyncio.TimeoutError,
+                          socket.timeout)):
+        return True
+    # requests, boto and google have timeout errors of their own
+    return type(error).__name__.endswith(('Timeout', 'TimeoutError'))
+
+
+class ConcurrencyController():
+    """Adapt the number of concurrent uploads to the object store
+
+    The limit grows additively and shrinks multiplicatively (AIMD), as
+    in TCP congestion control. It grows by one once as many uploads as
+    the limit succeeded at a healthy pace, and is cut by decrease_factor
+    when the object store throttles (THROTTLE_STATUSES) or an attempt
+    times out. Attempts which started before the last cut do not cut
+    it again, they were sent at the old limit.
+
+    The pace of an attempt is its time per LATENCY_SIZE_UNIT bytes,
+    smaller files counting as one unit. It is healthy within
+    latency_tolerance times the best pace seen, which creeps up by a
+    percent per attempt so that a slower path is eventually accepted.
+    """
+
+    def __init__(self, initial, maximum, minimum=1,
+                 decrease_factor=CONCURRENCY_DECREASE_FACTOR,
+                 latency_tolerance=CONCURRENCY_LATENCY_TOLERANCE):
+        """
+        Args:
+            initial (int): Concurrent uploads to start with.
+            maximum (int): Upper bound of the concurrent uploads.
+            minimum (int): Lower bound of the concurrent uploads.
+            decrease_factor (float): Factor the limit is cut by.
+            latency_tolerance (float): Factor of the best pace up to
+                                       which the limit still grows.
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.initial = min(max(self.minimum, initial), self.maximum)
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.decisions = []
+        self.increases = 0
+        self.decreases = 0
+        self._limit = float(self.initial)
+        self._successes = 0
+        self._best_pace = None
+        self._last_decrease = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def observe(self, started, latency, size=0, error=None):
+        """Adapt the limit to the outcome of an attempt
+
+        Args:
+            started (float): time.time() when the attempt started.
+            latency (float): Seconds the attempt took.
+            size (int): Bytes the attempt uploaded.
+            error (Exception): The error the attempt failed with, if any.
+        """
+        with self._lock:
+            if error is None:
+                self._succeeded(latency, size)
+                return
+            status = _error_status(error)
+            if status in THROTTLE_STATUSES:
+                reason = 'throttled (HTTP %d)' % status
+            elif status in TIMEOUT_STATUSES or _is_timeout(error):
+                reason = 'timeout'
+            else:
+                return
+            if started < self._last_decrease:
+                return
+            self._last_decrease = time.time()
+            self._successes = 0
+            self.decreases += 1
+            self._set_limit(max(self.minimum,
+                                self._limit * self.decrease_factor), reason)
+
+    def _succeeded(self, latency, size):
+        pace = latency / max(1, size / LATENCY_SIZE_UNIT)
+        if self._best_pace is None:
+            self._best_pace = pace
+        else:
+            self._best_pace = min(pace, self._best_pace * 1.01)
+        if (pace > self._best_pace * self.latency_tolerance or
+                self._limit >= self.maximum):
+            return
+        self._successes += 1
+        if self._successes < self.limit:
+            return
+        self._successes = 0
+        self.increases += 1
+        self._set_limit(min(self.maximum, self._limit + 1), 'healthy')
+
+    def _set_limit(self, limit, reason):
+        changed = int(limit) != int(self._limit)
+        self._limit = limit
+        if changed and len(self.decisions) < CONCURRENCY_MAX_DECISIONS:
+            self.decisions.append({
+                'time': round(time.time() - self._start, 1),
+                'limit': self.limit,
+                'reason': reason,
+            })
+
+    def summary(self):
+        """The decisions taken, for the module result"""
+        with self._lock:
+            return {
+                'initial': self.initial,
+                'minimum': self.minimum,
+                'maximum': self.maximum,
+                'limit': self.limit,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'decisions': list(self.decisions),
+            }
+
+
+class MeteredStream(io.RawIOBase):
+    """Count the time spent reading a stream, and the bytes read
+
+    Reading a compressed stream compresses the file on the fly, so the
+    time spent is the time spent compressing (and reading the file).
+    Other attributes, like line_index(), are the ones of the stream.
+    """
+
+    def __init__(self, stream, metrics, size):
+        self._stream = stream
+        self._metrics = metrics
+        self._size = size
+        self._elapsed = 0
+        self._read = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._stream, name)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self._stream.read(size)
+        self._elapsed += time.time() - start
+        self._read += len(data)
+        if not data and size != 0:
+            self._metrics.compressed(self._elapsed, self._size, self._read)
+            self._elapsed = self._read = 0
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self._stream.tell()
+
+    def close(self):
+        self._stream.close()
+        super(MeteredStream, self).close()
+
+
+class UploadMetrics():
+    """Where the time of an upload goes, for the module result
+
+    The wall time of the phases of an upload is recorded by
+    run_upload, the time each object took by the UploadEngine it is
+    given to. Compression and network time are summed over the objects
+    uploaded at the same time, so they can exceed the wall time of the
+    upload; what matters is how they compare.
+    """
+
+    def __init__(self, slowest=METRICS_SLOWEST_OBJECTS):
+        self.phases = collections.OrderedDict()
+        self.latencies = []
+        self.failed = 0
+        self.size = 0
+        self.compression_time = 0
+        self.compression_in = 0
+        self.compression_out = 0
+        self._slowest_count = slowest
+        self._slowest = []
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def meter(self, stream, size):
+        """Wrap a compressed stream of a file of size bytes"""
+        return MeteredStream(stream, self, size)
+
+    def compressed(self, seconds, size, compressed_size):
+        with self._lock:
+            self.compression_time += seconds
+            self.compression_in += size
+            self.compression_out += compressed_size
+
+    def object_done(self, item, seconds, failed=False):
+        """Record the time an object took, including its retries"""
+        size = getattr(item, 'size', 0) or 0
+        name = (getattr(item, 'relative_path', None) or
+                getattr(item, 'filename', None) or repr(item))
+        with self._lock:
+            if failed:
+                self.failed += 1
+                return
+            self.latencies.append(seconds)
+            self.size += size
+            entry = (seconds, name, size)
+            if len(self._slowest) < self._slowest_count:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def _percentile(self, latencies, percent):
+        # Nearest rank
+        rank = int(math.ceil(percent / 100.0 * len(latencies)))
+        return round(latencies[max(0, rank - 1)], 3)
+
+    def report(self, retries=0):
+        """The metrics as a dict for the module result
+
+        Args:
+            retries (int): Number of retries done during the upload.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            upload_time = self.phases.get('upload', 0)
+            times = collections.OrderedDict(
+                (name, round(seconds, 3))
+                for name, seconds in self.phases.items())
+            times['compression'] = round(self.compression_time, 3)
+            times['network'] = round(
+                max(0, sum(latencies) - self.compression_time), 3)
+            report = {
+                'objects': len(latencies),
+                'failed': self.failed,
+                'bytes': self.size,
+                'objects_per_second': round(
+                    len(latencies) / upload_time, 1) if upload_time else None,
+                'time': times,
+                'compression': {
+                    'bytes_in': self.compression_in,
+                    'bytes_out': self.compression_out,
+                },
+                'retries': retries,
+                'slowest': [
+                    {'name': name, 'seconds': round(seconds, 3),
+                     'size': size}
+                    for seconds, name, size in sorted(self._slowest,
+                                                      reverse=True)],
+            }
+            if latencies:
+                report['latency'] = dict(
+                    ('p%d' % percent, self._percentile(latencies, percent))
+                    for percent in (50, 95, 99))
+                report['latency']['max'] = round(latencies[-1], 3)
+            return report
+
+    def save(self, path, report):
+        """Write a report as a JSON artifact"""
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+class UploadProfiler():
+    """Profile an upload, including the threads it starts
+
+    With 'cprofile', every thread started while profiling gets a
+    cProfile profiler of its own, and the profiles are merged into one
+    pstats file, to be read with pstats or snakeviz.  With 'sample', the
+    stacks of all threads are sampled every PROFILE_SAMPLE_INTERVAL
+    seconds and written in the collapsed format of flamegraph.pl and
+    speedscope, each stack starting with the name of its thread.
+    Sampling costs less and shows where the workers wait, cProfile
+    counts every call.
+    """
+
+    modes = ('cprofile', 'sample')
+
+    def __init__(self, mode, interval=PROFILE_SAMPLE_INTERVAL):
+        if mode not in self.modes:
+            raise ValueError("Unknown profiler %s, use one of %s" % (
+                mode, ', '.join(self.modes)))
+        self.mode = mode
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._profiles = []
+        self._done = threading.Event()
+        self._sampler = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.mode == 'cprofile':
+            # From Python 3.12 on, the profiler of the thread starting
+            # the upload already covers all threads.
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._start_thread)
+            self._start_profile()
+        else:
+            self._sampler = threading.Thread(target=self._sample)
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            threading.setprofile(None)
+            for profile in self._profiles:
+                profile.disable()
+        else:
+            self._done.set()
+            self._sampler.join()
+
+    def _start_profile(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active
+            return False
+        with self._lock:
+            self._profiles.append(profile)
+        return True
+
+    def _start_thread(self, frame, event, arg):
+        # Called on the first event of every new thread; enabling a
+        # profiler in the thread replaces this hook.
+        if not self._start_profile():
+            # Or the hook would run again on every call of the thread
+            sys.setprofile(None)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self._done.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def save(self, directory):
+        """Write the profile to directory, returning its FileDetail"""
+        if self.mode == 'cprofile':
+            path = os.path.join(directory, PROFILE_NAME + '.prof')
+            pstats.Stats(*self._profiles).dump_stats(path)
+        else:
+            path = os.path.join(directory, PROFILE_NAME + '.txt')
+            with open(path, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+        return FileDetail(path, os.path.basename(path))
+
+
+# Queued after the last item of an UploadEngine run
+_STOP_WORKERS = object()
+
+
+class UploadEngine():
+    """Run upload tasks on a bounded pool of worker threads
+
+    Every Uploader hands its file list to an UploadEngine instead of
+    managing its own threads, so the number of concurrent uploads, the
+    amount of data in flight and the time a single upload may take are
+    capped in one place.
+
+    A timed out task is reported as failed and its worker abandoned,
+    but the worker still counts against the concurrency until its task
+    returns, so slow storage does not get more uploads at once.  Only
+    after another task_timeout does a worker stuck for good stop
+    counting, so it cannot stall the upload.
+
+    An engine runs one file list at a time.
+    """
+
+    # How often the calling thread looks for timed out tasks
+    poll_interval = 1.0
+
+    def __init__(self, concurrency=None, max_inflight_bytes=None,
+                 task_timeout=None, retry_policy=None, controller=None,
+                 metrics=None):
+        """
+        Args:
+            concurrency (int): Number of worker threads, defaults to
+                               MAX_UPLOAD_THREADS.
+            max_inflight_bytes (int): Upper bound of the summed size of
+                                      the items uploaded at the same time.
+                                      A single bigger item is uploaded on
+                                      its own.
+            task_timeout (float): Seconds after which a task, including
+                                  its retries, is reported as failed.
+            retry_policy (RetryPolicy): Policy all tasks are retried
+                                        with, sharing its retry budget.
+            controller (ConcurrencyController): Adapts the number of
+                                                tasks run at once, up to
+                                                its maximum which then
+                                                replaces concurrency.
+            metrics (UploadMetrics): Records the time of the runs and
+                                     of every item.
+        """
+        self.controller = controller
+        self.metrics = metrics
+        if controller is not None:
+            concurrency = controller.maximum
+        self.concurrency = max(1, concurrency or MAX_UPLOAD_THREADS)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.max_inflight_bytes = max_inflight_bytes or MAX_INFLIGHT_BYTES
+        self.task_timeout = task_timeout
+        self.queue_size = self.concurrency * 2
+        self._cond = threading.Condition()
+
+    def run(self, func, items, on_failure=default_failure):
+        """Call func(item) for every item using the worker pool
+
+        Each call is retried with retry_function and the retry_policy of
+        the engine. Errors left after the retries and timed out tasks are
+        turned into failure entries with on_failure(item, error).
+
+        items may be a generator, like the one of a pipelined scan.  It
+        is consumed from the calling thread while the workers upload,
+        and blocks when queue_size items are waiting for a worker.
+
+        Returns:
+            A list of failure entries, one per failed item.
+        """
+        self._queue = queuelib.Queue(self.queue_size)
+        self._func = func
+        self._on_failure = on_failure
+        self._failures = []
+        self._running = {}
+        # Timed out workers still running, by the time they timed out
+        self._abandoned = {}
+        self._inflight_bytes = 0
+
+        workers = []
+        for item in items:
+            if len(workers) < self.concurrency:
+                workers.append(self._start_worker())
+            self._put(item, workers)
+        if workers:
+            self._put(_STOP_WORKERS, workers)
+        while workers:
+            if self.task_timeout:
+                workers[0].join(self.poll_interval)
+                self._expire_tasks(workers)
             else:
-                logging.exception("Error on attempt %d" % attempt)
-                time.sleep(attempt * 10)
+                workers[0].join()
+            workers = [t for t in workers if t.is_alive()]
+        return self._failures
+
+    async def run_async(self, func, items, on_failure=default_failure):
+        """Await func(item) for every item on the running event loop
+
+        Up to concurrency calls, or the limit of the controller, are in
+        flight at once, all driven from the calling thread. Retries,
+        timeouts and failures are handled like in run();
+        max_inflight_bytes does not apply as nothing is buffered per item.
+
+        Returns:
+            A list of failure entries, one per failed item.
+        """
+        items = iter(items)
+        failures = []
+        running = [0]
+        changed = asyncio.Condition()
+
+        async def attempt(item):
+            if self.controller is None:
+                return await func(item)
+            started = time.time()
+            size = getattr(item, 'size', 0) or 0
+            try:
+                result = await func(item)
+            except Exception as e:
+                self.controller.observe(started, time.time() - started,
+                                        size, e)
+                raise
+            self.controller.observe(started, time.time() - started, size)
+            return result
+
+        async def worker():
+            # All workers share the iterator, which is safe as they
+            # run on the same thread.
+            for item in items:
+                if self.controller is not None:
+                    async with changed:
+                        await changed.wait_for(
+                            lambda: running[0] < self.controller.limit)
+                running[0] += 1
+                logging.debug("processing job %s", item)
+                started = time.time()
+                failed = True
+                try:
+                    coro = async_retry_function(lambda: attempt(item),
+                                                self.retry_policy)
+                    if self.task_timeout:
+                        coro = asyncio.wait_for(coro, self.task_timeout)
+                    await coro
+                    failed = False
+                except asyncio.TimeoutError as e:
+                    if self.controller is not None:
+                        self.controller.observe(
+                            started, self.task_timeout, error=e)
+                    failures.append(on_failure(
+                        item, UploadTimeout(
+                            "Timed out after %s seconds" %
+                            self.task_timeout)))
+                except Exception as e:
+                    # Do our best to attempt to upload all the files
+                    logging.exception("Error uploading %s", item)
+                    failures.append(on_failure(item, e))
+                finally:
+                    if self.metrics is not None:
+                        self.metrics.object_done(
+                            item, time.time() - started, failed)
+                    running[0] -= 1
+                    async with changed:
+                        changed.notify_all()
+
+        await asyncio.gather(*[worker() for x in range(self.concurrency)])
+        return failures
+
+    def _put(self, item, workers):
+        while True:
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                return
+            except queuelib.Full:
+                if self.task_timeout:
+                    self._expire_tasks(workers)
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._worker)
+        # Timed out tasks are abandoned, they must not keep the
+        # process alive.
+        t.daemon = True
+        t.start()
+        return t
+
+    def _expire_tasks(self, workers):
+        now = time.time()
+        with self._cond:
+            for worker, expired in list(self._abandoned.items()):
+                if now - expired >= self.task_timeout:
+                    # Stuck for good, stop holding its slot
+                    del self._abandoned[worker]
+                    self._cond.notify_all()
+            for worker, (item, started, size) in list(self._running.items()):
+                if now - started < self.task_timeout:
+                    continue
+                # The worker is left to finish on its own; it notices
+                # that it was abandoned and exits.
+                del self._running[worker]
+                self._abandoned[worker] = now
+                self._inflight_bytes -= size
+                self._cond.notify_all()
+                if self.controller is not None:
+                    self.controller.observe(
+                        started, now - started, size,
+                        UploadTimeout("Timed out"))
+                self._failures.append(self._on_failure(
+                    item, UploadTimeout(
+                        "Timed out after %s seconds" % self.task_timeout)))
+                if self.metrics is not None:
+                    self.metrics.object_done(item, now - started, True)
+                workers.remove(worker)
+                workers.append(self._start_worker())
+
+    def _limit(self):
+        if self.controller is not None:
+            return self.controller.limit
+        return self.concurrency
+
+    def _attempt(self, item, size):
+        if self.controller is None:
+            return self._func(item)
+        started = time.time()
+        try:
+            result = self._func(item)
+        except Exception as e:
+            self.controller.observe(started, time.time() - started, size, e)
+            raise
+        self.controller.observe(started, time.time() - started, size)
+        return result
+
+    def _worker(self):
+        me = threading.current_thread()
+        while True:
+            item = self._queue.get()
+            if item is _STOP_WORKERS:
+                # No more work to do, let the other workers know too
+                self._queue.put(item)
+                return
+            size = getattr(item, 'size', 0) or 0
+            with self._cond:
+                while ((self._inflight_bytes and
+                        self._inflight_bytes + size >
+                        self.max_inflight_bytes) or
+                       len(self._running) + len(self._abandoned) >=
+                       self._limit()):
+                    self._cond.wait()
+                self._inflight_bytes += size
+                self._running[me] = (item, time.time(), size)
+
+            logging.debug("%s: processing job %s", me, item)
+            error = None
+            started = time.time()
+            try:
+                retry_function(lambda: self._attempt(item, size),
+                               self.retry_policy)
+            except Exception as e:
+                # Do our best to attempt to upload all the files
+                logging.exception("Error uploading %s", item)
+                error = e
+
+            with self._cond:
+                if self._running.pop(me, None) is None:
+                    # Timed out, a replacement worker took over and can
+                    # have the slot now
+                    self._abandoned.pop(me, None)
+                    self._cond.notify_all()
+                    return
+                if self.metrics is not None:
+                    self.metrics.object_done(item, time.time() - started,
+                                             error is not None)
+                self._inflight_bytes -= size
+                self._cond.notify_all()
+                if error is not None:
+                    self._failures.append(self._on_failure(item, error))
+
+
+async def async_retry_function(func, policy=None):
+    policy = policy or RetryPolicy()
+    attempt = 1
+    while True:
+        try:
+            result = await func()
+        except Exception as e:
+            delay = policy.retry_delay(attempt, e)
+            if delay is None:
+                raise
+            logging.exception("Error on attempt %d, retrying in %.1f "
+                              "seconds" % (attempt, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            policy.succeeded()
+            return result
+
+
+class AsyncHTTPResponse():
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+
+class AsyncHTTPConnectionPool():
+    """A minimal asyncio HTTP/1.1 client for a single endpoint
+
+    Requests are sent over at most maxsize connections which are kept
+    alive and reused. Bodies given as bytes are sent with a
+    Content-Length, file objects and iterables of bytes (like
+    GzipFilter) are streamed with chunked transfer encoding. Producing
+    the chunks reads and possibly compresses files, so it is done in
+    the default executor to keep the event loop free.
+    """
+    chunk_size = 65536
+
+    def __init__(self, endpoint, maxsize=ASYNC_MAX_UPLOADS,
+                 ssl_context=None):
+        """
+        Args:
+            endpoint (str): Base URL prepended to all request paths.
+            maxsize (int): Maximum number of open connections.
+            ssl_context (ssl.SSLContext): Context for https endpoints.
+        """
+        url = urlparse.urlsplit(endpoint)
+        self.host = url.hostname
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        if url.scheme == 'https':
+            self.port = url.port or 443
+            self.ssl = ssl_context or ssl.create_default_context()
+        else:
+            self.port = url.port or 80
+            self.ssl = None
+        self.maxsize = maxsize
+        # Number of connections opened, kept for statistics
+        self.connections = 0
+        self._idle = []
+        self._semaphore = None
+
+    async def request(self, method, path, headers=None, body=None):
+        # Created lazily so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxsize)
+        async with self._semaphore:
+            reader, writer = await self._get_connection()
+            try:
+                response, keep_alive = await self._send(
+                    reader, writer, method, path, headers or {}, body)
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    def close(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+    async def _get_connection(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            # The server may have closed the idle connection meanwhile
+            if not reader.at_eof():
+                return reader, writer
+            writer.close()
+        self.connections += 1
+        return await asyncio.open_connection(self.host, self.port,
+                                             ssl=self.ssl)
+
+    async def _send(self, reader, writer, method, path, headers, body):
+        if body is None:
+            body = b''
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = ['%s %s HTTP/1.1' % (method, self.path + path),
+                 'Host: %s' % self.netloc]
+        chunked = not isinstance(body, bytes)
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            lines.append('Content-Length: %d' % len(body))
+        for key, value in headers.items():
+            lines.append('%s: %s' % (key, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        if chunked:
+            if hasattr(body, 'read'):
+                chunks = iter(lambda: body.read(self.chunk_size), b'')
+            else:
+                chunks = iter(body)
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                writer.write(b'%x\r\n' % len(chunk))
+                writer.write(chunk)
+                writer.write(b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        else:
+            writer.write(body)
+        await writer.drain()
+        return await self._read_response(reader, method)
+
+    async def _read_response(self, reader, method):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+            [''])[:3]
+        status = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return AsyncHTTPResponse(status, reason, headers, body), keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader):
+        body = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                break
+            body.append(await reader.readexactly(size))
+            await reader.readline()
+        # Skip trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(body)
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -252,49 +1739,563 @@ class FileDetail():
     to push to storage.
     """
 
-    def __init__(self, full_path, relative_path, filename=None):
+    __slots__ = ('full_path', 'filename', 'relative_path', 'folder',
+                 'last_modified', 'size', 'content', '_mimetype',
+                 '_encoding')
+
+    def __init__(self, full_path, relative_path, filename=None,
+                 stat_result=None):
         """
         Args:
             full_path (str): The absolute path to the file on disk.
             relative_path (str): The relative path from the artifacts source
                                  used for links.
             filename (str): An optional alternate filename in links.
+            stat_result (os.stat_result): The result of os.stat on
+                                          full_path, when the caller
+                                          already has it.
         """
-        # Make FileNotFoundError exception to be compatible with python2
-        try:
-            FileNotFoundError  # noqa: F823
-        except NameError:
-            FileNotFoundError = OSError
-
         self.full_path = full_path
         if filename is None:
             self.filename = os.path.basename(full_path)
         else:
             self.filename = filename
         self.relative_path = relative_path
+        # Data of files which are not on disk, see from_content()
+        self.content = None
+        # Guessed on first use
+        self._mimetype = None
+        self._encoding = None
 
-        if self.full_path and os.path.isfile(self.full_path):
-            mime_guess, encoding = mimetypes.guess_type(self.full_path)
-            self.mimetype = mime_guess if mime_guess else 'text/plain'
-            self.encoding = encoding
-            self.folder = False
+        if stat_result is None and self.full_path:
+            try:
+                stat_result = os.stat(self.full_path)
+            except OSError:
+                pass
+        if stat_result is not None:
+            self.folder = not stat.S_ISREG(stat_result.st_mode)
+            self.last_modified = time.gmtime(stat_result[stat.ST_MTIME])
+            self.size = stat_result[stat.ST_SIZE]
         else:
-            self.mimetype = 'application/directory'
-            self.encoding = None
             self.folder = True
-        try:
-            st = os.stat(self.full_path)
-            self.last_modified = time.gmtime(st[stat.ST_MTIME])
-            self.size = st[stat.ST_SIZE]
-        except (FileNotFoundError, TypeError):
             self.last_modified = time.gmtime(0)
             self.size = 0
 
+    @classmethod
+    def from_content(cls, relative_path, content):
+        """Return the FileDetail of a file held in memory
+
+        Args:
+            relative_path (str): The relative path of the file.
+            content: The data of the file, as bytes or as an object
+                     turned into bytes by bytes(), like SpilledContent.
+        """
+        file_detail = cls(None, relative_path,
+                          os.path.basename(relative_path))
+        file_detail.content = content
+        file_detail.folder = False
+        file_detail.last_modified = time.gmtime()
+        file_detail.size = len(content)
+        return file_detail
+
+    def open(self):
+        """Return a binary file object to read the file"""
+        if self.content is not None:
+            return io.BytesIO(bytes(self.content))
+        return open(self.full_path, 'rb')
+
+    def _guess_type(self):
+        if self.folder:
+            self._mimetype = 'application/directory'
+            self._encoding = None
+        else:
+            mime_guess, encoding = mimetypes.guess_type(
+                self.full_path or self.filename)
+            self._mimetype = mime_guess if mime_guess else 'text/plain'
+            self._encoding = encoding
+
+    @property
+    def mimetype(self):
+        if self._mimetype is None:
+            self._guess_type()
+        return self._mimetype
+
+    @property
+    def encoding(self):
+        if self._mimetype is None:
+            self._guess_type()
+        return self._encoding
+
     def __repr__(self):
         t = 'Folder' if self.folder else 'File'
         return '<%s %s>' % (t, self.relative_path)
 
 
+def iter_upload_files(file_list, paths, scan_workers=1, indexes=True,
+                      create_parent_links=True,
+                      create_topdir_parent_link=False,
+                      append_footer='index_footer.html',
+                      index_page_size=None, manifest=False):
+    """Scan paths into file_list, yielding what to upload as it is found
+
+    This pipelines the scan, the indexing and the upload: files are
+    yielded as soon as their directory is listed and index pages as
+    soon as their folder is complete, instead of scanning and indexing
+    everything before the first upload.  The arguments are those of
+    FileList.add(), Indexer() and Indexer.make_indexes(), the manifest
+    comes last when requested.
+    """
+    indexer = Indexer(file_list, page_size=index_page_size)
+    listings = itertools.chain.from_iterable(
+        file_list.iter_add(path, scan_workers) for path in paths)
+    if indexes:
+        files = indexer.iter_indexes(
+            listings, create_parent_links=create_parent_links,
+            create_topdir_parent_link=create_topdir_parent_link,
+            append_footer=append_footer)
+    else:
+        files = itertools.chain(
+            [file_list[0]],
+            (f for folder, details in listings for f in details))
+    if not manifest:
+        return files
+    return _iter_with_manifest(indexer, files, indexes)
+
+
+def _iter_with_manifest(indexer, files, index_links):
+    uploaded = []
+    for f in files:
+        uploaded.append(f)
+        yield f
+    yield indexer.make_manifest(uploaded, index_links)
+
+
+# Options of the upload modules handled by run_upload, see
+# upload_argument_spec() and add_upload_arguments().
+UPLOAD_OPTIONS = ('max_inflight_bytes', 'max_concurrency', 'metrics',
+                  'metrics_file', 'profile', 'task_timeout',
+                  'compression_cpu_budget', 'min_compression_gain',
+                  'scan_workers', 'pipeline', 'index_page_size', 'manifest',
+                  'line_index_min_size', 'journal')
+
+
+def upload_argument_spec():
+    """Return the Ansible argument_spec entries all uploaders share
+
+    These are the UPLOAD_OPTIONS and the content_encoding the Uploader
+    of every module takes.
+    """
+    return dict(
+        max_inflight_bytes=dict(type='int'),
+        max_concurrency=dict(type='int'),
+        metrics=dict(type='bool', default=False),
+        metrics_file=dict(type='path'),
+        profile=dict(type='str', choices=list(UploadProfiler.modes)),
+        task_timeout=dict(type='int'),
+        compression_cpu_budget=dict(type='str', default='medium',
+                                    choices=['low', 'medium', 'high']),
+        min_compression_gain=dict(type='float'),
+        content_encoding=dict(type='str', default='gzip',
+                              choices=['gzip', 'br', 'zstd']),
+        scan_workers=dict(type='int', default=1),
+        pipeline=dict(type='bool', default=False),
+        index_page_size=dict(type='int'),
+        manifest=dict(type='bool', default=False),
+        line_index_min_size=dict(type='int'),
+        journal=dict(type='path'),
+    )
+
+
+def add_upload_arguments(parser):
+    """Add the command line options all uploaders share to parser"""
+    parser.add_argument('--max-inflight-bytes', type=int,
+                        help='Upper bound of the summed size of the files '
+                             'uploaded in parallel')
+    parser.add_argument('--max-concurrency', type=int,
+                        help='Adapt the number of files uploaded in '
+                             'parallel to the object store, starting at '
+                             '--concurrency and growing up to this number '
+                             'while uploads stay healthy')
+    parser.add_argument('--metrics-file',
+                        help='Write a report of where the time of the '
+                             'upload went, per phase and per object, to '
+                             'this JSON file')
+    parser.add_argument('--profile', choices=UploadProfiler.modes,
+                        help='Profile the upload with cProfile or by '
+                             'sampling the stacks of all threads, and '
+                             'upload the profile next to the files as '
+                             '%s.prof or .txt. Defaults to the '
+                             '%s environment variable' % (PROFILE_NAME,
+                                                          PROFILE_ENV))
+    parser.add_argument('--task-timeout', type=int,
+                        help='Seconds after which the upload of a single '
+                             'file is given up on')
+    parser.add_argument('--compression-cpu-budget', default='medium',
+                        choices=['low', 'medium', 'high'],
+                        help='How much CPU to spend compressing, the gzip '
+                             'level of each file depends on it and on the '
+                             'size of the file')
+    parser.add_argument('--min-compression-gain', type=float,
+                        help='Upload text files uncompressed when the start '
+                             'of the file shrinks by less than this fraction '
+                             'when compressed. Default is %s'
+                             % MIN_COMPRESSION_GAIN)
+    parser.add_argument('--content-encoding', default='gzip',
+                        choices=['gzip', 'br', 'zstd'],
+                        help='Encoding to compress text files with. br '
+                             '(brotli) and zstd need the brotli and '
+                             'zstandard python packages')
+    parser.add_argument('--scan-workers', default=1, type=int,
+                        help='Number of top-level directories to scan in '
+                             'parallel, which helps on network filesystems')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Upload files while the rest of the tree is '
+                             'being scanned and indexed')
+    parser.add_argument('--index-page-size', type=int,
+                        help='Split the index of folders with more entries '
+                             'than this into several pages')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Upload a zuul-manifest.json describing all '
+                             'the uploaded files')
+    parser.add_argument('--line-index-min-size', type=int,
+                        help='Upload gzipped text files from this size on '
+                             'with a line index, to read parts of them with '
+                             'range requests')
+    parser.add_argument('--journal',
+                        help='Record the uploaded objects in this local '
+                             'file, and skip the files it records as '
+                             'uploaded and unchanged since, to resume an '
+                             'interrupted upload')
+
+
+def upload_options(params):
+    """Pick the arguments of run_upload from module params or CLI args"""
+    return dict((name, params.get(name)) for name in UPLOAD_OPTIONS)
+
+
+def _upload_profile(profiler, uploader, directory):
+    """Stop profiling and upload the profile, returning the failures
+
+    This runs whether the upload succeeded or not, so errors are
+    reported as failures rather than raised over the error of the
+    upload.
+    """
+    profiler.stop()
+    if uploader is None:
+        logging.warning("Not uploading the profile, the upload failed "
+                        "before it started")
+        return []
+    try:
+        profile = profiler.save(directory)
+    except Exception as e:
+        logging.exception("Error saving the profile")
+        return [{"file": PROFILE_NAME, "error": "{}".format(e)}]
+    # The profile is no part of the upload the metrics describe
+    uploader.engine.metrics = None
+    try:
+        return uploader.upload([profile])
+    except Exception as e:
+        logging.exception("Error uploading the profile")
+        return [default_failure(profile, e)]
+
+
+def run_upload(files, make_uploader, indexes=True, parent_links=True,
+               topdir_parent_link=False, footer='index_footer.html',
+               concurrency=None, max_inflight_bytes=None,
+               max_concurrency=None, task_timeout=None,
+               compression_cpu_budget='medium', min_compression_gain=None,
+               scan_workers=1, pipeline=False, index_page_size=None,
+               manifest=False, line_index_min_size=None, journal=None,
+               metrics=False, metrics_file=None, profile=None):
+    """Scan, index and upload files, the part of run() uploaders share
+
+    make_uploader(engine, compression, journal) returns the Uploader of
+    the module, given the UploadEngine, the CompressionPolicy and the
+    UploadJournal, or None, made from the options.  Without a profile,
+    the PROFILE_ENV environment variable selects the profiler.
+
+    Returns:
+        A tuple of the uploader, the upload failures, the compression
+        levels used, the summary of the concurrency controller and the
+        metrics report; the last two are None unless asked for.
+    """
+    profile = profile or os.environ.get(PROFILE_ENV)
+    upload_metrics = None
+    if metrics or metrics_file:
+        upload_metrics = UploadMetrics()
+
+    # Create the objects to make sure the arguments are sound.
+    with FileList() as file_list:
+        profiler = None
+        upload_journal = None
+        uploader = None
+        upload_failures = None
+        try:
+            if profile:
+                profiler = UploadProfiler(profile)
+                profiler.start()
+            if pipeline:
+                # Upload files while the rest is still being scanned.
+                upload_list = iter_upload_files(
+                    file_list, files, scan_workers, indexes,
+                    create_parent_links=parent_links,
+                    create_topdir_parent_link=topdir_parent_link,
+                    append_footer=footer, index_page_size=index_page_size,
+                    manifest=manifest)
+            else:
+                # Scan the files.
+                start = time.time()
+                for file_path in files:
+                    file_list.add(file_path, scan_workers=scan_workers)
+                scanned = time.time()
+
+                indexer = Indexer(file_list, page_size=index_page_size)
+
+                # (Possibly) make indexes.
+                if indexes:
+                    indexer.make_indexes(
+                        create_parent_links=parent_links,
+                        create_topdir_parent_link=topdir_parent_link,
+                        append_footer=footer)
+                if manifest:
+                    file_list.file_list.append(
+                        indexer.make_manifest(index_links=indexes))
+                if upload_metrics:
+                    upload_metrics.add_phase('scan', scanned - start)
+                    upload_metrics.add_phase('index',
+                                             time.time() - scanned)
+
+                logging.debug("List of files prepared to upload:")
+                for x in file_list:
+                    logging.debug(x)
+                upload_list = file_list
+
+            # Upload.
+            controller = None
+            if max_concurrency:
+                controller = ConcurrencyController(concurrency,
+                                                   max_concurrency)
+            engine = UploadEngine(concurrency=concurrency,
+                                  max_inflight_bytes=max_inflight_bytes,
+                                  task_timeout=task_timeout,
+                                  controller=controller,
+                                  metrics=upload_metrics)
+            compression = CompressionPolicy(
+                cpu_budget=compression_cpu_budget,
+                min_gain=min_compression_gain,
+                line_index_min_size=line_index_min_size)
+            if journal:
+                upload_journal = UploadJournal(journal)
+            uploader = make_uploader(engine, compression, upload_journal)
+            started = time.time()
+            upload_failures = uploader.upload(upload_list)
+            if upload_metrics:
+                upload_metrics.add_phase('upload', time.time() - started)
+                retries = engine.retry_policy.retries
+        finally:
+            # Also when the upload failed, that profile is the one
+            # most wanted.
+            if profiler:
+                profile_failures = _upload_profile(
+                    profiler, uploader, file_list.get_tempdir())
+                if profile_failures:
+                    upload_failures = ((upload_failures or []) +
+                                       profile_failures)
+            if upload_journal is not None:
+                upload_journal.close()
+        report = None
+        if upload_metrics:
+            report = upload_metrics.report(retries)
+            if metrics_file:
+                upload_metrics.save(metrics_file, report)
+        return (uploader, upload_failures, compression.levels,
+                controller.summary() if controller else None, report)
+
+
+def file_digest(file_detail, salt=b''):
+    """Return the SHA-256 hex digest of salt and the content of a file"""
+    digest = hashlib.sha256(salt)
+    with file_detail.open() as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DedupIndex():
+    """Local record of the content-addressed blobs already uploaded
+
+    Maps blob names, including their container, to the time the blob
+    expires, or None when it does not.  Knowing which blobs exist this
+    way spares a HEAD request per file; the record only has the blobs
+    uploaded from this machine.  It is loaded from and saved to a JSON
+    file, merged with what other runs saved in the meantime.  Runs
+    sharing the file save one at a time, holding a lock on the file
+    next to it with a .lock suffix.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._blobs = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                blobs = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((name, expires) for name, expires in blobs.items()
+                    if expires is None or expires > now)
+
+    def has(self, name, until=None):
+        """Whether a blob exists and is kept at least until a time"""
+        with self._lock:
+            if name not in self._blobs:
+                return False
+            expires = self._blobs[name]
+        return expires is None or (until is not None and expires >= until)
+
+    def add(self, name, expires=None):
+        with self._lock:
+            self._blobs[name] = expires
+
+    def save(self):
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Or another run could replace the file between our read
+            # and our rename, and lose what we merged or what it did.
+            with open(self.path + '.lock', 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                blobs = self._load()
+                for name, expires in self._blobs.items():
+                    if name not in blobs or (
+                            blobs[name] is not None and
+                            (expires is None or expires > blobs[name])):
+                        blobs[name] = expires
+                self._blobs = blobs
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(blobs, f)
+                os.rename(tmp, self.path)
+
+
+class UploadJournal():
+    """On-disk record of the objects an upload completed
+
+    Every uploaded object is appended to the journal file as a JSON
+    line, with the size and modification time of the file it was
+    uploaded from and the ETag the storage returned, if any.  When an
+    interrupted upload runs again with the same journal, the files
+    which were uploaded and did not change since are skipped.  Objects
+    are recorded by their full name, so one journal can serve several
+    prefixes.
+
+    The journal file is kept open for appending until close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = self._load()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _load(self):
+        entries = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by the interruption
+                        continue
+                    entries[entry['name']] = entry
+        except IOError:
+            pass
+        return entries
+
+    @staticmethod
+    def _stamp(file_detail):
+        return file_detail.size, calendar.timegm(file_detail.last_modified)
+
+    def is_done(self, name, file_detail):
+        """Whether an object was uploaded from the file as it is now"""
+        if file_detail.content is not None:
+            # Generated again on every run
+            return False
+        with self._lock:
+            entry = self._entries.get(name)
+        return (entry is not None and
+                (entry['size'], entry['mtime']) == self._stamp(file_detail))
+
+    def done(self, name, file_detail, etag=None):
+        """Record that an object was uploaded from a file"""
+        size, mtime = self._stamp(file_detail)
+        entry = {'name': name, 'size': size, 'mtime': mtime, 'etag': etag}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._entries[name] = entry
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(line)
+            # What is written survives the process being killed
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class SpilledContent():
+    """Data written to a spill file, read back with bytes()"""
+
+    __slots__ = ('path', 'offset', 'size')
+
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+
+
+def split_file_list(file_list, count):
+    """Split a file list into count parts of about the same size
+
+    Files are handed out biggest first to the part with the smallest
+    total size so far.  Folders weigh nothing, and every part keeps the
+    order of the original list.
+
+    Returns:
+        A list of count lists of FileDetail objects, some may be empty.
+    """
+    count = max(1, count)
+    parts = [[] for x in range(count)]
+    totals = [(0, x) for x in range(count)]
+    entries = sorted(enumerate(file_list),
+                     key=lambda e: 0 if e[1].folder else -e[1].size)
+    for index, file_detail in entries:
+        total, part = heapq.heappop(totals)
+        parts[part].append((index, file_detail))
+        if not file_detail.folder:
+            total += file_detail.size
+        heapq.heappush(totals, (total, part))
+    return [[f for index, f in sorted(part, key=lambda e: e[0])]
+            for part in parts]
+
+
 class FileList(Sequence):
     '''A collection of FileDetail objects
 
@@ -338,18 +2339,107 @@ class FileList(Sequence):
             return False
         return True
 
-    def add(self, file_path):
-        """
-        Generate a list of files to upload to storage. Recurses through
-        directories
+    def _scan_dir(self, path, parent_dir, original_root):
+        """List a directory
+
+        Like os.walk the folders of a directory are listed before its
+        files, in case-insensitive name order.  The stat results of the
+        directory entries are reused, and only symlinks are resolved to
+        check they stay in the tree.
+
+        Returns:
+            The relative path of the directory, the list of its
+            FileDetails and the list of the folders to recurse into.
         """
+        # relative_path: The path between the given directory
+        # and the one being currently scanned.
+        relative_path = os.path.relpath(path, parent_dir)
+        if relative_path == '.':
+            relative_path = ''
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name.lower())
+        except OSError:
+            logging.exception("Unable to scan %s" % (path,))
+            return relative_path, [], []
+
+        folders = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if entry.is_symlink() and not self._path_in_tree(
+                    original_root, entry.path):
+                continue
+            if is_dir:
+                folders.append(entry)
+            else:
+                files.append(entry)
 
-        # file_list: A list of FileDetails to push to storage
         file_list = []
-
+        for entry in folders + files:
+            try:
+                stat_result = entry.stat()
+            except OSError:
+                # Broken symlink
+                stat_result = None
+            file_list.append(FileDetail(
+                entry.path, os.path.join(relative_path, entry.name),
+                entry.name, stat_result))
+        # TODO: this will copy the result of symlinked files, but
+        # it won't follow directory symlinks.  If we add that, we
+        # should ensure that we don't loop.
+        subdirs = [entry.path for entry in folders
+                   if not entry.is_symlink()]
+        return relative_path, file_list, subdirs
+
+    def _scan(self, top, parent_dir, original_root):
+        """Yield the listing of every directory below top, in upload order
+
+        Each directory is listed, then its folders are recursed into.
+        """
+        pending = [top]
+        while pending:
+            folder, details, subdirs = self._scan_dir(
+                pending.pop(), parent_dir, original_root)
+            yield folder, details
+            pending.extend(reversed(subdirs))
+
+    def _scan_parallel(self, top, parent_dir, original_root, workers):
+        """Scan the top-level folders of top on a pool of threads
+
+        Stat calls release the GIL, which pays off on network
+        filesystems.  The results are yielded in the order _scan would
+        yield them.
+        """
+        folder, details, subdirs = self._scan_dir(top, parent_dir,
+                                                  original_root)
+        yield folder, details
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for listings in executor.map(
+                    lambda path: list(self._scan(path, parent_dir,
+                                                 original_root)),
+                    subdirs):
+                for listing in listings:
+                    yield listing
+
+    def iter_add(self, file_path, scan_workers=1):
+        """Add files like add() while they are found
+
+        Yields:
+            A (folder, file_details) tuple for every directory listed,
+            with the relative path of the directory and the FileDetails
+            of its entries.  Entries found outside of a directory
+            listing, like file_path itself, are yielded as entries of
+            the top folder, ''.
+        """
         if os.path.isfile(file_path):
             relative_path = os.path.basename(file_path)
-            file_list.append(FileDetail(file_path, relative_path))
+            file_detail = FileDetail(file_path, relative_path)
+            self.file_list.append(file_detail)
+            yield '', [file_detail]
         elif os.path.isdir(file_path):
             original_root = os.path.realpath(os.path.abspath(
                 os.path.expanduser(file_path)))
@@ -359,36 +2449,30 @@ class FileList(Sequence):
                 filename = os.path.basename(file_path)
                 full_path = file_path
                 relative_name = os.path.relpath(full_path, parent_dir)
-                file_list.append(FileDetail(full_path, relative_name,
-                                            filename))
-            # TODO: this will copy the result of symlinked files, but
-            # it won't follow directory symlinks.  If we add that, we
-            # should ensure that we don't loop.
-            for path, folders, files in os.walk(file_path):
-                # Sort folder in-place so that we recurse in order.
-                files.sort(key=lambda x: x.lower())
-                folders.sort(key=lambda x: x.lower())
-                # relative_path: The path between the given directory
-                # and the one being currently walked.
-                relative_path = os.path.relpath(path, parent_dir)
-
-                for filename in folders:
-                    full_path = os.path.join(path, filename)
-                    if not self._path_in_tree(original_root, full_path):
-                        continue
-                    relative_name = os.path.relpath(full_path, parent_dir)
-                    file_list.append(FileDetail(full_path, relative_name,
-                                                filename))
+                file_detail = FileDetail(full_path, relative_name, filename)
+                self.file_list.append(file_detail)
+                yield '', [file_detail]
+            if scan_workers > 1:
+                listings = self._scan_parallel(
+                    file_path, parent_dir, original_root, scan_workers)
+            else:
+                listings = self._scan(file_path, parent_dir, original_root)
+            for folder, details in listings:
+                self.file_list.extend(details)
+                yield folder, details
 
-                for filename in files:
-                    full_path = os.path.join(path, filename)
-                    if not self._path_in_tree(original_root, full_path):
-                        continue
-                    relative_name = os.path.relpath(full_path, parent_dir)
-                    file_detail = FileDetail(full_path, relative_name)
-                    file_list.append(file_detail)
+    def add(self, file_path, scan_workers=1):
+        """
+        Generate a list of files to upload to storage. Recurses through
+        directories
 
-        self.file_list += file_list
+        Args:
+            file_path (str): The file or directory to add.
+            scan_workers (int): Number of top-level folders of a
+                                directory scanned in parallel.
+        """
+        for listing in self.iter_add(file_path, scan_workers):
+            pass
 
 
 class Indexer():
@@ -398,77 +2482,211 @@ class Indexer():
     FileList
 
      - make_indexes() : make index.html in folders
+     - make_manifest() : make zuul-manifest.json for the whole list
     """
-    def __init__(self, file_list):
+    index_filename = 'index.html'
+    manifest_filename = 'zuul-manifest.json'
+
+    def __init__(self, file_list, page_size=None):
         '''
         Args:
             file_list (FileList): A FileList object with all files
              to be indexed.
+            page_size (int): The maximum number of entries of an index
+             page, bigger folders get several pages.  No limit if None.
         '''
         assert isinstance(file_list, FileList)
         self.file_list = file_list
-
-    def _make_index_file(self, folder_links, title, tempdir, append_footer):
-        """Writes an index into a file for pushing"""
+        self.page_size = page_size
+        self.max_memory = INDEX_MAX_MEMORY
+        self._memory_used = 0
+        self._spill_path = None
+
+    def _page_filename(self, page):
+        """Return the filename of a page of an index, counted from 1"""
+        if page == 1:
+            return self.index_filename
+        root, ext = os.path.splitext(self.index_filename)
+        return '%s-%d%s' % (root, page, ext)
+
+    def _make_index_file(self, folder_links, title, append_footer):
+        """Return the content of the pages of an index for pushing"""
+        file_details_to_append = None
         for file_details in folder_links:
             # Do not generate an index file if one exists already.
             # This may be the case when uploading other machine generated
             # content like python coverage info.
             if self.index_filename == file_details.filename:
-                return
-        index_content = self._generate_log_index(
-            folder_links, title, append_footer)
-        fd = open(os.path.join(tempdir, self.index_filename), 'w')
-        fd.write(index_content)
-        return os.path.join(tempdir, self.index_filename)
+                return []
+            if (append_footer and
+                append_footer in file_details.filename):
+                file_details_to_append = file_details
 
-    def _generate_log_index(self, folder_links, title, append_footer):
-        """Create an index of logfiles and links to them"""
+        footer = None
+        if file_details_to_append:
+            try:
+                with file_details_to_append.open() as f:
+                    footer = f.read().decode('utf-8')
+            except IOError:
+                logging.exception("Error opening file for appending")
 
-        output = '<html><head><title>%s</title></head><body>\n' % title
-        output += '<h1>%s</h1>\n' % title
-        output += '<table><tr><th></th><th>Name</th><th>Last Modified</th>'
-        output += '<th>Size</th></tr>'
+        page_size = self.page_size or len(folder_links) or 1
+        pages = [folder_links[i:i + page_size]
+                 for i in range(0, len(folder_links), page_size)] or [[]]
+        return [self._generate_log_index(links, title, footer,
+                                         page, len(pages)).encode('utf-8')
+                for page, links in enumerate(pages, 1)]
+
+    def _store(self, content):
+        """Keep content in memory, or in the spill file past max_memory"""
+        if self._memory_used + len(content) <= self.max_memory:
+            self._memory_used += len(content)
+            return content
+        if self._spill_path is None:
+            self._spill_path = os.path.join(self.file_list.get_tempdir(),
+                                            'indexes')
+        with open(self._spill_path, 'ab') as f:
+            offset = f.tell()
+            f.write(content)
+        return SpilledContent(self._spill_path, offset, len(content))
+
+    def _generate_log_index(self, folder_links, title, footer,
+                            page=1, page_count=1):
+        """Create a page of an index of logfiles and links to them
+
+        The rows are rendered first so that the page only embeds the
+        icons it uses, once each, in a stylesheet referenced by class.
+        """
 
-        file_details_to_append = None
+        rows = []
+        # CSS class by icon
+        icons = {}
         for file_details in folder_links:
-            output += '<tr>'
-            output += (
-                '<td><img alt="[ ]" title="%(m)s" src="%(i)s"></img></td>' % ({
-                    'm': file_details.mimetype,
-                    'i': get_mime_icon(file_details.mimetype,
-                                       file_details.filename),
-                }))
+            icon = get_mime_icon_name(file_details.mimetype,
+                                      file_details.filename)
+            icon_class = icons.get(icon)
+            if icon_class is None:
+                icon_class = icons[icon] = get_icon_class(icon)
             filename = file_details.filename
             link_filename = filename
             if file_details.folder:
                 filename += '/'
                 link_filename += '/index.html'
-            output += '<td><a href="%s">%s</a></td>' % (
-                urlparse.quote(link_filename),
-                filename)
-            output += '<td>%s</td>' % time.asctime(
-                file_details.last_modified)
-            size = sizeof_fmt(file_details.size, suffix='')
-            output += '<td style="text-align: right">%s</td>' % size
-            output += '</tr>\n'
+            rows.append(
+                '<tr><td class="icon %s" title="%s"></td>'
+                '<td><a href="%s">%s</a></td><td>%s</td>'
+                '<td class="size">%s</td></tr>\n' % (
+                    icon_class,
+                    file_details.mimetype,
+                    urlparse.quote(link_filename),
+                    filename,
+                    time.asctime(file_details.last_modified),
+                    sizeof_fmt(file_details.size, suffix='')))
+
+        output = ['<html><head><title>%s</title>\n' % title,
+                  '<style>\n',
+                  'td.size { text-align: right; }\n',
+                  get_icon_style(icons),
+                  '</style></head><body>\n',
+                  '<h1>%s</h1>\n' % title]
+        if page_count > 1:
+            output.append(self._generate_page_links(page, page_count))
+        output.extend([
+            '<table><tr><th></th><th>Name</th><th>Last Modified</th>',
+            '<th>Size</th></tr>'])
+        output.extend(rows)
+        output.append('</table>')
+
+        if footer:
+            output.append('<br /><hr />')
+            output.append(footer)
+
+        output.append('</body></html>\n')
+        return ''.join(output)
+
+    def _generate_page_links(self, page, page_count):
+        """Create the links to the other pages of an index"""
+        links = ['<p class="pages">Page %d of %d' % (page, page_count)]
+        for label, target in (('first', 1), ('previous', page - 1),
+                              ('next', page + 1), ('last', page_count)):
+            if 1 <= target <= page_count and target != page:
+                links.append(' <a href="%s">%s</a>' % (
+                    self._page_filename(target), label))
+        links.append('</p>\n')
+        return ''.join(links)
+
+    def _make_index(self, folder, files, create_parent_links,
+                    create_topdir_parent_link, append_footer):
+        """Return the FileDetails of the pages of the index of a folder"""
+        parent_file_detail = FileDetail(None, '..', '..')
+        # Don't add the pseudo-top-directory
+        if files and files[0].full_path is None:
+            files = files[1:]
+            if create_topdir_parent_link:
+                files = [parent_file_detail] + files
+        elif create_parent_links:
+            files = [parent_file_detail] + files
 
-            if (append_footer and
-                append_footer in file_details.filename):
-                file_details_to_append = file_details
+        # Do generate a link to the parent directory
+        pages = self._make_index_file(files, 'Index of %s' % (folder,),
+                                      append_footer)
 
-        output += '</table>'
+        return [FileDetail.from_content(
+            os.path.join(folder, self._page_filename(page)),
+            self._store(content))
+            for page, content in enumerate(pages, 1)]
 
-        if file_details_to_append:
-            output += '<br /><hr />'
-            try:
-                with open(file_details_to_append.full_path, 'r') as f:
-                    output += f.read()
-            except IOError:
-                logging.exception("Error opening file for appending")
+    def iter_indexes(self, listings, create_parent_links=True,
+                     create_topdir_parent_link=False,
+                     append_footer='index_footer.html'):
+        '''Yield files as they are listed, with the index of each folder
 
-        output += '</body></html>\n'
-        return output
+        This is the streaming version of make_indexes(), the index of a
+        folder is made as soon as the folder is listed instead of once
+        all files are known.  The top folder is only complete once
+        listings is exhausted, its index comes last, after the ones of
+        folders which were never listed, like symlinked directories.
+
+        Args:
+          listings: (folder, file_details) tuples like the ones
+             FileList.iter_add() yields, every folder but the top one
+             being listed once.
+          create_parent_links (bool): Create parent links
+          create_topdir_parent_link (bool): Create topdir parent link
+          append_footer (str): Filename of a footer to append to each
+             generated page
+
+        Yields:
+            The FileDetails of the listings and of the indexes.
+        '''
+        # The pseudo-top-directory
+        top_files = [self.file_list[0]]
+        yield self.file_list[0]
+        unlisted = collections.OrderedDict()
+        for folder, files in listings:
+            for f in files:
+                if f.folder:
+                    unlisted[f.relative_path] = True
+                yield f
+            if folder == '':
+                top_files.extend(files)
+                continue
+            unlisted.pop(folder, None)
+            for index in self._make_index(folder, files,
+                                          create_parent_links,
+                                          create_topdir_parent_link,
+                                          append_footer):
+                yield index
+
+        for folder in unlisted:
+            for index in self._make_index(folder, [], create_parent_links,
+                                          create_topdir_parent_link,
+                                          append_footer):
+                yield index
+        for index in self._make_index('', top_files, create_parent_links,
+                                      create_topdir_parent_link,
+                                      append_footer):
+            yield index
 
     def make_indexes(self, create_parent_links=True,
                      create_topdir_parent_link=False,
@@ -486,8 +2704,6 @@ class Indexer():
         Return:
             No value, the self.file_list will be updated
         '''
-        self.index_filename = 'index.html'
-
         folders = collections.OrderedDict()
         for f in self.file_list:
             if f.folder:
@@ -501,25 +2717,12 @@ class Indexer():
             folders[folder].append(f)
 
         indexes = {}
-        parent_file_detail = FileDetail(None, '..', '..')
         for folder, files in folders.items():
-            # Don't add the pseudo-top-directory
-            if files and files[0].full_path is None:
-                files = files[1:]
-                if create_topdir_parent_link:
-                    files = [parent_file_detail] + files
-            elif create_parent_links:
-                files = [parent_file_detail] + files
-
-            # Do generate a link to the parent directory
-            full_path = self._make_index_file(files, 'Index of %s' % (folder,),
-                                              self.file_list.get_tempdir(),
-                                              append_footer)
-
-            if full_path:
-                filename = os.path.basename(full_path)
-                relative_name = os.path.join(folder, filename)
-                indexes[folder] = FileDetail(full_path, relative_name)
+            pages = self._make_index(folder, files, create_parent_links,
+                                     create_topdir_parent_link,
+                                     append_footer)
+            if pages:
+                indexes[folder] = pages
 
         # This appends the index file at the end of the group of files
         # for each directory.
@@ -534,20 +2737,91 @@ class Indexer():
             if dirname == '/':
                 dirname = ''
             if dirname != last_dirname:
-                index = indexes.pop(dirname, None)
-                if index:
-                    new_list.append(index)
+                pages = indexes.pop(dirname, None)
+                if pages:
+                    new_list.extend(reversed(pages))
                     last_dirname = dirname
             new_list.append(f)
         new_list.reverse()
         self.file_list.file_list = new_list
 
+    def make_manifest(self, files=None, index_links=True):
+        '''Make zuul-manifest.json
+
+        The manifest describes every file of the upload in one object, a
+        tree of entries with their name, mimetype, encoding and last
+        modification time, the size of files and the children of
+        folders.
+
+        Args:
+          files: The FileDetails to describe, the file list if None.
+          index_links (bool): Whether folders have index pages to link
+             to, recorded in the manifest for viewers.
+
+        Return:
+            The FileDetail of the manifest, to upload with the files.
+        '''
+        if files is None:
+            files = self.file_list
+        children = {'': []}
+        for f in files:
+            if not f.relative_path:
+                # The pseudo-top-directory
+                continue
+            entry = {
+                'name': f.filename,
+                'mimetype': f.mimetype,
+                'encoding': f.encoding,
+                'last_modified': calendar.timegm(f.last_modified),
+            }
+            if f.folder:
+                entry['children'] = children.setdefault(f.relative_path, [])
+            else:
+                entry['size'] = f.size
+            parent = os.path.dirname(f.relative_path)
+            children.setdefault(parent, []).append(entry)
+
+        manifest = {'tree': children[''], 'index_links': index_links}
+        content = json.dumps(manifest, separators=(',', ':'))
+        return FileDetail.from_content(self.manifest_filename,
+                                       self._store(content.encode('utf-8')))
+
 
-class GzipFilter():
+class FileSegment():
+    """A file-like view on length bytes of a file from its position"""
+
+    def __init__(self, infile, length):
+        self.infile = infile
+        self.remaining = length
+
+    def __len__(self):
+        return self.remaining
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self.infile.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class EncodingFilter():
     chunk_size = 16384
 
-    def __init__(self, infile):
-        self.gzipfile = GZIPCompressedStream(infile)
+    def __init__(self, infile, encoding='gzip', size=0, compression_level=9,
+                 line_index=False, metrics=None):
+        if line_index:
+            if encoding != 'gzip':
+                raise ValueError("Line indexes need the gzip encoding")
+            self.encodedfile = LineIndexedGZIPCompressedStream(
+                infile, compression_level)
+        else:
+            self.encodedfile = get_content_encoder(encoding).open(
+                infile, size, compression_level)
+        if metrics is not None:
+            self.encodedfile = metrics.meter(self.encodedfile, size)
         self.done = False
 
     def __iter__(self):
@@ -555,14 +2829,20 @@ class GzipFilter():
 
     def __next__(self):
         if self.done:
-            self.gzipfile.close()
+            self.encodedfile.close()
             raise StopIteration()
-        data = self.gzipfile.read(self.chunk_size)
+        data = self.encodedfile.read(self.chunk_size)
         if not data:
             self.done = True
         return data
 
 
+class GzipFilter(EncodingFilter):
+    def __init__(self, infile, size=0, compression_level=9):
+        super(GzipFilter, self).__init__(infile, 'gzip', size,
+                                         compression_level)
+
+
 class DeflateFilter():
     chunk_size = 16384
 
@@ -589,3 +2869,112 @@ class DeflateFilter():
                 ret = self.encoder.flush()
                 break
         return ret
+
+
+class CompressorStream(io.RawIOBase):
+    """Read a stream through a streaming compressor
+
+    Args:
+        stream: The file-like object to compress.
+        compress: Function returning the compressed output for the
+                  given input, as much as is available yet.
+        finish: Function returning the rest of the compressed output
+                once all the input is given.
+    """
+    chunk_size = 65536
+
+    def __init__(self, stream, compress, finish):
+        self._stream = stream
+        self._compress = compress
+        self._finish = finish
+        self._buffer = b''
+        self._offset = 0
+        self._finished = False
+        self.count = 0
+
+    def read(self, size=-1):
+        r = super().read(size)
+        self.count += len(r)
+        return r
+
+    def tell(self):
+        return self.count
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset >= len(self._buffer):
+            if self._finished:
+                return 0
+            data = self._stream.read(self.chunk_size)
+            if data:
+                self._buffer = self._compress(data)
+            else:
+                self._buffer = self._finish()
+                self._finished = True
+            self._offset = 0
+        size = min(len(b), len(self._buffer) - self._offset)
+        b[:size] = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+
+class ContentEncoder():
+    """A content encoding files can be uploaded with
+
+    Args:
+        encoding (str): The content-encoding header value.
+        open_stream: Function taking a file-like object, its size and
+                     a compression level from 1 to 9, and returning a
+                     file-like object reading it encoded.
+        concatenable (bool): Whether the concatenation of encoded
+                             streams is a valid encoded stream, as
+                             needed to encode segments separately.
+    """
+
+    def __init__(self, encoding, open_stream, concatenable=False):
+        self.encoding = encoding
+        self.open = open_stream
+        self.concatenable = concatenable
+
+
+CONTENT_ENCODERS = {}
+
+
+def register_content_encoder(encoder):
+    CONTENT_ENCODERS[encoder.encoding] = encoder
+
+
+def get_content_encoder(encoding):
+    """Return the ContentEncoder of a content encoding
+
+    Raises ValueError when it is unknown or when the library it needs is
+    not installed.
+    """
+    try:
+        return CONTENT_ENCODERS[encoding]
+    except KeyError:
+        raise ValueError("Content encoding %s is not available, use one "
+                         "of %s" % (encoding,
+                                    ', '.join(sorted(CONTENT_ENCODERS))))
+
+
+def _open_brotli_stream(stream, size, compression_level):
+    compressor = brotli.Compressor(quality=compression_level)
+    return CompressorStream(stream, compressor.process, compressor.finish)
+
+
+def _open_zstd_stream(stream, size, compression_level):
+    compressor = zstandard.ZstdCompressor(
+        level=compression_level).compressobj()
+    return CompressorStream(stream, compressor.compress, compressor.flush)
+
+
+register_content_encoder(
+    ContentEncoder('gzip', open_gzip_stream, concatenable=True))
+if brotli:
+    register_content_encoder(ContentEncoder('br', _open_brotli_stream))
+if zstandard:
+    register_content_encoder(
+        ContentEncoder('zstd', _open_zstd_stream, concatenable=True))
@@ -18,14 +18,22 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import json
 import os
 import testtools
+import threading
 import time
 import stat
 import fixtures
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from bs4 import BeautifulSoup
+from . import zuul_swift_upload
 from .zuul_swift_upload import FileList, Indexer, FileDetail
+from .zuul_swift_upload import UploadEngine, Uploader, UploadJournal
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
@@ -402,3 +410,90 @@ class TestFileDetail(testtools.TestCase):
 
         self.assertEqual(time.gmtime(0), file_detail.last_modified)
         self.assertEqual(0, file_detail.size)
+
+
+class MockUploader(Uploader):
+    """An uploader that uses a mocked cloud object"""
+    def __init__(self, container, journal=None):
+        self.container = container
+        self.cloud = mock.Mock()
+        self.dry_run = False
+        self.prefix = ""
+        self.delete_after = None
+        self.engine = UploadEngine(concurrency=2)
+        self.journal = journal
+
+
+class TestUploadJournal(testtools.TestCase):
+
+    def test_resume(self):
+        '''Test an interrupted upload resumes with the files left'''
+        # Do not retry (and sleep) on failures
+        self.useFixture(
+            fixtures.MockPatchObject(zuul_swift_upload, 'POST_ATTEMPTS', 1))
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'journal')
+        files = [
+            FileDetail(os.path.join(FIXTURE_DIR, 'logs/controller', name),
+                       'controller/' + name)
+            for name in ('service_log.txt', 'syslog', 'journal.xz')]
+        posted = []
+        # Interrupted on the first attempt only
+        failing = ['controller/syslog']
+
+        def create_object(container, name, data, **headers):
+            posted.append(name)
+            if name in failing:
+                failing.remove(name)
+                raise IOError("Connection reset")
+            return mock.Mock(etag='etag-' + name)
+
+        uploader = MockUploader('container', UploadJournal(path))
+        self.addCleanup(uploader.journal.close)
+        uploader.cloud.create_object.side_effect = create_object
+        failures = uploader.upload(files)
+        self.assertEqual(['syslog'], [f['file'] for f in failures])
+
+        # Run again, like after the job was restarted
+        posted[:] = []
+        uploader = MockUploader('container', UploadJournal(path))
+        self.addCleanup(uploader.journal.close)
+        uploader.cloud.create_object.side_effect = create_object
+        self.assertEqual([], uploader.upload(files))
+        self.assertEqual(['controller/syslog'], posted)
+
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            {'container/controller/service_log.txt':
+             'etag-controller/service_log.txt',
+             'container/controller/journal.xz': 'etag-controller/journal.xz',
+             'container/controller/syslog': 'etag-controller/syslog'},
+            dict((e['name'], e['etag']) for e in entries))
+
+
+class TestUploadEngine(testtools.TestCase):
+
+    def test_task_timeout_concurrency(self):
+        '''Test timed out tasks still count until they return'''
+        self.useFixture(
+            fixtures.MockPatchObject(zuul_swift_upload, 'POST_ATTEMPTS', 1))
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def post(file_detail):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            slow = file_detail.relative_path == 'slow'
+            time.sleep(0.4 if slow else 0.05)
+            with lock:
+                state['running'] -= 1
+
+        engine = UploadEngine(concurrency=2, task_timeout=0.2)
+        engine.poll_interval = 0.05
+        items = [FileDetail('missing', name)
+                 for name in ['slow'] + [str(i) for i in range(8)]]
+        failures = engine.run(post, items)
+        self.assertEqual(['missing'], [f['file'] for f in failures])
+        self.assertEqual(2, state['peak'])
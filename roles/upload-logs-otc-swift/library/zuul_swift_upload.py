@@ -23,8 +23,10 @@ Utility to upload files to swift
 """
 
 import argparse
+import calendar
 import gzip
 import io
+import json
 import logging
 import mimetypes
 import os
@@ -64,6 +66,9 @@ mimetypes.init()
 mimetypes.add_type('text/plain', '.yaml')
 
 MAX_UPLOAD_THREADS = 24
+# Upper bound of the summed size of the files an UploadEngine uploads at
+# the same time.
+MAX_INFLIGHT_BYTES = 1024 * 1024 * 1024
 POST_ATTEMPTS = 3
 
 # Map mime types to apache icons
@@ -247,6 +252,160 @@ def retry_function(func):
                 time.sleep(attempt * 10)
 
 
+class UploadTimeout(Exception):
+    pass
+
+
+def default_failure(item, error):
+    return {
+        "file": item.filename,
+        "error": "{}".format(error)
+    }
+
+
+class UploadEngine():
+    """Run upload tasks on a bounded pool of worker threads
+
+    Every Uploader hands its file list to an UploadEngine instead of
+    managing its own threads, so the number of concurrent uploads, the
+    amount of data in flight and the time a single upload may take are
+    capped in one place.
+
+    A timed out task is reported as failed and its worker abandoned,
+    but the worker still counts against the concurrency until its task
+    returns, so slow storage does not get more uploads at once.  Only
+    after another task_timeout does a worker stuck for good stop
+    counting, so it cannot stall the upload.
+
+    An engine runs one file list at a time.
+    """
+
+    # How often the calling thread looks for timed out tasks
+    poll_interval = 1.0
+
+    def __init__(self, concurrency=None, max_inflight_bytes=None,
+                 task_timeout=None):
+        """
+        Args:
+            concurrency (int): Number of worker threads, defaults to
+                               MAX_UPLOAD_THREADS.
+            max_inflight_bytes (int): Upper bound of the summed size of
+                                      the items uploaded at the same time.
+                                      A single bigger item is uploaded on
+                                      its own.
+            task_timeout (float): Seconds after which a task, including
+                                  its retries, is reported as failed.
+        """
+        self.concurrency = max(1, concurrency or MAX_UPLOAD_THREADS)
+        self.max_inflight_bytes = max_inflight_bytes or MAX_INFLIGHT_BYTES
+        self.task_timeout = task_timeout
+        self._cond = threading.Condition()
+
+    def run(self, func, items, on_failure=default_failure):
+        """Call func(item) for every item using the worker pool
+
+        Each call is retried with retry_function. Errors left after the
+        retries and timed out tasks are turned into failure entries with
+        on_failure(item, error).
+
+        Returns:
+            A list of failure entries, one per failed item.
+        """
+        items = list(items)
+        self._queue = queuelib.Queue()
+        for item in items:
+            self._queue.put(item)
+        self._func = func
+        self._on_failure = on_failure
+        self._failures = []
+        self._running = {}
+        # Timed out workers still running, by the time they timed out
+        self._abandoned = {}
+        self._inflight_bytes = 0
+
+        workers = [self._start_worker()
+                   for x in range(min(len(items), self.concurrency))]
+        while workers:
+            if self.task_timeout:
+                workers[0].join(self.poll_interval)
+                self._expire_tasks(workers)
+            else:
+                workers[0].join()
+            workers = [t for t in workers if t.is_alive()]
+        return self._failures
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._worker)
+        # Timed out tasks are abandoned, they must not keep the
+        # process alive.
+        t.daemon = True
+        t.start()
+        return t
+
+    def _expire_tasks(self, workers):
+        now = time.time()
+        with self._cond:
+            for worker, expired in list(self._abandoned.items()):
+                if now - expired >= self.task_timeout:
+                    # Stuck for good, stop holding its slot
+                    del self._abandoned[worker]
+                    self._cond.notify_all()
+            for worker, (item, started, size) in list(self._running.items()):
+                if now - started < self.task_timeout:
+                    continue
+                # The worker is left to finish on its own; it notices
+                # that it was abandoned and exits.
+                del self._running[worker]
+                self._abandoned[worker] = now
+                self._inflight_bytes -= size
+                self._cond.notify_all()
+                self._failures.append(self._on_failure(
+                    item, UploadTimeout(
+                        "Timed out after %s seconds" % self.task_timeout)))
+                workers.remove(worker)
+                workers.append(self._start_worker())
+
+    def _worker(self):
+        me = threading.current_thread()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queuelib.Empty:
+                # No more work to do
+                return
+            size = getattr(item, 'size', 0) or 0
+            with self._cond:
+                while ((self._inflight_bytes and
+                        self._inflight_bytes + size >
+                        self.max_inflight_bytes) or
+                       len(self._running) + len(self._abandoned) >=
+                       self.concurrency):
+                    self._cond.wait()
+                self._inflight_bytes += size
+                self._running[me] = (item, time.time(), size)
+
+            logging.debug("%s: processing job %s", me, item)
+            error = None
+            try:
+                retry_function(lambda: self._func(item))
+            except Exception as e:
+                # Do our best to attempt to upload all the files
+                logging.exception("Error uploading %s", item)
+                error = e
+
+            with self._cond:
+                if self._running.pop(me, None) is None:
+                    # Timed out, a replacement worker took over and can
+                    # have the slot now
+                    self._abandoned.pop(me, None)
+                    self._cond.notify_all()
+                    return
+                self._inflight_bytes -= size
+                self._cond.notify_all()
+                if error is not None:
+                    self._failures.append(self._on_failure(item, error))
+
+
 def sizeof_fmt(num, suffix='B'):
     # From http://stackoverflow.com/questions/1094841/
     # reusable-library-to-get-human-readable-version-of-file-size
@@ -402,6 +561,70 @@ class FileList(Sequence):
         self.file_list += file_list
 
 
+class UploadJournal():
+    """On-disk record of the objects an upload completed
+
+    Every uploaded object is appended to the journal file as a JSON
+    line, with the size and modification time of the file it was
+    uploaded from and the ETag swift returned.  When an interrupted
+    upload runs again with the same journal, the files which were
+    uploaded and did not change since are skipped.
+
+    The journal file is kept open for appending until close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = self._load()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _load(self):
+        entries = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by the interruption
+                        continue
+                    entries[entry['name']] = entry
+        except IOError:
+            pass
+        return entries
+
+    @staticmethod
+    def _stamp(file_detail):
+        return file_detail.size, calendar.timegm(file_detail.last_modified)
+
+    def is_done(self, name, file_detail):
+        """Whether an object was uploaded from the file as it is now"""
+        with self._lock:
+            entry = self._entries.get(name)
+        return (entry is not None and
+                (entry['size'], entry['mtime']) == self._stamp(file_detail))
+
+    def done(self, name, file_detail, etag=None):
+        """Record that an object was uploaded from a file"""
+        size, mtime = self._stamp(file_detail)
+        entry = {'name': name, 'size': size, 'mtime': mtime, 'etag': etag}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._entries[name] = entry
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(line)
+            # What is written survives the process being killed
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
 class Indexer():
     """Index a FileList
 
@@ -604,9 +827,11 @@ class DeflateFilter():
 
 class Uploader():
     def __init__(self, cloud, container, prefix=None, delete_after=None,
-                 public=True, dry_run=False):
+                 public=True, dry_run=False, engine=None, journal=None):
 
         self.dry_run = dry_run
+        self.engine = engine or UploadEngine()
+        self.journal = journal
         if dry_run:
             self.url = 'http://dry-run-url.com/a/path/'
             return
@@ -676,51 +901,34 @@ class Uploader():
         self.url = os.path.join(container, self.prefix)
 
     def upload(self, file_list):
-        """Spin up thread pool to upload to swift"""
+        """Upload the file list to swift using the upload engine"""
 
         if self.dry_run:
             return
 
-        num_threads = min(len(file_list), MAX_UPLOAD_THREADS)
-        threads = []
-        queue = queuelib.Queue()
-        # add items to queue
-        for f in file_list:
+        files = [
+            f for f in file_list
             if (f.full_path
                 and 'job-output.json' not in f.full_path
                 and 'zuul-info' not in f.full_path
                 and 'alerts.csv' not in f.full_path
-                and 'testrepository.subunit' not in f.full_path
-               ):
-                queue.put(f)
+                and 'testrepository.subunit' not in f.full_path)
+        ]
+        if not self.journal:
+            return self.engine.run(self._post_file, files)
 
-        for x in range(num_threads):
-            t = threading.Thread(target=self.post_thread, args=(queue,))
-            threads.append(t)
-            t.start()
+        files = [f for f in files
+                 if not self.journal.is_done(self._journal_name(f), f)]
 
-        for t in threads:
-            t.join()
+        def post(file_detail):
+            etag = self._post_file(file_detail)
+            self.journal.done(self._journal_name(file_detail), file_detail,
+                              etag)
+        return self.engine.run(post, files)
 
-    def post_thread(self, queue):
-        while True:
-            try:
-                file_detail = queue.get_nowait()
-                logging.debug("%s: processing job %s",
-                              threading.current_thread(),
-                              file_detail)
-                retry_function(lambda: self._post_file(file_detail))
-            except requests.exceptions.RequestException:
-                # Do our best to attempt to upload all the files
-                logging.exception("Error posting file after multiple attempts")
-                continue
-            except IOError:
-                # Do our best to attempt to upload all the files
-                logging.exception("Error opening file")
-                continue
-            except queuelib.Empty:
-                # No more work to do
-                return
+    def _journal_name(self, file_detail):
+        return os.path.join(self.container, self.prefix,
+                            file_detail.relative_path)
 
     @staticmethod
     def _is_text_type(mimetype):
@@ -779,12 +987,15 @@ class Uploader():
                 'content_type': file_detail.mimetype
             }
         )
+        return obj.etag
 
 
 def run(cloud, container, files,
         indexes=True, parent_links=True, topdir_parent_link=False,
         partition=False, footer='index_footer.html', delete_after=15552000,
-        prefix=None, public=True, dry_run=False):
+        prefix=None, public=True, dry_run=False,
+        concurrency=MAX_UPLOAD_THREADS, max_inflight_bytes=None,
+        task_timeout=None, journal=None):
 
     if prefix:
         prefix = prefix.lstrip('/')
@@ -813,9 +1024,17 @@ def run(cloud, container, files,
             logging.debug(x)
 
         # Upload.
-        uploader = Uploader(cloud, container, prefix, delete_after,
-                            public, dry_run)
-        uploader.upload(file_list)
+        engine = UploadEngine(concurrency=concurrency,
+                              max_inflight_bytes=max_inflight_bytes,
+                              task_timeout=task_timeout)
+        upload_journal = UploadJournal(journal) if journal else None
+        try:
+            uploader = Uploader(cloud, container, prefix, delete_after,
+                                public, dry_run, engine, upload_journal)
+            uploader.upload(file_list)
+        finally:
+            if upload_journal is not None:
+                upload_journal.close()
         return uploader.url
 
 
@@ -833,6 +1052,10 @@ def ansible_main():
             footer=dict(type='str'),
             delete_after=dict(type='int'),
             prefix=dict(type='str'),
+            concurrency=dict(type='int', default=MAX_UPLOAD_THREADS),
+            max_inflight_bytes=dict(type='int'),
+            task_timeout=dict(type='int'),
+            journal=dict(type='path'),
         )
     )
 
@@ -847,7 +1070,11 @@ def ansible_main():
                   footer=p.get('footer'),
                   delete_after=p.get('delete_after', 15552000),
                   prefix=p.get('prefix'),
-                  public=p.get('public'))
+                  public=p.get('public'),
+                  concurrency=p.get('concurrency'),
+                  max_inflight_bytes=p.get('max_inflight_bytes'),
+                  task_timeout=p.get('task_timeout'),
+                  journal=p.get('journal'))
     except (keystoneauth1.exceptions.http.HttpError,
             requests.exceptions.RequestException):
         s = "Error uploading to %s.%s" % (cloud.name, cloud.config.region_name)
@@ -892,6 +1119,20 @@ def cli_main():
     parser.add_argument('--prefix',
                         help='Prepend this path to the object names when '
                              'uploading')
+    parser.add_argument('--concurrency', default=MAX_UPLOAD_THREADS,
+                        type=int,
+                        help='Number of files to upload in parallel')
+    parser.add_argument('--max-inflight-bytes', type=int,
+                        help='Upper bound of the summed size of the files '
+                             'uploaded in parallel')
+    parser.add_argument('--task-timeout', type=int,
+                        help='Seconds after which the upload of a single '
+                             'file is given up on')
+    parser.add_argument('--journal',
+                        help='Record the uploaded objects in this local '
+                             'file, and skip the files it records as '
+                             'uploaded and unchanged since, to resume an '
+                             'interrupted upload')
     parser.add_argument('--dry-run', action='store_true',
                         help='do not attempt to create containers or upload, '
                              'useful with --verbose for debugging')
@@ -926,7 +1167,11 @@ def cli_main():
               delete_after=args.delete_after,
               prefix=args.prefix,
               public=not args.no_public,
-              dry_run=args.dry_run)
+              dry_run=args.dry_run,
+              concurrency=args.concurrency,
+              max_inflight_bytes=args.max_inflight_bytes,
+              task_timeout=args.task_timeout,
+              journal=args.journal)
     print(url)
 
 